@@ -1,23 +1,42 @@
 import asyncio
 import base64
+import bisect
+import csv
 import json
 import os
+import random
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 import requests
 import io
 import gspread
 import sys
 import logging
+import sqlite3
+import threading
+import time
 import traceback
+import tracemalloc
 import urllib.parse
+import functools
+import hashlib
+import hmac
+import ipaddress
+import contextvars
+import importlib.util
+import itertools
+from collections import OrderedDict
+from html import unescape as html_unescape
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from typing import List, Tuple
 from telethon.network import connection as tl_connection
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 from telethon.extensions import html as tl_html
-from telethon import types
+from telethon.helpers import add_surrogate, del_surrogate
+from telethon import types, functions
 import telethon.errors as tl_errors
 from dotenv import load_dotenv
 
@@ -28,11 +47,35 @@ try:
 except Exception:
     _PIL_AVAILABLE = False
 
-# Загрузка переменных из .env файла
-load_dotenv()
+# Optional: таблица ширин глифов для векторного измерения текста (без FreeType на каждый вызов)
+try:
+    import numpy as np
+    _NP_AVAILABLE = True
+except Exception:
+    _NP_AVAILABLE = False
+
+# Мультиарендный режим: хост-процесс (TENANTS=...) загружает отдельную копию скрипта
+# на каждого арендатора и до загрузки подставляет ей TENANT (имя), SHARED (общие ресурсы)
+# и ENV — её настройки (неизменяемый словарь переменных). Вся конфигурация читается из ENV,
+# а не из os.environ, поэтому арендаторы не видят настроек друг друга — даже при чтении
+# настройки позже, в рабочем потоке.
+TENANT = globals().get("TENANT")
+SHARED = globals().get("SHARED") or {}
+
+# Загрузка переменных из .env файла (копии арендаторов получают уже готовые настройки)
+if not TENANT:
+    load_dotenv()
+ENV = globals().get("ENV", os.environ)
+
+# Офлайн-режимы командной строки (--bench-*, --dry-run, --sqlite-import) работают без Telegram:
+# обязательные креды не проверяются, клиенты не подключаются, уведомления не отправляются
+BENCH_MODE = next((a for a in sys.argv[1:] if a.startswith("--bench")), None)
+DRY_RUN = "--dry-run" in sys.argv[1:]
+SQLITE_IMPORT = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("--sqlite-import=")), None)
+OFFLINE_MODE = BENCH_MODE is not None or DRY_RUN or SQLITE_IMPORT is not None
 
 # Mute noisy Telethon reconnect logs like "Server closed the connection" unless explicitly overridden
-LOG_LEVEL = os.environ.get("TELETHON_LOG_LEVEL", "ERROR").upper()
+LOG_LEVEL = ENV.get("TELETHON_LOG_LEVEL", "ERROR").upper()
 try:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
     logging.getLogger("telethon").setLevel(getattr(logging, LOG_LEVEL, logging.ERROR))
@@ -43,20 +86,23 @@ except Exception:
 
 # === Telegram DM notifications via Bot API ===================================
 # Configure env: TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID
-TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
+TELEGRAM_BOT_TOKEN = ENV.get("TELEGRAM_BOT_TOKEN")
+TELEGRAM_CHAT_ID = ENV.get("TELEGRAM_CHAT_ID")
+
+# Общий для процесса HTTP-пул (keep-alive): уведомления и загрузка медиа всех арендаторов
+HTTP = SHARED.setdefault("http", requests.Session())
 
 def tg_notify(text: str):
     """
     Fire-and-forget notification to your personal chat via Bot API.
-    Does nothing if TELEGRAM_BOT_TOKEN/TELEGRAM_CHAT_ID are not set.
+    Does nothing if TELEGRAM_BOT_TOKEN/TELEGRAM_CHAT_ID are not set or in offline modes.
     """
-    if not (TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID):
+    if OFFLINE_MODE or not (TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID):
         return
     try:
-        msg = str(text)
+        msg = f"[{TENANT}] {text}" if TENANT else str(text)
         # Telegram max length ~4096
-        requests.post(
+        HTTP.post(
             f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
             data={
                 "chat_id": TELEGRAM_CHAT_ID,
@@ -82,9 +128,11 @@ class TGBotLoggingHandler(logging.Handler):
             pass
 
 _lvl = logging.ERROR
-_tg_handler = TGBotLoggingHandler(level=_lvl)
-_tg_handler.setFormatter(logging.Formatter("%(name)s: %(message)s"))
-logging.getLogger().addHandler(_tg_handler)
+if not TENANT:
+    # Обработчик один на процесс — арендаторы пишут в тот же корневой логгер
+    _tg_handler = TGBotLoggingHandler(level=_lvl)
+    _tg_handler.setFormatter(logging.Formatter("%(name)s: %(message)s"))
+    logging.getLogger().addHandler(_tg_handler)
 
 # Helper to log and DM-notify skipped publications
 def _notify_skip(row_idx, reason):
@@ -122,7 +170,7 @@ def _swap_media_extension(url: str):
 
 def _download_with_fallback(url: str, row_idx: int, timeout=(5, 60)):
     try:
-        resp = requests.get(url, timeout=timeout)
+        resp = HTTP.get(url, timeout=timeout)
         resp.raise_for_status()
         return resp.content, url, resp.headers.get('Content-Type', '').lower()
     except Exception as first_e:
@@ -132,7 +180,7 @@ def _download_with_fallback(url: str, row_idx: int, timeout=(5, 60)):
         last_err = first_e
         for alt in alts:
             try:
-                resp = requests.get(alt, timeout=timeout)
+                resp = HTTP.get(alt, timeout=timeout)
                 resp.raise_for_status()
                 return resp.content, alt, resp.headers.get('Content-Type', '').lower()
             except Exception as e:
@@ -166,38 +214,174 @@ if sys.version_info >= (3, 13):
     print("ПРЕДУПРЕЖДЕНИЕ: Обнаружен Python 3.13+. Известны проблемы совместимости asyncio с Telethon. "
           "Рекомендуется использовать Python 3.11–3.12 или обновить Telethon до последней версии.")
 
+# --- 0. МУЛЬТИАРЕНДНЫЙ РЕЖИМ (несколько таблиц и наборов каналов в одном процессе) ---
+#
+# TENANTS=erevan,gyumri — каждый арендатор получает свои настройки (ENV): общие переменные
+# процесса плюс переопределения с префиксом <ИМЯ>__ (ERVAN__GSHEET_ID, ERVAN__TG1_CHANNEL, ...).
+# Если арендатор задаёт свои TG{n}_CHANNEL, общие TG{n}_CHANNEL ему не достаются.
+# Общие на процесс: импорты, шрифт короны, HTTP-пул, кэш медиа, квоты Sheets
+# сервисного аккаунта и клиенты Telethon с одинаковой сессией. Раздельные: таблица,
+# журнал отправок, кэши строк, счётчики и webhook (у каждого арендатора свой порт).
+
+TENANTS = [] if TENANT else [t.strip() for t in ENV.get("TENANTS", "").split(",") if t.strip()]
+TENANT_RESTART_SECONDS = int(ENV.get("TENANT_RESTART_SECONDS", "60"))
+TENANT_STATS_MINUTES = float(ENV.get("TENANT_STATS_MINUTES", "15"))
+
+# Имя арендатора текущей задачи asyncio — подставляется в каждую запись лога
+_TENANT_CTX = contextvars.ContextVar("tenant", default=None)
+
+class _TenantPrefixedStream:
+    """stdout, в котором каждая строка помечается арендатором текущей задачи —
+    тот же префикс, что и у записей лога, без подмены print в копиях скрипта."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._line_start = True
+
+    def write(self, text):
+        name = _TENANT_CTX.get()
+        with self._lock:
+            if name and text:
+                # print пишет аргументы по частям — префикс ставится только в начале строки
+                parts = []
+                for piece in text.splitlines(True):
+                    parts.append(f"[{name}] {piece}" if self._line_start and piece.strip() else piece)
+                    self._line_start = piece.endswith("\n")
+                text = "".join(parts)
+            elif text:
+                self._line_start = text.endswith("\n")
+            return self._stream.write(text)
+
+    def __getattr__(self, attr):
+        return getattr(self._stream, attr)
+
+def _install_tenant_log_prefix():
+    base_factory = logging.getLogRecordFactory()
+
+    def factory(*args, **kwargs):
+        record = base_factory(*args, **kwargs)
+        name = _TENANT_CTX.get()
+        if name:
+            record.msg = f"[{name}] {record.msg}"
+        return record
+
+    logging.setLogRecordFactory(factory)
+    sys.stdout = _TenantPrefixedStream(sys.stdout)
+
+def _tenant_env(name: str) -> dict:
+    """Настройки арендатора: общие переменные + <ИМЯ>__VAR поверх них."""
+    prefixes = tuple(f"{t.upper()}__" for t in TENANTS)
+    own = f"{name.upper()}__"
+    env = {k: v for k, v in os.environ.items() if not k.startswith(prefixes) and k != "TENANTS"}
+    overrides = {k[len(own):]: v for k, v in os.environ.items() if k.startswith(own)}
+    if any(re.match(r"^TG\d+_CHANNEL$", k) for k in overrides):
+        env = {k: v for k, v in env.items() if not re.match(r"^TG\d+_CHANNEL$", k)}
+    env.update(overrides)
+    return env
+
+def _load_tenant(name: str):
+    """Выполнить копию скрипта с настройками арендатора (os.environ процесса не меняется).
+    Ошибки конфигурации (exit() при загрузке) выходят наружу как SystemExit."""
+    spec = importlib.util.spec_from_file_location(f"telethon_poster_{name}", os.path.abspath(__file__))
+    module = importlib.util.module_from_spec(spec)
+    module.TENANT = name
+    module.SHARED = SHARED
+    module.ENV = MappingProxyType(_tenant_env(name))
+    spec.loader.exec_module(module)
+    return module
+
+async def _run_tenant(name: str, module):
+    """Главный цикл арендатора; его падение не затрагивает остальных — перезапуск с паузой."""
+    _TENANT_CTX.set(name)
+    delay = TENANT_RESTART_SECONDS
+    while True:
+        try:
+            await module.main()
+            reason = "главный цикл завершился"
+        except asyncio.CancelledError:
+            raise
+        except SystemExit as e:
+            reason = f"exit({e.code})"
+        except Exception as e:
+            logging.error(f"Сбой арендатора: {e}", exc_info=True)
+            reason = f"сбой: {e}"
+        module.CYCLE_STATS["restarts"] += 1
+        logging.error(f"Арендатор остановлен ({reason}). Перезапуск через {delay} сек.")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1800)
+
+async def _tenant_stats_loop(modules: dict):
+    while True:
+        await asyncio.sleep(max(60.0, TENANT_STATS_MINUTES * 60))
+        for name, module in modules.items():
+            try:
+                logging.info(f"[{name}] {module.tenant_status()}")
+            except Exception as e:
+                logging.warning(f"[{name}] статистика недоступна: {e}")
+
+async def run_tenants(names) -> int:
+    _install_tenant_log_prefix()
+    modules = {}
+    for name in names:
+        token = _TENANT_CTX.set(name)
+        try:
+            modules[name] = _load_tenant(name)
+            print(f"Арендатор {name}: конфигурация загружена.")
+        except (SystemExit, Exception) as e:
+            logging.error(f"Арендатор не загружен: {e!r}")
+            tg_notify(f"❗️Арендатор {name} не загружен: {e!r}")
+        finally:
+            _TENANT_CTX.reset(token)
+    if not modules:
+        print("ОШИБКА: ни один арендатор из TENANTS не загружен.")
+        return 1
+    await asyncio.gather(
+        *(_run_tenant(name, module) for name, module in modules.items()),
+        _tenant_stats_loop(modules),
+    )
+    return 0
+
+if TENANTS and not OFFLINE_MODE and __name__ == "__main__":
+    sys.exit(asyncio.run(run_tenants(TENANTS)))
+
 # --- 1. КОНФИГУРАЦИЯ ---
 
 # Google Sheets
-GSHEET_ID = os.environ.get("GSHEET_ID")
-GOOGLE_CREDS_JSON = os.environ.get("GOOGLE_CREDS_JSON")
+GSHEET_ID = ENV.get("GSHEET_ID")
+GOOGLE_CREDS_JSON = ENV.get("GOOGLE_CREDS_JSON")
+
+# Источник записей: sheets (по умолчанию) | csv | xlsx | sqlite
+RECORD_SOURCE = ENV.get("RECORD_SOURCE", "sheets").strip().lower()
+RECORD_SOURCE_PATH = ENV.get("RECORD_SOURCE_PATH", "")
+RECORD_SOURCE_TABLE = ENV.get("RECORD_SOURCE_TABLE", "posts")
 
 # Общие Telegram API креды
-TG_API_ID_STR = os.environ.get("TG_API_ID")
-TG_API_HASH = os.environ.get("TG_API_HASH")
-if not TG_API_ID_STR or not TG_API_HASH:
+TG_API_ID_STR = ENV.get("TG_API_ID")
+TG_API_HASH = ENV.get("TG_API_HASH")
+if (not TG_API_ID_STR or not TG_API_HASH) and not OFFLINE_MODE:
     print("ОШИБКА: Укажите общие TG_API_ID и TG_API_HASH в переменных окружения.")
     exit(1)
 try:
-    TG_API_ID = int(TG_API_ID_STR)
+    TG_API_ID = int(TG_API_ID_STR or 0)
 except Exception:
     print("ОШИБКА: TG_API_ID должен быть числом.")
     exit(1)
 
 # Один общий аккаунт для всех каналов
-TG_SESSION = os.environ.get("TG_SESSION") or os.environ.get("TG1_SESSION")
-if not TG_SESSION:
+TG_SESSION = ENV.get("TG_SESSION") or ENV.get("TG1_SESSION")
+if not TG_SESSION and not OFFLINE_MODE:
     print("ОШИБКА: Укажите TG_SESSION (StringSession одного аккаунта) в переменных окружения.")
     exit(1)
 
 # Глобальный (общий) прокси (опционально): TG_PROXY_*
 GLOBAL_PROXY = None
-gp_type = os.environ.get("TG_PROXY_TYPE") or os.environ.get("PROXY_TYPE")
-gp_host = os.environ.get("TG_PROXY_HOST") or os.environ.get("PROXY_HOST")
-gp_port_str = os.environ.get("TG_PROXY_PORT") or os.environ.get("PROXY_PORT")
-gp_rdns_str = os.environ.get("TG_PROXY_RDNS", os.environ.get("PROXY_RDNS", "true"))
-gp_user = os.environ.get("TG_PROXY_USER") or os.environ.get("PROXY_USER")
-gp_pass = os.environ.get("TG_PROXY_PASS") or os.environ.get("PROXY_PASS")
+gp_type = ENV.get("TG_PROXY_TYPE") or ENV.get("PROXY_TYPE")
+gp_host = ENV.get("TG_PROXY_HOST") or ENV.get("PROXY_HOST")
+gp_port_str = ENV.get("TG_PROXY_PORT") or ENV.get("PROXY_PORT")
+gp_rdns_str = ENV.get("TG_PROXY_RDNS", ENV.get("PROXY_RDNS", "true"))
+gp_user = ENV.get("TG_PROXY_USER") or ENV.get("PROXY_USER")
+gp_pass = ENV.get("TG_PROXY_PASS") or ENV.get("PROXY_PASS")
 
 if gp_type and gp_host and gp_port_str:
     try:
@@ -215,12 +399,12 @@ def _proxy_tuple_for_index(idx: int):
     Разрешает переопределения TG{idx}_PROXY_TYPE/HOST/PORT/RDNS/USER/PASS,
     иначе использует глобальные TG_PROXY_*.
     """
-    t = os.environ.get(f"TG{idx}_PROXY_TYPE") or gp_type
-    h = os.environ.get(f"TG{idx}_PROXY_HOST") or gp_host
-    p_str = os.environ.get(f"TG{idx}_PROXY_PORT") or gp_port_str
-    rdns_str = os.environ.get(f"TG{idx}_PROXY_RDNS") or gp_rdns_str
-    u = os.environ.get(f"TG{idx}_PROXY_USER") or gp_user
-    pw = os.environ.get(f"TG{idx}_PROXY_PASS") or gp_pass
+    t = ENV.get(f"TG{idx}_PROXY_TYPE") or gp_type
+    h = ENV.get(f"TG{idx}_PROXY_HOST") or gp_host
+    p_str = ENV.get(f"TG{idx}_PROXY_PORT") or gp_port_str
+    rdns_str = ENV.get(f"TG{idx}_PROXY_RDNS") or gp_rdns_str
+    u = ENV.get(f"TG{idx}_PROXY_USER") or gp_user
+    pw = ENV.get(f"TG{idx}_PROXY_PASS") or gp_pass
     if not (t and h and p_str):
         return GLOBAL_PROXY
     try:
@@ -231,11 +415,11 @@ def _proxy_tuple_for_index(idx: int):
     return (t, h, p, rdns, u, pw)
 
 # Требование наличия прокси по переключателю (по умолчанию — включено)
-REQUIRE_PROXY = str(os.environ.get("REQUIRE_PROXY", "true")).lower() in ("1", "true", "yes", "on")
+REQUIRE_PROXY = str(ENV.get("REQUIRE_PROXY", "true")).lower() in ("1", "true", "yes", "on")
 
 # Собираем каналы TG{n}_CHANNEL без жёсткого лимита
 CHANNELS_BY_INDEX = {}
-for key, val in os.environ.items():
+for key, val in ENV.items():
     m = re.match(r"^TG(\d+)_CHANNEL$", key)
     if m and val:
         idx = int(m.group(1))
@@ -243,7 +427,7 @@ for key, val in os.environ.items():
 # Сортировка по индексу для стабильного порядка
 CHANNELS_BY_INDEX = dict(sorted(CHANNELS_BY_INDEX.items()))
 
-if not CHANNELS_BY_INDEX:
+if not CHANNELS_BY_INDEX and not OFFLINE_MODE:
     print("ОШИБКА: Не задан ни один TG{n}_CHANNEL (например, TG1_CHANNEL).")
     exit(1)
 
@@ -251,59 +435,885 @@ if not CHANNELS_BY_INDEX:
 accounts = [{"index": i, "channel": ch} for i, ch in sorted(CHANNELS_BY_INDEX.items())]
 
 # Канал для ссылки на будущий пост (используется для префилла DM-ссылок)
-POST_LINK_CHANNEL_ID = int(os.environ.get("POST_LINK_CHANNEL_ID", "-1002940070930"))
-POST_LINK_CHANNEL_SLUG = os.environ.get("POST_LINK_CHANNEL_SLUG", "axjikner_handipum_erevan")
+POST_LINK_CHANNEL_ID = int(ENV.get("POST_LINK_CHANNEL_ID", "-1002940070930"))
+POST_LINK_CHANNEL_SLUG = ENV.get("POST_LINK_CHANNEL_SLUG", "axjikner_handipum_erevan")
 
 # Проверка прокси — по переключателю REQUIRE_PROXY (по умолчанию обязателен)
-if REQUIRE_PROXY and not GLOBAL_PROXY:
+if REQUIRE_PROXY and not GLOBAL_PROXY and not OFFLINE_MODE:
     logging.error(
         "Прокси не задан. Укажите TG_PROXY_TYPE/TG_PROXY_HOST/TG_PROXY_PORT "
         "(при необходимости TG_PROXY_USER/TG_PROXY_PASS/TG_PROXY_RDNS) — "
         "или установите REQUIRE_PROXY=0, чтобы разрешить работу без прокси."
     )
     exit(1)
-elif not GLOBAL_PROXY:
+elif not GLOBAL_PROXY and not OFFLINE_MODE:
     logging.warning("REQUIRE_PROXY=0 — продолжаем без прокси.")
 
 # Интервал обновления (в секундах)
-REFRESH_SECONDS = int(os.environ.get("REFRESH_SECONDS", 30))
+REFRESH_SECONDS = int(ENV.get("REFRESH_SECONDS", 30))
+
+# --- Push-уведомления об изменениях таблицы (webhook; выключено, если порт не задан) ---
+SHEET_WEBHOOK_PORT = int(ENV.get("SHEET_WEBHOOK_PORT", "0") or 0)
+SHEET_WEBHOOK_HOST = ENV.get("SHEET_WEBHOOK_HOST", "0.0.0.0")
+SHEET_WEBHOOK_TOKEN = ENV.get("SHEET_WEBHOOK_TOKEN", "")
+SHEET_WEBHOOK_PATH = ENV.get("SHEET_WEBHOOK_PATH", "/sheet-changed")
+
+def _is_loopback_host(host: str) -> bool:
+    if host.strip().lower() == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip()).is_loopback
+    except ValueError:
+        return False
+
+# Открытый наружу webhook без токена позволил бы любому гонять перечитывание строк
+if SHEET_WEBHOOK_PORT and not SHEET_WEBHOOK_TOKEN and not _is_loopback_host(SHEET_WEBHOOK_HOST) and not OFFLINE_MODE:
+    print(f"ОШИБКА: webhook слушает {SHEET_WEBHOOK_HOST} — задайте SHEET_WEBHOOK_TOKEN "
+          f"или SHEET_WEBHOOK_HOST=127.0.0.1 (за обратным прокси).")
+    exit(1)
+# Полный опрос листа — страховка; при включённом webhook можно опрашивать редко
+# (локальные источники читаются инкрементально, полный проход тоже нужен редко)
+FULL_POLL_SECONDS = int(ENV.get(
+    "FULL_POLL_SECONDS",
+    "300" if (SHEET_WEBHOOK_PORT or RECORD_SOURCE != "sheets") else str(REFRESH_SECONDS),
+))
 
 # --- Validation tunables (speed up startup; override via env) ---
-VALIDATION_CONNECT_TIMEOUT = int(os.environ.get("VALIDATION_CONNECT_TIMEOUT", "30"))
-VALIDATION_AUTH_TIMEOUT = int(os.environ.get("VALIDATION_AUTH_TIMEOUT", "20"))
-VALIDATION_DISCONNECT_TIMEOUT = int(os.environ.get("VALIDATION_DISCONNECT_TIMEOUT", "10"))
-VALIDATION_CONCURRENCY = int(os.environ.get("VALIDATION_CONCURRENCY", "5"))
+VALIDATION_CONNECT_TIMEOUT = int(ENV.get("VALIDATION_CONNECT_TIMEOUT", "30"))
+VALIDATION_AUTH_TIMEOUT = int(ENV.get("VALIDATION_AUTH_TIMEOUT", "20"))
+VALIDATION_DISCONNECT_TIMEOUT = int(ENV.get("VALIDATION_DISCONNECT_TIMEOUT", "10"))
+VALIDATION_CONCURRENCY = int(ENV.get("VALIDATION_CONCURRENCY", "5"))
+
+# --- Google Sheets I/O tunables (override via env) ---
+SHEETS_CALL_TIMEOUT = float(ENV.get("SHEETS_CALL_TIMEOUT", "60"))
+SHEETS_EXECUTOR_WORKERS = int(ENV.get("SHEETS_EXECUTOR_WORKERS", "2"))
+# Квоты Google Sheets API на пользователя (сервисный аккаунт) в минуту
+SHEETS_READ_PER_MIN = int(ENV.get("SHEETS_READ_PER_MIN", "60"))
+SHEETS_WRITE_PER_MIN = int(ENV.get("SHEETS_WRITE_PER_MIN", "60"))
+SHEETS_MAX_RETRIES = int(ENV.get("SHEETS_MAX_RETRIES", "5"))
+SHEETS_BACKOFF_BASE = float(ENV.get("SHEETS_BACKOFF_BASE", "1"))
+SHEETS_BACKOFF_MAX = float(ENV.get("SHEETS_BACKOFF_MAX", "64"))
+SHEETS_MAX_POLL_SECONDS = int(ENV.get("SHEETS_MAX_POLL_SECONDS", "600"))
+# Запись по номеру столбца сверяется с заголовком, если он проверялся дольше N сек. назад
+HEADER_WRITE_MAX_AGE = float(ENV.get("HEADER_WRITE_MAX_AGE", "10"))
 
 # --- Telethon network tunables (override via env) ---
-TELETHON_REQUEST_RETRIES = int(os.environ.get("TELETHON_REQUEST_RETRIES", "7"))
-TELETHON_CONNECTION_RETRIES = int(os.environ.get("TELETHON_CONNECTION_RETRIES", "6"))
-TELETHON_RETRY_DELAY = int(os.environ.get("TELETHON_RETRY_DELAY", "3"))
-TELETHON_TIMEOUT = int(os.environ.get("TELETHON_TIMEOUT", "45"))
-TELETHON_FLOOD_SLEEP_THRESHOLD = int(os.environ.get("TELETHON_FLOOD_SLEEP_THRESHOLD", "60"))
+TELETHON_REQUEST_RETRIES = int(ENV.get("TELETHON_REQUEST_RETRIES", "7"))
+TELETHON_CONNECTION_RETRIES = int(ENV.get("TELETHON_CONNECTION_RETRIES", "6"))
+TELETHON_RETRY_DELAY = int(ENV.get("TELETHON_RETRY_DELAY", "3"))
+TELETHON_TIMEOUT = int(ENV.get("TELETHON_TIMEOUT", "45"))
+TELETHON_FLOOD_SLEEP_THRESHOLD = int(ENV.get("TELETHON_FLOOD_SLEEP_THRESHOLD", "60"))
 
 # --- 2. НАСТРОЙКА КЛИЕНТОВ ---
 
-# Авторизация в Google Sheets
-try:
-    credentials_json = json.loads(base64.b64decode(GOOGLE_CREDS_JSON))
-    gc = gspread.service_account_from_dict(credentials_json)
-    sheet = gc.open_by_key(GSHEET_ID)
-    worksheet = sheet.sheet1
-except Exception as e:
-    print(f"ОШИБКА: Не удалось подключиться к Google Sheets. Проверьте GOOGLE_CREDS_JSON и GSHEET_ID. {e}")
-    exit()
+# Авторизация в Google Sheets (нужна только источнику sheets)
+worksheet = None
+SHEETS_QUOTA_KEY = None
+if RECORD_SOURCE == "sheets" and not (OFFLINE_MODE and not GOOGLE_CREDS_JSON):
+    try:
+        credentials_json = json.loads(base64.b64decode(GOOGLE_CREDS_JSON))
+        # Квоты Google считаются на сервисный аккаунт — арендаторы с одним аккаунтом делят бюджет
+        SHEETS_QUOTA_KEY = credentials_json.get("client_email")
+        gc = gspread.service_account_from_dict(credentials_json)
+        gc.set_timeout(SHEETS_CALL_TIMEOUT)
+        sheet = gc.open_by_key(GSHEET_ID)
+        worksheet = sheet.sheet1
+    except Exception as e:
+        print(f"ОШИБКА: Не удалось подключиться к Google Sheets. Проверьте GOOGLE_CREDS_JSON и GSHEET_ID. {e}")
+        exit()
+
+
+class TokenBucket:
+    """Token bucket на N запросов в минуту (равномерное пополнение, запас до N или до burst)."""
+
+    def __init__(self, per_minute: int, burst: int = 0):
+        self.rate = max(1.0, float(per_minute)) / 60.0
+        self.capacity = float(burst) if burst > 0 else max(1.0, float(per_minute))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def level(self) -> float:
+        """Доля оставшегося бюджета (0..1)."""
+        self._refill()
+        return self.tokens / self.capacity
+
+    def try_acquire(self) -> bool:
+        """Взять токен без ожидания; False — бюджет на сейчас исчерпан."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> float:
+        """Взять токен, при необходимости подождав. Возвращает время ожидания (сек.)."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+class SheetsUsage:
+    """Поминутные счётчики обращений к Sheets: чтения, записи, байты, 429 и ожидание лимитера.
+    Байты считаются хуком HTTP-сессии gspread, который вызывается из потоков пула."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.minute = int(time.time() // 60)
+        self.current = self._blank()
+        self.last = self._blank()
+
+    @staticmethod
+    def _blank():
+        return {"reads": 0, "writes": 0, "bytes": 0, "throttled": 0, "waited_sec": 0.0}
+
+    def _roll(self):
+        m = int(time.time() // 60)
+        if m == self.minute:
+            return
+        finished = self.current
+        self.last = finished if m == self.minute + 1 else self._blank()
+        self.current = self._blank()
+        self.minute = m
+        if finished["reads"] or finished["writes"]:
+            logging.info(
+                f"Sheets за минуту: чтений {finished['reads']}, записей {finished['writes']}, "
+                f"{finished['bytes'] / 1024:.0f} КБ, 429: {finished['throttled']}, "
+                f"ожидание лимитера {finished['waited_sec']:.1f} сек."
+            )
+
+    def add(self, key: str, n=1):
+        with self._lock:
+            self._roll()
+            self.current[key] += n
+
+    def on_response(self, response, *args, **kwargs):
+        try:
+            self.add("bytes", len(response.content or b""))
+        except Exception:
+            pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._roll()
+            return {"current": dict(self.current), "last_minute": dict(self.last)}
+
+def _is_sheets_quota_error(e) -> bool:
+    if not isinstance(e, gspread.exceptions.APIError):
+        return False
+    code = getattr(e, "code", None)
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return 429 in (code, status)
+
+class AsyncSheet:
+    """Асинхронный доступ к листу: синхронные HTTP-вызовы gspread выполняются
+    в выделенном пуле потоков с таймаутом, поэтому event loop (keepalive, переподключения
+    и загрузки Telethon) никогда не ждёт Google. HTTP-сессия и токен gspread переиспользуются.
+    Чтения и записи проходят через token bucket по квотам Google, на 429 —
+    экспоненциальный backoff с jitter, а интервал опроса растёт, пока бюджет на исходе."""
+
+    def __init__(self, ws, workers: int = SHEETS_EXECUTOR_WORKERS, timeout: float = SHEETS_CALL_TIMEOUT,
+                 quota_key=None):
+        self.ws = ws
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="gsheets")
+        if quota_key:
+            self.read_bucket, self.write_bucket = SHARED.setdefault(
+                ("sheets_quota", quota_key),
+                (TokenBucket(SHEETS_READ_PER_MIN), TokenBucket(SHEETS_WRITE_PER_MIN)),
+            )
+        else:
+            self.read_bucket = TokenBucket(SHEETS_READ_PER_MIN)
+            self.write_bucket = TokenBucket(SHEETS_WRITE_PER_MIN)
+        self.usage = SheetsUsage()
+        self.backoff_level = 0
+        self._last_throttle = 0.0
+        session = getattr(getattr(ws, "client", None), "session", None)
+        if session is not None:
+            session.hooks.setdefault("response", []).append(self.usage.on_response)
+
+    async def _call(self, kind: str, fn, *args, **kwargs):
+        bucket = self.read_bucket if kind == "reads" else self.write_bucket
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            waited = await bucket.acquire()
+            if waited:
+                self.usage.add("waited_sec", waited)
+            self.usage.add(kind)
+            fut = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+            try:
+                return await asyncio.wait_for(fut, timeout=self.timeout)
+            except gspread.exceptions.APIError as e:
+                if not _is_sheets_quota_error(e):
+                    raise
+                self.usage.add("throttled")
+                self.backoff_level = min(self.backoff_level + 1, 5)
+                self._last_throttle = time.monotonic()
+                if attempt >= SHEETS_MAX_RETRIES:
+                    raise
+                # Exponential backoff с full jitter
+                delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * (2 ** attempt)))
+                attempt += 1
+                logging.warning(f"Sheets 429 (квота). Повтор #{attempt} через {delay:.1f} сек.")
+                await asyncio.sleep(delay)
+
+    def poll_interval(self, base: float) -> float:
+        """Интервал опроса с учётом бюджета: удваивается на каждый недавний 429
+        и при почти исчерпанном бюджете чтений, возвращается к base, когда всё спокойно."""
+        if self.backoff_level and time.monotonic() - self._last_throttle > 60:
+            self.backoff_level -= 1
+            self._last_throttle = time.monotonic()
+        factor = 2 ** self.backoff_level
+        if self.read_bucket.level() < 0.2:
+            factor *= 2
+        return min(max(base, base * factor), max(base, SHEETS_MAX_POLL_SECONDS))
+
+    async def get_all_records(self, **kwargs):
+        return await self._call("reads", self.ws.get_all_records, **kwargs)
+
+    async def get_all_values(self, **kwargs):
+        return await self._call("reads", self.ws.get_all_values, **kwargs)
+
+    async def row_values(self, row: int, **kwargs):
+        return await self._call("reads", self.ws.row_values, row, **kwargs)
+
+    async def batch_get(self, ranges, **kwargs):
+        return await self._call("reads", self.ws.batch_get, ranges, **kwargs)
+
+    async def update_cell(self, row: int, col: int, value):
+        return await self._call("writes", self.ws.update_cell, row, col, value)
+
+    async def batch_update(self, data, **kwargs):
+        return await self._call("writes", self.ws.batch_update, data, **kwargs)
+
+    def _archive_ws(self, title: str, header):
+        try:
+            return self.ws.spreadsheet.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            ws = self.ws.spreadsheet.add_worksheet(title=title, rows=1, cols=max(1, len(header)))
+            ws.update([list(header)], "A1")
+            return ws
+
+    async def archive_worksheet(self, title: str, header):
+        """Лист-архив с тем же заголовком (создаётся при первом обращении)."""
+        return await self._call("writes", self._archive_ws, title, header)
+
+    async def move_rows(self, target_ws, rows):
+        """Перенести строки [(номер, значения), ...] в конец target_ws одним
+        spreadsheets.batchUpdate: appendCells + deleteDimension применяются атомарно,
+        поэтому сбой не оставит строку одновременно в архиве и в активном листе.
+        Значения пишутся как есть (строками, аналог RAW) — без разбора формул и дат."""
+        ranges = []
+        for r in sorted({r for r, _ in rows}):
+            if ranges and ranges[-1][1] == r - 1:
+                ranges[-1][1] = r
+            else:
+                ranges.append([r, r])
+        batch_requests = [{"appendCells": {
+            "sheetId": target_ws.id,
+            "rows": [{"values": [{"userEnteredValue": {"stringValue": str(v)}} for v in values]}
+                     for _, values in rows],
+            "fields": "userEnteredValue",
+        }}]
+        # Диапазоны снизу вверх, чтобы номера оставшихся строк не сдвигались
+        batch_requests += [
+            {"deleteDimension": {"range": {
+                "sheetId": self.ws.id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end,
+            }}}
+            for start, end in reversed(ranges)
+        ]
+        return await self._call("writes", self.ws.spreadsheet.batch_update, {"requests": batch_requests})
+
+SHEETS = AsyncSheet(worksheet, quota_key=SHEETS_QUOTA_KEY) if worksheet is not None else None
+
+# --- 2.1. ИСТОЧНИКИ ЗАПИСЕЙ (Google Sheets / CSV / XLSX / SQLite) ---
+
+# Поля строки, которые читают main() и send_post: (заголовок, атрибут PostRow)
+_POST_ROW_FIELDS = (
+    ("Имя", "name"), ("Статус", "status"), ("Время", "time"), ("Отправлено", "sent"),
+    ("Услуги", "services"), ("Доп. услуги", "extra_services"),
+    ("Возраст", "age"), ("Рост", "height"), ("Вес", "weight"), ("Грудь", "bust"),
+    ("Express", "express"), ("Incall", "incall"), ("Outcall", "outcall"),
+    ("WhatsApp", "whatsapp"), ("Telegram", "telegram"), ("Примечание", "note"),
+    ("Национальность", "nationality"), ("Английское Имя", "eng_name"), ("Количество", "count"),
+    ("Приоритет", "priority"),
+)
+_POST_ROW_MEDIA = tuple(f"Ссылка {i}" for i in range(1, 11))
+_POST_ROW_ATTR = dict(_POST_ROW_FIELDS)
+_POST_ROW_ATTR["отправлено"] = "sent"
+_POST_ROW_MEDIA_POS = {h: i for i, h in enumerate(_POST_ROW_MEDIA)}
+# Короткие повторяющиеся значения интернируются, чтобы тысячи строк делили одни объекты
+_POST_ROW_INTERNED = frozenset({
+    "name", "status", "sent", "age", "height", "weight", "bust",
+    "express", "incall", "outcall", "nationality", "eng_name", "count", "priority",
+})
+
+class PostRow:
+    """Компактная строка листа: только поля, которые читают main() и send_post.
+    Совместима с dict по чтению (get/[]), поэтому send_post работает с ней как с записью."""
+    __slots__ = tuple(attr for _, attr in _POST_ROW_FIELDS) + ("media",)
+
+    def get(self, name, default=""):
+        attr = _POST_ROW_ATTR.get(name)
+        if attr is not None:
+            return getattr(self, attr)
+        pos = _POST_ROW_MEDIA_POS.get(name)
+        if pos is not None:
+            return self.media[pos] if pos < len(self.media) else default
+        return default
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __setitem__(self, name, value):
+        attr = _POST_ROW_ATTR.get(name)
+        if attr is not None:
+            setattr(self, attr, value)
+        elif name in _POST_ROW_MEDIA_POS:
+            media = list(self.media) + [""] * (len(_POST_ROW_MEDIA) - len(self.media))
+            media[_POST_ROW_MEDIA_POS[name]] = value
+            self.media = tuple(media)
+
+    def copy(self):
+        other = PostRow.__new__(PostRow)
+        for attr in PostRow.__slots__:
+            setattr(other, attr, getattr(self, attr))
+        return other
+
+    def to_dict(self) -> dict:
+        d = {h: getattr(self, attr) for h, attr in _POST_ROW_FIELDS}
+        d.update(zip(_POST_ROW_MEDIA, self.media))
+        return d
+
+    def __eq__(self, other):
+        if not isinstance(other, PostRow):
+            return NotImplemented
+        return all(getattr(self, a) == getattr(other, a) for a in PostRow.__slots__)
+
+    def __repr__(self):
+        return f"PostRow({self.name!r}, {self.time!r})"
+
+    @staticmethod
+    def column_plan(header):
+        """Позиции нужных столбцов в строке значений (None — столбца нет)."""
+        cols = {}
+        for i, h in enumerate(header):
+            h = str(h).strip()
+            if h:
+                cols[h] = i
+        if "Отправлено" not in cols and "отправлено" in cols:
+            cols["Отправлено"] = cols["отправлено"]
+        fields = tuple((attr, cols.get(h)) for h, attr in _POST_ROW_FIELDS)
+        media = tuple(cols.get(h) for h in _POST_ROW_MEDIA)
+        while media and media[-1] is None:
+            media = media[:-1]
+        return fields, media
+
+    @classmethod
+    def from_values(cls, plan, values):
+        fields, media = plan
+        n = len(values)
+        row = cls.__new__(cls)
+        for attr, i in fields:
+            v = values[i] if i is not None and i < n else ""
+            if attr in _POST_ROW_INTERNED and type(v) is str:
+                v = sys.intern(v)
+            setattr(row, attr, v)
+        row.media = tuple((values[i] if i is not None and i < n else "") for i in media)
+        return row
+
+def _records_from_values(header, rows, start: int = 2, unsent_only: bool = False) -> List[Tuple[int, PostRow]]:
+    """Сырые строки значений -> [(row_idx, PostRow)], нумерация как в листе.
+    Значения не «нумеризуются»: цены, количество и время остаются строками, как их видит редактор.
+    unsent_only: пропустить строки без имени и с флагом «Отправлено», не создавая для них объектов."""
+    plan = PostRow.column_plan(header)
+    name_col = dict(plan[0])["name"]
+    sent_col = dict(plan[0])["sent"]
+    out = []
+    for row_idx, values in enumerate(rows, start=start):
+        values = values or ()
+        if unsent_only:
+            n = len(values)
+            if name_col is None or name_col >= n or not str(values[name_col]).strip():
+                continue
+            if sent_col is not None and sent_col < n and str(values[sent_col]).strip().upper() == "TRUE":
+                continue
+        out.append((row_idx, PostRow.from_values(plan, values)))
+    return out
+
+# Отображаемые значения: «40,5» остаётся строкой, а не превращается в 405, а «Время» —
+# в том виде, в каком его ждёт strptime (UNFORMATTED_VALUE отдал бы серийный номер даты)
+SHEETS_VALUE_RENDER = gspread.utils.ValueRenderOption.formatted
+
+class HeaderMap:
+    """Версионированная карта «заголовок -> номер столбца».
+    version растёт при каждом изменении набора или порядка столбцов;
+    checked_at — когда заголовок последний раз сверялся с источником."""
+
+    def __init__(self):
+        self.names = []
+        self.cols = {}
+        self.version = 0
+        self.checked_at = 0.0
+
+    def update(self, names) -> bool:
+        names = list(names or [])
+        self.checked_at = time.monotonic()
+        if names == self.names and self.version:
+            return False
+        self.names = names
+        self.cols = {str(n).strip(): i for i, n in enumerate(names, start=1) if str(n).strip()}
+        self.version += 1
+        if self.version > 1:
+            logging.warning(f"Заголовки таблицы изменились (версия {self.version}): {names}")
+        return True
+
+    def col(self, name: str):
+        return self.cols.get(name)
+
+    def age(self) -> float:
+        return time.monotonic() - self.checked_at
+
+class RecordSource:
+    """Источник записей для send_post.
+    Запись — PostRow (читается как dict «заголовок -> значение»), row_idx нумеруется
+    как в листе (1 — заголовки, данные со 2-й строки)."""
+    kind = "base"
+    incremental = False  # changed_since умеет отдавать только изменённые строки
+    positional_rows = True  # row_idx — позиция строки: удаление сдвигает номера ниже
+
+    def __init__(self):
+        self.headers = HeaderMap()
+
+    @property
+    def header(self) -> List[str]:
+        return self.headers.names
+
+    @header.setter
+    def header(self, names):
+        self.headers.update(names)
+
+    def col_index(self, name: str):
+        return self.headers.col(name)
+
+    def read_header(self) -> List[str]:
+        raise NotImplementedError
+
+    async def refresh_header(self) -> int:
+        """Перечитать заголовок из источника; возвращает версию карты столбцов."""
+        await asyncio.to_thread(self.read_header)
+        return self.headers.version
+
+    async def fetch_all(self) -> List[Tuple[int, PostRow]]:
+        raise NotImplementedError
+
+    async def fetch_rows(self, row_nums) -> List[Tuple[int, PostRow]]:
+        wanted = set(row_nums)
+        return [(i, r) for i, r in await self.fetch_all() if i in wanted]
+
+    async def changed_since(self, since: float) -> List[Tuple[int, PostRow]]:
+        """Строки, изменённые после метки since (time.time()). По умолчанию — все."""
+        return await self.fetch_all()
+
+    async def write_cells(self, updates):
+        """Записать значения: updates — список (row_idx, заголовок, значение)."""
+        raise NotImplementedError
+
+    async def write_cell(self, row_idx: int, name: str, value):
+        return await self.write_cells([(row_idx, name, value)])
+
+    async def archive_rows(self, should_archive, archive_name: str, limit: int) -> List[int]:
+        """Перенести строки, для которых should_archive(PostRow) истинно, в архив.
+        Возвращает номера удалённых из активного набора строк."""
+        raise NotImplementedError
+
+class SheetsRecordSource(RecordSource):
+    kind = "sheets"
+
+    def __init__(self, sheets: AsyncSheet):
+        super().__init__()
+        self.sheets = sheets
+
+    def read_header(self) -> List[str]:
+        self.header = self.sheets.ws.row_values(1)
+        return self.header
+
+    async def refresh_header(self) -> int:
+        self.header = await self.sheets.row_values(1)
+        return self.headers.version
+
+    async def fetch_all(self) -> List[Tuple[int, PostRow]]:
+        # Заголовок приходит в том же ответе и обновляет карту столбцов. Держим только
+        # неотправленные строки и только нужные столбцы. Значения — отображаемые строки
+        # (FORMATTED_VALUE): без дедупликации заголовков и numericise из get_all_records
+        values = await self.sheets.get_all_values(value_render_option=SHEETS_VALUE_RENDER)
+        if not values:
+            return []
+        self.header = values[0]
+        return _records_from_values(values[0], values[1:], unsent_only=True)
+
+    async def fetch_rows(self, row_nums) -> List[Tuple[int, PostRow]]:
+        """Адресно перечитать указанные строки одним batch_get."""
+        rows = sorted(r for r in set(row_nums) if r >= 2)
+        if not rows or not self.header:
+            return []
+        last_col = gspread.utils.rowcol_to_a1(1, len(self.header)).rstrip("0123456789")
+        value_ranges = await self.sheets.batch_get(
+            [f"A{r}:{last_col}{r}" for r in rows], value_render_option=SHEETS_VALUE_RENDER
+        )
+        out = []
+        for r, vr in zip(rows, value_ranges):
+            out += _records_from_values(self.header, [vr[0] if vr else []], start=r)
+        return out
+
+    async def write_cells(self, updates):
+        # Запись идёт по номерам столбцов — сверяем их с актуальным заголовком,
+        # чтобы вставленный/переставленный столбец не получил чужое значение
+        if self.headers.age() > HEADER_WRITE_MAX_AGE:
+            await self.refresh_header()
+        cells = []
+        for row_idx, name, value in updates:
+            col = self.col_index(name)
+            if not col:
+                raise KeyError(f"нет столбца '{name}'")
+            cells.append((row_idx, col, value))
+        if len(cells) == 1:
+            return await self.sheets.update_cell(*cells[0])
+        # Как update_cell — USER_ENTERED: "TRUE" становится булевым значением (флажок,
+        # формулы =TRUE/COUNTIF), а не строкой; batch_update gspread по умолчанию пишет RAW
+        return await self.sheets.batch_update(
+            [{"range": gspread.utils.rowcol_to_a1(r, c), "values": [[v]]} for r, c, v in cells],
+            value_input_option=gspread.utils.ValueInputOption.user_entered,
+        )
+
+    async def archive_rows(self, should_archive, archive_name: str, limit: int) -> List[int]:
+        values = await self.sheets.get_all_values()
+        if len(values) < 2:
+            return []
+        self.header = values[0]
+        plan = PostRow.column_plan(values[0])
+        picked = [
+            (r, row) for r, row in enumerate(values[1:], start=2)
+            if should_archive(PostRow.from_values(plan, row))
+        ][:limit]
+        if not picked:
+            return []
+        archive = await self.sheets.archive_worksheet(archive_name, values[0])
+        # Удаление идёт по номерам строк: убеждаемся, что лист не сдвинулся с момента чтения,
+        # и сразу же переносим одним запросом — окно между проверкой и записью минимально
+        current = await self.sheets.get_all_values()
+        if current[:1] != values[:1] or any(
+            r > len(current) or current[r - 1] != row for r, row in picked
+        ):
+            logging.warning("Архивация отложена: лист изменился во время подготовки.")
+            return []
+        await self.sheets.move_rows(archive, picked)
+        return [r for r, _ in picked]
+
+class LocalFileRecordSource(RecordSource):
+    """CSV или XLSX (первый лист) на диске. Изменения определяются сравнением
+    со снимком предыдущего чтения; запись флагов — атомарной перезаписью файла."""
+    kind = "file"
+    incremental = True
 
-# Кэш заголовков -> индексов столбцов
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.is_xlsx = path.lower().endswith((".xlsx", ".xlsm"))
+        self._rows = []
+        self._mtime = None
+        self._snapshot = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cell_str(v):
+        if v is None:
+            return ""
+        if isinstance(v, datetime):
+            return v.strftime("%d.%m.%Y %H:%M:%S")
+        if isinstance(v, float) and v.is_integer():
+            return str(int(v))
+        return str(v)
+
+    def _load(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self._mtime:
+            return
+        if self.is_xlsx:
+            from openpyxl import load_workbook  # optional: only needed for XLSX sources
+            wb = load_workbook(self.path, read_only=True, data_only=True)
+            try:
+                rows = [[self._cell_str(v) for v in r] for r in wb.active.iter_rows(values_only=True)]
+            finally:
+                wb.close()
+        else:
+            with open(self.path, newline="", encoding="utf-8-sig") as f:
+                rows = [list(r) for r in csv.reader(f)]
+        self.header = rows[0] if rows else []
+        self._rows = rows[1:]
+        self._mtime = mtime
+
+    def read_header(self) -> List[str]:
+        with self._lock:
+            self._load()
+            return self.header
+
+    def _all(self):
+        with self._lock:
+            self._load()
+            return _records_from_values(self.header, self._rows)
+
+    async def fetch_all(self) -> List[Tuple[int, PostRow]]:
+        records = await asyncio.to_thread(self._all)
+        self._snapshot = {i: r for i, r in records}
+        return records
+
+    def values(self) -> List[Tuple[int, list]]:
+        """Строки файла как есть, с номерами (для загрузки в другой источник)."""
+        with self._lock:
+            self._load()
+            return list(enumerate(self._rows, start=2))
+
+    async def changed_since(self, since: float) -> List[Tuple[int, PostRow]]:
+        records = await asyncio.to_thread(self._all)
+        changed = [(i, r) for i, r in records if self._snapshot.get(i) != r]
+        self._snapshot = {i: r for i, r in records}
+        return changed
+
+    def _write(self, updates):
+        with self._lock:
+            self._load()
+            applied = []
+            for row_idx, name, value in updates:
+                col = self.col_index(name)
+                if not col:
+                    raise KeyError(f"нет столбца '{name}'")
+                if not 2 <= row_idx < len(self._rows) + 2:
+                    # Строку удалили из файла — запись отбрасываем, иначе она возвращалась бы в очередь вечно
+                    logging.warning(f"{self.path}: строки {row_idx} нет в файле, запись '{name}' пропущена.")
+                    continue
+                row = self._rows[row_idx - 2]
+                row += [""] * (col - len(row))
+                row[col - 1] = self._cell_str(value)
+                applied.append((row_idx, col, value))
+            if not applied:
+                return
+            if self.is_xlsx:
+                from openpyxl import load_workbook
+                wb = load_workbook(self.path)
+                for row_idx, col, value in applied:
+                    wb.active.cell(row=row_idx, column=col, value=self._cell_str(value))
+                base, ext = os.path.splitext(self.path)
+                tmp = f"{base}.tmp{ext}"
+                wb.save(tmp)
+                os.replace(tmp, self.path)
+            else:
+                tmp = f"{self.path}.tmp"
+                with open(tmp, "w", newline="", encoding="utf-8") as f:
+                    csv.writer(f).writerows([self.header] + self._rows)
+                os.replace(tmp, self.path)
+            self._mtime = os.path.getmtime(self.path)
+
+    async def write_cells(self, updates):
+        await asyncio.to_thread(self._write, list(updates))
+        # собственные записи не считаются «изменениями» для changed_since
+        for row_idx, name, value in updates:
+            if row_idx in self._snapshot:
+                row = self._snapshot[row_idx].copy()
+                row[name] = self._cell_str(value)
+                self._snapshot[row_idx] = row
+
+class SqliteRecordSource(RecordSource):
+    """Таблица SQLite: столбцы = заголовки листа, плюс служебные row_idx и updated_at.
+    updated_at ставится триггерами и при внешних правках, поэтому changed_since —
+    это индексированный запрос, а не полный проход."""
+    kind = "sqlite"
+    incremental = True
+    positional_rows = False
+    _SERVICE_COLS = ("row_idx", "updated_at")
+
+    def __init__(self, path: str, table: str = "posts"):
+        super().__init__()
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._ensure_schema()
+
+    @staticmethod
+    def _q(name: str) -> str:
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def _ensure_schema(self):
+        t = self._q(self.table)
+        now_expr = "((julianday('now') - 2440587.5) * 86400.0)"
+        with self._lock:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {t} (row_idx INTEGER PRIMARY KEY, updated_at REAL)")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self._q(self.table + '_updated_at')} ON {t}(updated_at)")
+            self._conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {self._q(self.table + '_touch_ins')} AFTER INSERT ON {t} "
+                f"WHEN NEW.updated_at IS NULL BEGIN "
+                f"UPDATE {t} SET updated_at = {now_expr} WHERE row_idx = NEW.row_idx; END"
+            )
+            self._conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {self._q(self.table + '_touch_upd')} AFTER UPDATE ON {t} "
+                f"WHEN NEW.updated_at IS OLD.updated_at BEGIN "
+                f"UPDATE {t} SET updated_at = {now_expr} WHERE row_idx = NEW.row_idx; END"
+            )
+
+    def _columns(self) -> List[str]:
+        cur = self._conn.execute(f"PRAGMA table_info({self._q(self.table)})")
+        return [r[1] for r in cur.fetchall() if r[1] not in self._SERVICE_COLS]
+
+    def _ensure_columns(self, names):
+        existing = set(self._columns())
+        for n in names:
+            if n and n not in existing:
+                self._conn.execute(f"ALTER TABLE {self._q(self.table)} ADD COLUMN {self._q(n)} TEXT DEFAULT ''")
+                existing.add(n)
+        self.header = self._columns()
+
+    def read_header(self) -> List[str]:
+        with self._lock:
+            self.header = self._columns()
+            return self.header
+
+    def _select(self, where: str = "", params=()):
+        with self._lock:
+            self.header = self._columns()
+            cols = ", ".join(self._q(c) for c in self.header)
+            sql = f"SELECT row_idx{', ' + cols if cols else ''} FROM {self._q(self.table)} {where} ORDER BY row_idx"
+            rows = self._conn.execute(sql, params).fetchall()
+        plan = PostRow.column_plan(self.header)
+        return [(r[0], PostRow.from_values(plan, ["" if v is None else str(v) for v in r[1:]])) for r in rows]
+
+    async def fetch_all(self) -> List[Tuple[int, PostRow]]:
+        return await asyncio.to_thread(self._select)
+
+    async def fetch_rows(self, row_nums) -> List[Tuple[int, PostRow]]:
+        rows = sorted(set(int(r) for r in row_nums))
+        if not rows:
+            return []
+        marks = ",".join("?" for _ in rows)
+        return await asyncio.to_thread(self._select, f"WHERE row_idx IN ({marks})", tuple(rows))
+
+    async def changed_since(self, since: float) -> List[Tuple[int, PostRow]]:
+        return await asyncio.to_thread(self._select, "WHERE updated_at > ?", (float(since),))
+
+    def _write(self, updates):
+        t = self._q(self.table)
+        with self._lock:
+            self._ensure_columns({name for _, name, _ in updates})
+            self._conn.execute("BEGIN")
+            try:
+                for row_idx, name, value in updates:
+                    self._conn.execute(
+                        f"UPDATE {t} SET {self._q(name)} = ?, updated_at = ? WHERE row_idx = ?",
+                        ("" if value is None else str(value), time.time(), int(row_idx)),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def write_cells(self, updates):
+        await asyncio.to_thread(self._write, list(updates))
+
+    def _archive(self, row_nums, archive_name: str):
+        t = self._q(self.table)
+        a = self._q(archive_name)
+        marks = ",".join("?" for _ in row_nums)
+        with self._lock:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {a} AS SELECT * FROM {t} WHERE 0")
+            archived_cols = {r[1] for r in self._conn.execute(f"PRAGMA table_info({a})")}
+            for c in ["row_idx", "updated_at"] + self._columns():
+                if c not in archived_cols:
+                    self._conn.execute(f"ALTER TABLE {a} ADD COLUMN {self._q(c)} TEXT DEFAULT ''")
+            cols = ", ".join(self._q(c) for c in ["row_idx", "updated_at"] + self._columns())
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(f"INSERT INTO {a} ({cols}) SELECT {cols} FROM {t} WHERE row_idx IN ({marks})", tuple(row_nums))
+                self._conn.execute(f"DELETE FROM {t} WHERE row_idx IN ({marks})", tuple(row_nums))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def archive_rows(self, should_archive, archive_name: str, limit: int) -> List[int]:
+        picked = [r for r, row in await self.fetch_all() if should_archive(row)][:limit]
+        if picked:
+            await asyncio.to_thread(self._archive, picked, f"{self.table}_{archive_name}")
+        return picked
+
+    def upsert_rows(self, header, rows) -> Tuple[int, int]:
+        """Загрузить строки (например, выгрузку листа): rows — [(row_idx, [значения])].
+        Неизменённые строки не трогаются, чтобы не сбивать updated_at.
+        Возвращает (добавлено, изменено)."""
+        t = self._q(self.table)
+        inserted = updated = 0
+        with self._lock:
+            self._ensure_columns([h for h in header if h])
+            names = [h for h in header if h]
+            cols = ", ".join(self._q(h) for h in names)
+            marks = ", ".join("?" for _ in names)
+            self._conn.execute("BEGIN")
+            try:
+                for row_idx, values in rows:
+                    vals = list(values or []) + [""] * len(header)
+                    new = tuple(str(vals[i] if vals[i] is not None else "") for i, h in enumerate(header) if h)
+                    old = self._conn.execute(f"SELECT {cols} FROM {t} WHERE row_idx = ?", (int(row_idx),)).fetchone()
+                    if old is None:
+                        self._conn.execute(f"INSERT INTO {t} (row_idx, {cols}) VALUES (?, {marks})", (int(row_idx),) + new)
+                        inserted += 1
+                    elif tuple("" if v is None else str(v) for v in old) != new:
+                        assignments = ", ".join(f"{self._q(h)} = ?" for h in names)
+                        self._conn.execute(f"UPDATE {t} SET {assignments} WHERE row_idx = ?", new + (int(row_idx),))
+                        updated += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return inserted, updated
+
+def _make_record_source():
+    if RECORD_SOURCE == "sheets":
+        return SheetsRecordSource(SHEETS) if SHEETS else None
+    if not RECORD_SOURCE_PATH:
+        print(f"ОШИБКА: для RECORD_SOURCE={RECORD_SOURCE} укажите RECORD_SOURCE_PATH.")
+        exit(1)
+    if RECORD_SOURCE in ("csv", "xlsx", "file"):
+        return LocalFileRecordSource(RECORD_SOURCE_PATH)
+    if RECORD_SOURCE == "sqlite":
+        return SqliteRecordSource(RECORD_SOURCE_PATH, RECORD_SOURCE_TABLE)
+    print(f"ОШИБКА: неизвестный RECORD_SOURCE='{RECORD_SOURCE}' (ожидается sheets|csv|xlsx|sqlite).")
+    exit(1)
+
+SOURCE = _make_record_source()
+
+# Карта заголовков -> индексов столбцов (обновляется при каждом полном опросе)
+HEADER_MAP = SOURCE.headers if SOURCE else HeaderMap()
 try:
-    header_row = worksheet.row_values(1)
-    HEADER_TO_COL = {name.strip(): idx for idx, name in enumerate(header_row, start=1)}
+    if SOURCE:
+        SOURCE.read_header()
 except Exception as e:
     print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось прочитать заголовки листа: {e}")
-    HEADER_TO_COL = {}
 
 
 def get_col_index(name: str, warn: bool = True):
-    idx = HEADER_TO_COL.get(name)
+    idx = HEADER_MAP.col(name)
     if not idx and warn:
         print(f"ПРЕДУПРЕЖДЕНИЕ: не найден столбец '{name}' в заголовке таблицы.")
     return idx
@@ -311,27 +1321,40 @@ def get_col_index(name: str, warn: bool = True):
 # Часовой пояс для расписания (Армения)
 tz = pytz.timezone("Asia/Yerevan")
 
+# Клиенты с одной и той же сессией (и прокси) переиспользуются — в том числе между
+# арендаторами: одна сессия держит одно MTProto-соединение на процесс
+_CLIENT_POOL = SHARED.setdefault("telethon_clients", {})
+
+def _telegram_client(session: str, proxy):
+    key = (TG_API_ID, session, proxy)
+    client = _CLIENT_POOL.get(key)
+    if client is None:
+        client = TelegramClient(
+            StringSession(session),
+            TG_API_ID,
+            TG_API_HASH,
+            proxy=proxy,
+            connection=tl_connection.ConnectionTcpAbridged,  # избегаем tcpfull
+            request_retries=TELETHON_REQUEST_RETRIES,
+            connection_retries=TELETHON_CONNECTION_RETRIES,
+            retry_delay=TELETHON_RETRY_DELAY,
+            timeout=TELETHON_TIMEOUT,
+            flood_sleep_threshold=TELETHON_FLOOD_SLEEP_THRESHOLD,
+        )
+        _CLIENT_POOL[key] = client
+    return client
+
 # Настройка клиентов Telegram:
 # - service_client (только для служебных операций — определение next_post_link и т.п.)
 # - CLIENT_BY_INDEX: отдельный клиент для каждого TG{n}_SESSION → TG{n}_CHANNEL
-service_client = TelegramClient(
-    StringSession(TG_SESSION),
-    TG_API_ID,
-    TG_API_HASH,
-    proxy=GLOBAL_PROXY,
-    connection=tl_connection.ConnectionTcpAbridged,  # избегаем tcpfull
-    request_retries=TELETHON_REQUEST_RETRIES,
-    connection_retries=TELETHON_CONNECTION_RETRIES,
-    retry_delay=TELETHON_RETRY_DELAY,
-    timeout=TELETHON_TIMEOUT,
-    flood_sleep_threshold=TELETHON_FLOOD_SLEEP_THRESHOLD,
-)
+# В офлайн-режиме клиенты не создаются вовсе.
+service_client = None if OFFLINE_MODE else _telegram_client(TG_SESSION, GLOBAL_PROXY)
 
 # Удобные словари доступа по индексу (все индексы имеют свой клиент)
 ACC_BY_INDEX = {acc["index"]: acc for acc in accounts}
 CLIENT_BY_INDEX = {}
-for i in sorted(ACC_BY_INDEX.keys()):
-    sess = os.environ.get(f"TG{i}_SESSION")
+for i in ([] if OFFLINE_MODE else sorted(ACC_BY_INDEX.keys())):
+    sess = ENV.get(f"TG{i}_SESSION")
     if not sess:
         print(f"ОШИБКА: Для TG{i}_CHANNEL требуется TG{i}_SESSION (StringSession).")
         exit(1)
@@ -339,24 +1362,139 @@ for i in sorted(ACC_BY_INDEX.keys()):
     if REQUIRE_PROXY and not proxy_tuple:
         print(f"ОШИБКА: Для TG{i} не настроен прокси. Задайте TG_PROXY_* или TG{i}_PROXY_*.") 
         exit(1)
-    CLIENT_BY_INDEX[i] = TelegramClient(
-        StringSession(sess),
-        TG_API_ID,
-        TG_API_HASH,
-        proxy=proxy_tuple,
-        connection=tl_connection.ConnectionTcpAbridged,  # избегаем tcpfull
-        request_retries=TELETHON_REQUEST_RETRIES,
-        connection_retries=TELETHON_CONNECTION_RETRIES,
-        retry_delay=TELETHON_RETRY_DELAY,
-        timeout=TELETHON_TIMEOUT,
-        flood_sleep_threshold=TELETHON_FLOOD_SLEEP_THRESHOLD,
-    )
+    CLIENT_BY_INDEX[i] = _telegram_client(sess, proxy_tuple)
+
+# Список всех клиентов (сервисный + по индексам), без повторов общих сессий
+ALL_CLIENTS = list({id(c): c for c in [service_client, *CLIENT_BY_INDEX.values()] if c}.values())
+
+# --- Журнал отправок: (строка, канал) -> исход; переживает рестарт процесса ---
+# Путь должен указывать на постоянный диск, иначе журнал пропадёт вместе с файловой системой.
+SEND_JOURNAL_PATH = ENV.get(
+    "SEND_JOURNAL_PATH", f"send_journal.{TENANT}.sqlite3" if TENANT else "send_journal.sqlite3"
+)
+SEND_JOURNAL_RETENTION_DAYS = int(ENV.get("SEND_JOURNAL_RETENTION_DAYS", "30"))
+SEND_JOURNAL_COMPACT_HOURS = float(ENV.get("SEND_JOURNAL_COMPACT_HOURS", "6"))
+
+class SendJournal:
+    """Append-only журнал исходов отправки по парам (row_idx, acc_idx) в SQLite (WAL).
+    Последнее событие по каждой паре держится в памяти, поэтому проверки на дубли —
+    локальные словарные lookup-и без обращения к Telegram. Статусы:
+    pending — отправка начата (если процесс упал посреди неё, исход неизвестен),
+    sent — успешно, failed — точно не отправлено, unknown — ошибка с неизвестным исходом.
+    Для sent хранятся ID всех сообщений (альбом — несколько), постоянная ссылка и задержка
+    публикации относительно «Время» — для последующих правок/удалений и отчётов."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS send_journal ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " row_idx INTEGER NOT NULL, acc_idx INTEGER NOT NULL, fingerprint TEXT,"
+            " status TEXT NOT NULL, message_id INTEGER, detail TEXT, ts REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS send_journal_key ON send_journal(row_idx, acc_idx, id)")
+        # Столбцы, добавленные позже: журналы прежних версий дополняются на месте
+        have = {r[1] for r in self._conn.execute("PRAGMA table_info(send_journal)")}
+        for col, decl in (("message_ids", "TEXT"), ("link", "TEXT"), ("latency", "REAL")):
+            if col not in have:
+                self._conn.execute(f"ALTER TABLE send_journal ADD COLUMN {col} {decl}")
+        self.latest = {}
+        for row in self._conn.execute(
+            "SELECT row_idx, acc_idx, fingerprint, status, message_id, detail, ts, message_ids, link, latency"
+            " FROM send_journal WHERE id IN (SELECT MAX(id) FROM send_journal GROUP BY row_idx, acc_idx)"
+        ):
+            self.latest[(row[0], row[1])] = {
+                "fingerprint": row[2], "status": row[3], "message_id": row[4], "detail": row[5], "ts": row[6],
+                "message_ids": [int(x) for x in row[7].split(",")] if row[7] else ([row[4]] if row[4] else []),
+                "link": row[8], "latency": row[9],
+            }
+        # Пустой журнал (первый запуск/новый диск) не гарантирует, что ничего не отправлялось
+        self.fresh = not self.latest
+        self.compacted_at = time.monotonic()
+
+    def record(self, row_idx: int, acc_idx: int, fingerprint: str, status: str, message_id=None, detail=None,
+               message_ids=None, link=None, latency=None):
+        message_ids = list(message_ids or ([message_id] if message_id is not None else []))
+        entry = {"fingerprint": fingerprint, "status": status, "message_id": message_id,
+                 "detail": None if detail is None else str(detail)[:500], "ts": time.time(),
+                 "message_ids": message_ids, "link": link, "latency": latency}
+        self._conn.execute(
+            "INSERT INTO send_journal (row_idx, acc_idx, fingerprint, status, message_id, detail, ts,"
+            " message_ids, link, latency) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (int(row_idx), int(acc_idx), fingerprint, status, message_id, entry["detail"], entry["ts"],
+             ",".join(str(i) for i in message_ids) or None, link, latency),
+        )
+        self.latest[(int(row_idx), int(acc_idx))] = entry
+
+    def get(self, row_idx: int, acc_idx: int):
+        return self.latest.get((int(row_idx), int(acc_idx)))
+
+    def pending_channels(self, row_idx: int, fingerprint: str, channels) -> List[int]:
+        """Каналы, куда строка с этим содержимым ещё не доставлена. Журнал помнит позицию
+        строки, поэтому запись «sent» другой версии доставкой не считается: её проверяет
+        send_post по истории канала (строку могли заменить другим постом)."""
+        pending = []
+        for acc_idx in channels:
+            entry = self.latest.get((int(row_idx), int(acc_idx)))
+            if not (entry and entry["status"] == "sent" and entry["fingerprint"] == fingerprint):
+                pending.append(acc_idx)
+        return pending
 
-# Список всех клиентов (сервисный + по индексам)
-ALL_CLIENTS = [service_client] + list(CLIENT_BY_INDEX.values())
+    def remap_rows(self, deleted_rows):
+        """Строки удалены из листа: их события убираются, номера строк ниже сдвигаются вверх."""
+        deleted = sorted(set(int(r) for r in deleted_rows))
+        if not deleted:
+            return
+        marks = ",".join("?" for _ in deleted)
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.execute(f"DELETE FROM send_journal WHERE row_idx IN ({marks})", tuple(deleted))
+            rows = [r for (r,) in self._conn.execute(
+                "SELECT DISTINCT row_idx FROM send_journal WHERE row_idx > ? ORDER BY row_idx", (deleted[0],)
+            )]
+            for r in rows:
+                self._conn.execute(
+                    "UPDATE send_journal SET row_idx = ? WHERE row_idx = ?",
+                    (r - bisect.bisect_left(deleted, r), r),
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        deleted_set = set(deleted)
+        self.latest = {
+            (r - bisect.bisect_left(deleted, r), acc): v
+            for (r, acc), v in self.latest.items()
+            if r not in deleted_set
+        }
+
+    def compact(self):
+        """Удалить вытесненные события и старые записи, затем урезать WAL."""
+        cutoff = time.time() - SEND_JOURNAL_RETENTION_DAYS * 86400
+        self._conn.execute(
+            "DELETE FROM send_journal WHERE id NOT IN"
+            " (SELECT MAX(id) FROM send_journal GROUP BY row_idx, acc_idx) OR ts < ?",
+            (cutoff,),
+        )
+        self.latest = {k: v for k, v in self.latest.items() if v["ts"] >= cutoff}
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.compacted_at = time.monotonic()
+
+    def maybe_compact(self):
+        if time.monotonic() - self.compacted_at >= SEND_JOURNAL_COMPACT_HOURS * 3600:
+            try:
+                self.compact()
+            except Exception as e:
+                logging.warning(f"Не удалось сжать журнал отправок: {e}")
 
-# Runtime de-duplication guard: prevent repeating sends if Google Sheets flag update lags
-SENT_RUNTIME = set()  # stores tuples of (row_idx, acc_idx)
+try:
+    SEND_JOURNAL = SendJournal(":memory:" if OFFLINE_MODE else SEND_JOURNAL_PATH)
+except Exception as e:
+    print(f"ОШИБКА: не удалось открыть журнал отправок {SEND_JOURNAL_PATH}: {e}")
+    exit(1)
 
 # --- 3. ПОЛЬЗОВАТЕЛЬСКИЕ EMOJI И ПАРСЕР + ТИПОГРАФИКА ---
 
@@ -415,29 +1553,33 @@ FOTO_EMOJI_IDS = [
     5373338978780979795,
     5372991528811635071,
 ]
+# document_id, которых Telegram не вернул при проверке на старте (validate_custom_emoji):
+# вместо них в пост идёт символ-заглушка
+INVALID_EMOJI_IDS = set()
 
 # Типографика короны
-CROWN_OFFSET_ADJUST = int(os.environ.get("CROWN_OFFSET_ADJUST", "0"))
-CROWN_OFFSET_SCALE = float(os.environ.get("CROWN_OFFSET_SCALE", "1.25"))
+CROWN_OFFSET_ADJUST = int(ENV.get("CROWN_OFFSET_ADJUST", "0"))
+CROWN_OFFSET_SCALE = float(ENV.get("CROWN_OFFSET_SCALE", "1.25"))
 CROWN_THIN = "\u2009"  # тонкий пробел БЕЗ word-joiner — только для отступа короны
 NNBSP = "\u202F"       # узкий неразрывный пробел
 WORD_JOINER = "\u2060" # WORD JOINER
 THIN  = "\u2009" + WORD_JOINER
-CROWN_OFFSET_ADJUST = int(os.environ.get("CROWN_OFFSET_ADJUST", "0"))
-CROWN_OFFSET_SCALE = float(os.environ.get("CROWN_OFFSET_SCALE", "1.25"))
+CROWN_OFFSET_ADJUST = int(ENV.get("CROWN_OFFSET_ADJUST", "0"))
+CROWN_OFFSET_SCALE = float(ENV.get("CROWN_OFFSET_SCALE", "1.25"))
 
 # Pixel-based width helpers
-CROWN_FONT_PATH = os.environ.get("CROWN_FONT_PATH", "")
-CROWN_FONT_SIZE = int(os.environ.get("CROWN_FONT_SIZE", "18"))
-CROWN_EM_WIDTH_SCALE = float(os.environ.get("CROWN_EM_WIDTH_SCALE", "1.0"))
-CROWN_OFFSET_PX_ADJUST = int(os.environ.get("CROWN_OFFSET_PX_ADJUST", "0"))
-CROWN_PRESET = os.environ.get("CROWN_PRESET", "").lower()  # e.g. "ios"
-CROWN_FINE_TUNE = os.environ.get("CROWN_FINE_TUNE", "thin").lower()  # "thin" | "none"
+CROWN_FONT_PATH = ENV.get("CROWN_FONT_PATH", "")
+CROWN_FONT_SIZE = int(ENV.get("CROWN_FONT_SIZE", "18"))
+CROWN_EM_WIDTH_SCALE = float(ENV.get("CROWN_EM_WIDTH_SCALE", "1.0"))
+CROWN_OFFSET_PX_ADJUST = int(ENV.get("CROWN_OFFSET_PX_ADJUST", "0"))
+CROWN_PRESET = ENV.get("CROWN_PRESET", "").lower()  # e.g. "ios"
+CROWN_FINE_TUNE = ENV.get("CROWN_FINE_TUNE", "thin").lower()  # "thin" | "none"
+CROWN_CACHE_SIZE = int(ENV.get("CROWN_CACHE_SIZE", "2048"))  # имён в кэше отступов короны
 
 if CROWN_PRESET == "ios":
-    if "CROWN_EM_WIDTH_SCALE" not in os.environ:
+    if "CROWN_EM_WIDTH_SCALE" not in ENV:
         CROWN_EM_WIDTH_SCALE = 0.96
-    if "CROWN_OFFSET_PX_ADJUST" not in os.environ:
+    if "CROWN_OFFSET_PX_ADJUST" not in ENV:
         CROWN_OFFSET_PX_ADJUST = 1
 _CROWN_FONT_SOURCE = None
 
@@ -459,17 +1601,22 @@ def _load_crown_font():
         "./fonts/DejaVuSans.ttf",
         "fonts/DejaVuSans.ttf",
     ]
-    for d in [os.path.join(script_dir, "fonts"), "./fonts", "fonts"]:
-        try:
-            if os.path.isdir(d):
-                for fname in os.listdir(d):
-                    if fname.lower().endswith(".ttf"):
-                        p = os.path.join(d, fname)
-                        if p not in paths_to_try:
-                            paths_to_try.append(p)
-        except Exception:
-            pass
-    for p in paths_to_try:
+
+    def _font_dir_candidates():
+        # Каталоги шрифтов сканируем, только если ни один известный путь не подошёл
+        for d in [os.path.join(script_dir, "fonts"), "./fonts", "fonts"]:
+            try:
+                if os.path.isdir(d):
+                    for fname in sorted(os.listdir(d)):
+                        if fname.lower().endswith(".ttf"):
+                            p = os.path.join(d, fname)
+                            if p not in paths_to_try:
+                                paths_to_try.append(p)
+                                yield p
+            except Exception:
+                pass
+
+    for p in itertools.chain(list(paths_to_try), _font_dir_candidates()):
         try:
             if p and os.path.exists(p):
                 if CROWN_FONT_PATH and os.path.abspath(p) == os.path.abspath(CROWN_FONT_PATH):
@@ -489,7 +1636,11 @@ def _load_crown_font():
         pass
     return None
 
-_CROWN_FONT = _load_crown_font()
+# Шрифт загружается один раз на процесс (арендаторы с теми же настройками берут готовый)
+_font_key = ("crown_font", CROWN_FONT_PATH, CROWN_FONT_SIZE)
+if _font_key not in SHARED:
+    SHARED[_font_key] = (_load_crown_font(), _CROWN_FONT_SOURCE)
+_CROWN_FONT, _CROWN_FONT_SOURCE = SHARED[_font_key]
 
 if _PIL_AVAILABLE and _CROWN_FONT:
     if hasattr(_CROWN_FONT, "getlength"):
@@ -503,12 +1654,98 @@ else:
 
 print(f"[CROWN] Preset={CROWN_PRESET or 'default'}, fine_tune={CROWN_FINE_TUNE}")
 
+# Диапазоны таблицы ширин: латиница, кириллица, пунктуация/символы/дингбаты, эмодзи
+# (эмодзи в DejaVu нет — в таблицу попадает ширина заглушки, которую и вернул бы Pillow)
+_GLYPH_RANGES = ((0x20, 0x250), (0x400, 0x530), (0x2000, 0x2800), (0x1F000, 0x1FB00))
+CROWN_GLYPH_CACHE = ENV.get("CROWN_GLYPH_CACHE", "1") == "1"  # хранить таблицу на диске рядом со шрифтом
+
+class _GlyphAdvances:
+    """Ширины глифов шрифта короны по диапазонам кодовых точек (NumPy).
+    Ширина строки — векторный поиск и сумма; символы вне таблицы меряет Pillow (с запоминанием).
+    Кернинг не учитывается: на целых пикселях расхождение с getlength практически не видно."""
+    __slots__ = ("starts", "ends", "bases", "adv", "extra")
+
+    def __init__(self, adv):
+        self.starts = np.array([a for a, _ in _GLYPH_RANGES], dtype=np.int64)
+        self.ends = np.array([b for _, b in _GLYPH_RANGES], dtype=np.int64)
+        self.bases = np.concatenate(([0], np.cumsum(self.ends - self.starts)[:-1]))
+        self.adv = adv
+        self.extra = {}
+
+    @classmethod
+    def for_font(cls, font):
+        """Таблица из кэша рядом со шрифтом или построенная заново (и сохранённая)."""
+        path = getattr(font, "path", None)
+        cache_path = f"{path}.advances-{CROWN_FONT_SIZE}.npz" if isinstance(path, str) else None
+        stamp = None
+        if cache_path:
+            st = os.stat(path)
+            stamp = np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+        if cache_path and CROWN_GLYPH_CACHE and os.path.exists(cache_path):
+            try:
+                with np.load(cache_path) as data:
+                    if (np.array_equal(data["stamp"], stamp)
+                            and np.array_equal(data["ranges"], np.array(_GLYPH_RANGES, dtype=np.int64))):
+                        return cls(data["adv"]), "кэш"
+            except Exception as e:
+                print(f"[CROWN] Кэш ширин глифов повреждён ({e}) — строим заново")
+        adv = np.array(
+            [font.getlength(chr(cp)) for a, b in _GLYPH_RANGES for cp in range(a, b)],
+            dtype=np.float32,
+        )
+        if cache_path and CROWN_GLYPH_CACHE:
+            tmp = f"{cache_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    np.savez(f, adv=adv, stamp=stamp, ranges=np.array(_GLYPH_RANGES, dtype=np.int64))
+                os.replace(tmp, cache_path)
+            except OSError as e:
+                print(f"[CROWN] Не удалось сохранить кэш ширин глифов рядом со шрифтом: {e}")
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+        return cls(adv), "построена"
+
+    def width(self, s: str) -> float:
+        if not s:
+            return 0.0
+        cps = np.frombuffer(s.encode("utf-32-le", "surrogatepass"), dtype=np.uint32).astype(np.int64)
+        i = np.searchsorted(self.ends, cps, side="right")
+        inside = i < len(self.ends)
+        inside[inside] &= cps[inside] >= self.starts[i[inside]]
+        total = float(self.adv[self.bases[i[inside]] + cps[inside] - self.starts[i[inside]]].sum(dtype=np.float64))
+        if not inside.all():
+            for cp in cps[~inside].tolist():
+                w = self.extra.get(cp)
+                if w is None:
+                    w = self.extra[cp] = _CROWN_FONT.getlength(chr(cp))
+                total += w
+        return total
+
+# Таблица строится один раз на шрифт и процесс; без NumPy или getlength — прежнее измерение Pillow
+_GLYPH_TABLE = None
+if _NP_AVAILABLE and hasattr(_CROWN_FONT, "getlength"):
+    _glyph_key = ("glyph_advances",) + _font_key[1:]
+    if _glyph_key not in SHARED:
+        try:
+            _t0 = time.perf_counter()
+            _table, _how = _GlyphAdvances.for_font(_CROWN_FONT)
+            print(f"[CROWN] Таблица ширин глифов: {_table.adv.size} кодовых точек ({_how}, {(time.perf_counter() - _t0) * 1000:.0f} мс)")
+            SHARED[_glyph_key] = _table
+        except Exception as e:
+            print(f"[CROWN] Таблица ширин глифов недоступна ({e}) — измеряем через Pillow")
+            SHARED[_glyph_key] = None
+    _GLYPH_TABLE = SHARED[_glyph_key]
+
 _tag_re = re.compile(r"<[^>]+>")
 def _strip_tags(s: str) -> str:
     return _tag_re.sub("", str(s or "")).strip()
 
 def _text_width_px(s: str) -> int:
     plain = str(s or "")
+    if _GLYPH_TABLE is not None:
+        return int(round(_GLYPH_TABLE.width(plain)))
     if _PIL_AVAILABLE and _CROWN_FONT:
         try:
             if hasattr(_CROWN_FONT, "getlength"):
@@ -530,6 +1767,13 @@ def _space_width_px(ch: str = NNBSP) -> int:
             pass
     return 7
 
+# Ширины постоянных глифов не меняются после загрузки шрифта — меряем один раз
+_EM_PX = _space_width_px("M")
+_NNBSP_PX = _space_width_px(NNBSP)
+_CROWN_THIN_PX = _space_width_px(CROWN_THIN)
+# Всё, от чего зависит отступ кроме имени: ключ кэша, общего для арендаторов с разными пресетами
+_CROWN_PARAMS = (_font_key, CROWN_EM_WIDTH_SCALE, CROWN_OFFSET_PX_ADJUST, CROWN_OFFSET_ADJUST, CROWN_FINE_TUNE)
+
 def _plain_len(s: str) -> int:
     txt = re.sub(r"<[^>]+>", "", str(s or "")).strip()
     return len(txt)
@@ -551,17 +1795,31 @@ def _normalize_multiline_text(s: str) -> str:
     return t
 
 # --- Helpers: TG/WA contact normalization + next-post link -----------------
+_TG_LINK_PREFIX_RE = re.compile(r"^(?:https?://)?t\.me/", re.IGNORECASE)
+_LEADING_AT_RE = re.compile(r"^@+")
+_TG_USERNAME_RE = re.compile(r"[A-Za-z][A-Za-z0-9_]{3,31}")
+_WA_ME_RE = re.compile(r"(?:https?://)?wa\.me/\+?([0-9]{7,17})\b", re.IGNORECASE)
+_WA_PHONE_PARAM_RE = re.compile(r"(?:[?&]|^)phone=([0-9\-\s()]+)", re.IGNORECASE)
+_WA_FREE_TEXT_RE = re.compile(r"(?<!\d)(\+?[1-9][0-9\-()\s]{6,20})(?!\d)")
+_NON_DIGIT_RE = re.compile(r"\D")
+
 def _tg_username_from_contact(val: str):
+    return CONTACTS.tg_username(val)
+
+def _wa_number_from_contact(val: str):
+    return CONTACTS.wa_number(val)
+
+def _parse_tg_username(val: str):
     s = str(val or "").strip()
     if not s:
         return None
     # Strip t.me/ and leading @, drop query params and trailing slashes
-    s = re.sub(r"^(?:https?://)?t\.me/", "", s, flags=re.IGNORECASE)
-    s = re.sub(r"^@+", "", s)
+    s = _TG_LINK_PREFIX_RE.sub("", s)
+    s = _LEADING_AT_RE.sub("", s)
     s = s.split("?")[0].strip().strip("/")
     return s or None
 
-def _wa_number_from_contact(val: str):
+def _parse_wa_number(val: str):
     """Extract a WhatsApp phone number suitable for wa.me links.
     Rules:
     - Prefer explicit wa.me/<digits> path.
@@ -575,34 +1833,36 @@ def _wa_number_from_contact(val: str):
         return None
 
     # 1) wa.me/<digits>
-    m = re.search(r"(?:https?://)?wa\.me/\+?([0-9]{7,17})\b", s, flags=re.IGNORECASE)
+    m = _WA_ME_RE.search(s)
     if m:
         return m.group(1)
 
     # 2) ...?phone=<digits>
-    m = re.search(r"(?:[?&]|^)phone=([0-9\-\s()]+)", s, flags=re.IGNORECASE)
+    m = _WA_PHONE_PARAM_RE.search(s)
     if m:
-        digits = re.sub(r"\D", "", m.group(1))
+        digits = _NON_DIGIT_RE.sub("", m.group(1))
         if 7 <= len(digits) <= 15:
             return digits
         if len(digits) > 15:
             return digits[:15]
 
     # 3) General free-text: pick the first E.164-like token (allow common separators)
-    m = re.search(r"(?<!\d)(\+?[1-9][0-9\-()\s]{6,20})(?!\d)", s)
+    m = _WA_FREE_TEXT_RE.search(s)
     if m:
-        digits = re.sub(r"\D", "", m.group(1))
+        digits = _NON_DIGIT_RE.sub("", m.group(1))
         if 7 <= len(digits) <= 15:
             return digits
         if len(digits) > 15:
             return digits[:15]
 
     # 4) Fallback: digits-only if reasonable length
-    digits = re.sub(r"\D", "", s)
+    digits = _NON_DIGIT_RE.sub("", s)
     if 7 <= len(digits) <= 15:
         return digits
     return None
 
+_POST_LINK_ENTITY = None
+
 async def _get_next_post_link():
     """Вернуть ссылку t.me/<slug-or-username>/<next_id> на СЛЕДУЮЩЕЕ сообщение.
     Сначала пытаемся получить entity по username (POST_LINK_CHANNEL_SLUG), затем по ID.
@@ -616,9 +1876,12 @@ async def _get_next_post_link():
         logging.warning("Не удалось подключиться к Telegram клиенту для вычисления next_post_link")
         return None
 
-    entity = None
+    global _POST_LINK_ENTITY
+    # Канал резолвится один раз: get_entity по username — это ResolveUsername, лимит которого
+    # общий для аккаунта (в том числе с проверкой контактов в предпроверке)
+    entity = _POST_LINK_ENTITY
     # 1) Пытаемся по username/slug (надёжнее для публичных каналов)
-    if POST_LINK_CHANNEL_SLUG:
+    if entity is None and POST_LINK_CHANNEL_SLUG:
         try:
             entity = await base_client.get_entity(POST_LINK_CHANNEL_SLUG)
         except Exception as e:
@@ -634,6 +1897,7 @@ async def _get_next_post_link():
 
     try:
         last = await base_client.get_messages(entity, limit=1)
+        _POST_LINK_ENTITY = entity
         last_id = last[0].id if last else 0
         next_id = last_id + 1
         uname = getattr(entity, "username", None) or POST_LINK_CHANNEL_SLUG
@@ -643,32 +1907,37 @@ async def _get_next_post_link():
         if internal_id:
             return f"https://t.me/c/{internal_id}/{next_id}"
     except Exception as e:
+        _POST_LINK_ENTITY = None  # канал мог смениться — в следующий раз резолвим заново
         logging.warning(f"Не удалось получить номер последнего поста: {e}")
         return None
 
     return None
 
-def crown_over_name_lines(name: str, crown_html: str):
+def _crown_indent(name: str) -> str:
+    """Отступ из узких пробелов, ставящий корону по центру над именем.
+    Имена повторяются между перепостами, поэтому результат кэшируется."""
     name_plain = _strip_tags(name)
+    key = (name_plain, _CROWN_PARAMS)
+    indent = CROWN_INDENT_CACHE.get(key)
+    if indent is None:
+        indent = _measure_crown_indent(name_plain)
+        CROWN_INDENT_CACHE.put(key, indent)
+    return indent
+
+def _measure_crown_indent(name_plain: str) -> str:
     name_px = _text_width_px(name_plain)
-    em_px = _space_width_px("M")
-    crown_px = max(1, int(round(em_px * CROWN_EM_WIDTH_SCALE)))
+    crown_px = max(1, int(round(_EM_PX * CROWN_EM_WIDTH_SCALE)))
     offset_px = max(0, int(round(name_px / 2 - crown_px / 2)))
     offset_px += CROWN_OFFSET_PX_ADJUST
-    nnbsp_px = _space_width_px(NNBSP)
-    n_spaces = max(0, int(offset_px // max(1, nnbsp_px)))
-    leftover_px = max(0, int(offset_px - n_spaces * max(1, nnbsp_px)))
+    n_spaces = max(0, int(offset_px // max(1, _NNBSP_PX)))
+    leftover_px = max(0, int(offset_px - n_spaces * max(1, _NNBSP_PX)))
     thin_count = 0
     if CROWN_FINE_TUNE == "thin":
-        thin_px = _space_width_px(CROWN_THIN)
-        if thin_px > 0:
-            thin_count = int(round(leftover_px / thin_px))
+        if _CROWN_THIN_PX > 0:
+            thin_count = int(round(leftover_px / _CROWN_THIN_PX))
             thin_count = max(0, min(thin_count, 8))
     n_spaces += max(0, CROWN_OFFSET_ADJUST)
-    indent = (NNBSP * n_spaces) + (CROWN_THIN * thin_count)
-    line1 = f"{indent}{crown_html}"
-    line2 = f"<b><i>{name}</i></b>"
-    return line1, line2
+    return (NNBSP * n_spaces) + (CROWN_THIN * thin_count)
 
 
 # --- ДЕДУП ПО КАНАЛУ: сравнение текста и окно по времени ---
@@ -681,17 +1950,22 @@ def _norm_text_for_dedupe(s: str) -> str:
     t = re.sub(r'\s+', ' ', t)
     return t.strip().lower()
 
-async def _already_posted_recent(client, channel, message_html: str, window_sec: int = None) -> bool:
-    """Возвращает True, если в канале уже есть такой же по тексту пост за последние N секунд."""
+# Читается при загрузке, чтобы у каждого арендатора было своё значение
+DEDUP_WINDOW_SEC = ENV.get("DEDUP_WINDOW_SEC", "180")
+
+async def _already_posted_recent(client, channel, message_text: str, window_sec: int = None,
+                                 normalized: bool = False) -> bool:
+    """Возвращает True, если в канале уже есть такой же по тексту пост за последние N секунд.
+    normalized=True — message_text уже прошёл _norm_text_for_dedupe."""
     try:
-        win = int(os.environ.get("DEDUP_WINDOW_SEC", "180")) if window_sec is None else int(window_sec)
+        win = int(DEDUP_WINDOW_SEC) if window_sec is None else int(window_sec)
     except Exception:
         win = 180
     try:
         recent = await client.get_messages(channel, limit=6)
     except Exception:
         return False
-    target = _norm_text_for_dedupe(message_html)
+    target = message_text if normalized else _norm_text_for_dedupe(message_text)
     from datetime import datetime as _dt
     now_utc = _dt.utcnow()
     for m in recent:
@@ -710,70 +1984,266 @@ async def _already_posted_recent(client, channel, message_html: str, window_sec:
                 return True
     return False
 
+async def _journal_post_is_row(client, channel, entry, record):
+    """Сообщение из журнала (entry) ещё в канале и относится к этой строке — то же имя
+    и, если он указан, тот же контакт: строку правили после отправки, а не заменили другой.
+    None — проверить не удалось."""
+    if not entry.get("message_id"):
+        return False
+    try:
+        msg = await client.get_messages(channel, ids=entry["message_id"])
+    except Exception as e:
+        logging.warning(f"Не удалось прочитать сообщение #{entry['message_id']} из {channel}: {e}")
+        return None
+    if msg is None:
+        return False
+    text = _norm_text_for_dedupe(getattr(msg, "message", "") or "")
+    name = _norm_text_for_dedupe(record.get("Имя", ""))
+    if not name or name not in text:
+        return False
+    handles = [str(h).lower() for h in (CONTACTS.tg_username(record.get("Telegram", "")),
+                                       CONTACTS.wa_number(record.get("WhatsApp", ""))) if h]
+    if not handles:
+        return True
+    urls = " ".join(str(getattr(e, "url", "") or "").lower() for e in (getattr(msg, "entities", None) or []))
+    return any(h in text or h in urls for h in handles)
+
+def _message_link(channel_str, message_id: int):
+    """Постоянная ссылка на сообщение: t.me/<username>/<id> или t.me/c/<id канала>/<id>."""
+    ch = str(channel_str or "").strip()
+    if re.fullmatch(r"-100\d+", ch):
+        return f"https://t.me/c/{ch[4:]}/{message_id}"
+    name = re.sub(r"^(?:https?://)?t\.me/", "", ch, flags=re.IGNORECASE).lstrip("@").strip("/")
+    if re.fullmatch(r"[A-Za-z0-9_]{4,}", name):
+        return f"https://t.me/{name}/{message_id}"
+    return None
+
 # --- 4. ФУНКЦИЯ ОТПРАВКИ ПОСТА ---
 
-async def send_post(record, row_idx, pending_indices=None):  # returns (ok_count, success_indices)
-    """Собирает, форматирует и отправляет пост на основе строки из таблицы."""
-    status = record.get("Статус", "")
-    name = record.get("Имя", "")
-    services = _normalize_multiline_text(record.get("Услуги", ""))
-    extra_services = _normalize_multiline_text(record.get("Доп. услуги", ""))
-    age = record.get("Возраст", "")
-    height = record.get("Рост", "")
-    weight = record.get("Вес", "")
-    bust = record.get("Грудь", "")
-    express_price = record.get("Express", "")
-    incall_price = record.get("Incall", "")
-    outcall_price = record.get("Outcall", "")
-    whatsapp_link = record.get("WhatsApp", "")
-    telegram_link = record.get("Telegram", "")
-    note_text = record.get("Примечание", "")
-    nationality_raw = record.get("Национальность", "")
-    nationality_flag = re.sub(r"\s+", "", str(nationality_raw or ""))
+MEDIA_COLUMN_HEADERS = [f"Ссылка {i}" for i in range(1, 11)]
 
-    # --- Сбор ссылки на будущий пост и формирование DM-ссылок ---
-    name_plain_for_dm = _strip_tags(name)
-    next_post_link = await _get_next_post_link()
-    if not next_post_link:
-        _notify_skip(row_idx, "Не удалось получить номер последнего поста в канале (entity недоступен). Публикация пропущена.")
-        return 0, []
+# Столбцы, которые читает send_post: по ним считается отпечаток строки
+POST_FIELDS = (
+    "Статус", "Имя", "Услуги", "Доп. услуги", "Возраст", "Рост", "Вес", "Грудь",
+    "Express", "Incall", "Outcall", "WhatsApp", "Telegram", "Примечание",
+    "Национальность", "Английское Имя", "Количество",
+) + tuple(MEDIA_COLUMN_HEADERS)
 
-    # Определяем, нужно ли использовать английское имя/приветствие
-    eng_name_raw = record.get("Английское Имя", "")
-    eng_name_clean = _strip_tags(eng_name_raw)
-    use_english_greeting = bool(eng_name_clean)
+# Бюджет кэша скачанных медиа (для повторов неудачных строк без повторной загрузки
+# и заранее скачанных предпроверкой). Кэш один на процесс и живёт в памяти: по умолчанию
+# 50 МБ — с запасом для dyno на 512 МБ (Telethon, gspread и пик загрузки альбома — сверху).
+# На машинах с большим объёмом памяти можно поднять, 0 — не кэшировать.
+MEDIA_CACHE_MAX_MB = int(ENV.get("MEDIA_CACHE_MAX_MB", "50"))
+RENDER_CACHE_SIZE = int(ENV.get("RENDER_CACHE_SIZE", "256"))
 
-    if use_english_greeting:
-        name_for_dm = eng_name_clean
-        prefill_text = (
-            f"Hi, {name_for_dm}!\u2009💙\n"
-            f"I saw your profile and would like to arrange a meeting.\n"
-            f"Post link: {next_post_link}"
-        )
-    else:
-        name_for_dm = name_plain_for_dm
-        prefill_text = (
-            f"Привет, {name_for_dm}!\u2009💙\n"
-            f"Увидел твою анкету и хочу организовать встречу.\n"
-            f"Ссылка на пост: {next_post_link}"
-        )
+def _row_fingerprint(record) -> str:
+    """Быстрый отпечаток содержимого строки по столбцам, которые использует send_post."""
+    h = hashlib.blake2b(digest_size=12)
+    for f in POST_FIELDS:
+        h.update(str(record.get(f, "")).encode("utf-8", "surrogatepass"))
+        h.update(b"\x1f")
+    return h.hexdigest()
 
-    tg_username = _tg_username_from_contact(telegram_link)
-    wa_number = _wa_number_from_contact(whatsapp_link)
+class _LRU:
+    """Маленький LRU-кэш с лимитом по количеству или по суммарному «весу» (байтам)."""
 
-    telegram_dm_link = telegram_link
-    whatsapp_dm_link = whatsapp_link
-    try:
-        if tg_username:
-            telegram_dm_link = f"https://t.me/{tg_username}?text=" + urllib.parse.quote(prefill_text, safe="")
-    except Exception:
-        pass
-    try:
-        if wa_number:
-            whatsapp_dm_link = f"https://wa.me/{wa_number}?text=" + urllib.parse.quote(prefill_text, safe="")
-    except Exception:
-        pass
+    def __init__(self, max_items: int = 0, max_weight: int = 0):
+        self.max_items = max_items
+        self.max_weight = max_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return self._data[key][0]
+
+    def put(self, key, value, weight: int = 0):
+        self.pop(key)
+        self._data[key] = (value, weight)
+        self.weight += weight
+        while self._data and (
+            (self.max_items and len(self._data) > self.max_items)
+            or (self.max_weight and self.weight > self.max_weight)
+        ):
+            _, (_, w) = self._data.popitem(last=False)
+            self.weight -= w
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.weight -= item[1]
+            return item[0]
+        return None
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self.weight = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"items": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None}
+
+# Отпечатки строк между циклами: {row_idx: fingerprint}
+ROW_FINGERPRINTS = {}
+# Строки, не прошедшие проверку: {row_idx: (fingerprint, причина)} — не перепроверяем, пока строку не изменят
+ROW_INVALID = {}
+# fingerprint -> [(bytes, file_name)], fingerprint -> тело подписи
+# и (fingerprint, next_post_link) -> (text, entities, ключ дедупа)
+# Ключ — отпечаток содержимого строки, поэтому кэш медиа общий для всех арендаторов
+# max(1, …): при MEDIA_CACHE_MAX_MB=0 любой файл сразу вытесняется (у _LRU 0 — «без лимита»)
+MEDIA_CACHE = SHARED.setdefault("media_cache", _LRU(max_weight=max(1, MEDIA_CACHE_MAX_MB * 1024 * 1024)))
+RENDER_CACHE = _LRU(max_items=RENDER_CACHE_SIZE)
+POST_BODY_CACHE = _LRU(max_items=RENDER_CACHE_SIZE)
+# (имя, параметры пресета) -> отступ короны; параметры в ключе, поэтому кэш общий для арендаторов
+CROWN_INDENT_CACHE = SHARED.setdefault("crown_indent_cache", _LRU(max_items=CROWN_CACHE_SIZE))
+
+# Контакты: кэш разбора и (по желанию) проверка существования Telegram-username.
+# ResolveUsername у Telegram жёстко ограничен (порядка сотен в сутки на аккаунт, FloodWait — часы),
+# поэтому проверка выключена по умолчанию, идёт не чаще раза в минуту и не больше
+# CONTACT_RESOLVE_PER_DAY раз в сутки на аккаунт. Лучше отдать её отдельному аккаунту
+# (CONTACT_RESOLVE_SESSION): иначе она делит лимит с сервисным клиентом публикации.
+CONTACT_CACHE_SIZE = int(ENV.get("CONTACT_CACHE_SIZE", "4096"))
+CONTACT_RESOLVE_USERNAMES = ENV.get("CONTACT_RESOLVE_USERNAMES", "0") == "1"
+CONTACT_RESOLVE_PER_MIN = int(ENV.get("CONTACT_RESOLVE_PER_MIN", "1"))
+CONTACT_RESOLVE_PER_DAY = int(ENV.get("CONTACT_RESOLVE_PER_DAY", "50"))
+CONTACT_RESOLVE_TTL_HOURS = float(ENV.get("CONTACT_RESOLVE_TTL_HOURS", "24"))
+CONTACT_RESOLVE_SESSION = ENV.get("CONTACT_RESOLVE_SESSION", "")
+
+_MISSING = object()
+
+class ContactResolver:
+    """Разбор контактов строки с кэшем нормализованных значений и проверка username
+    через ResolveUsername (с лимитом запросов и TTL результата).
+    Разбор вызывается и из потоков предпроверки, поэтому кэш разбора — под замком."""
+
+    def __init__(self, client=None):
+        self._lock = threading.Lock()
+        self.parsed = _LRU(max_items=CONTACT_CACHE_SIZE)
+        self.resolved = _LRU(max_items=CONTACT_CACHE_SIZE)  # username -> (существует, time.time())
+        self.client = client
+        # Лимит — на аккаунт, а клиенты одной сессии общие для арендаторов: квота тоже общая
+        self.quota = SHARED.setdefault(("contact_resolve_quota", id(client)), {
+            "bucket": TokenBucket(CONTACT_RESOLVE_PER_MIN, burst=1),
+            "day": None, "used": 0, "flood_until": 0.0,
+        })
+
+    def _take_quota(self) -> bool:
+        q = self.quota
+        today = datetime.now(tz).date()
+        if q["day"] != today:
+            q["day"], q["used"] = today, 0
+        if time.monotonic() < q["flood_until"] or q["used"] >= CONTACT_RESOLVE_PER_DAY:
+            return False
+        if not q["bucket"].try_acquire():
+            return False
+        q["used"] += 1
+        return True
+
+    def _parse(self, kind, parse, val):
+        key = (kind, str(val or ""))
+        with self._lock:
+            res = self.parsed.get(key, _MISSING)
+        if res is _MISSING:
+            res = parse(key[1])
+            with self._lock:
+                self.parsed.put(key, res)
+        return res
+
+    def tg_username(self, val):
+        return self._parse("tg", _parse_tg_username, val)
+
+    def wa_number(self, val):
+        return self._parse("wa", _parse_wa_number, val)
+
+    async def username_exists(self, username: str):
+        """True/False — занят ли username в Telegram; None — не проверяли
+        (проверка выключена, лимит запросов исчерпан или ошибка сети)."""
+        if not CONTACT_RESOLVE_USERNAMES or self.client is None or not _TG_USERNAME_RE.fullmatch(username):
+            return None
+        key = username.lower()
+        cached = self.resolved.get(key)
+        if cached is not None and time.time() - cached[1] < CONTACT_RESOLVE_TTL_HOURS * 3600:
+            return cached[0]
+        if not self._take_quota():
+            return None
+        try:
+            if not self.client.is_connected():
+                await self.client.connect()
+            await self.client(functions.contacts.ResolveUsernameRequest(username))
+            exists = True
+        except (tl_errors.UsernameNotOccupiedError, tl_errors.UsernameInvalidError):
+            exists = False
+        except tl_errors.FloodWaitError as e:
+            self.quota["flood_until"] = time.monotonic() + e.seconds
+            logging.warning(f"ResolveUsername: FloodWait {e.seconds} сек — проверка username приостановлена")
+            return None
+        except Exception as e:
+            logging.warning(f"ResolveUsername @{username}: {e}")
+            return None
+        self.resolved.put(key, (exists, time.time()))
+        return exists
+
+CONTACTS = ContactResolver(
+    None if OFFLINE_MODE or not CONTACT_RESOLVE_USERNAMES
+    else _telegram_client(CONTACT_RESOLVE_SESSION, GLOBAL_PROXY) if CONTACT_RESOLVE_SESSION
+    else service_client
+)
+
+def cache_stats() -> dict:
+    """Статистика кэшей рендера, контактов и медиа: {имя: {items, hits, misses, hit_rate}}."""
+    return {
+        "crown": CROWN_INDENT_CACHE.stats(),
+        "body": POST_BODY_CACHE.stats(),
+        "render": RENDER_CACHE.stats(),
+        "contacts": CONTACTS.parsed.stats(),
+        "media": MEDIA_CACHE.stats(),
+    }
+
+def _is_sent(record) -> bool:
+    sent_flag = record.get("Отправлено", record.get("отправлено", ""))
+    return str(sent_flag).strip().upper() == "TRUE"
 
+def _note_row_versions(rows) -> int:
+    """Сравнить отпечатки свежепрочитанных строк с прошлым циклом.
+    Возвращает число изменённых строк; у изменённых сбрасываются кэши проверки и медиа."""
+    changed = 0
+    for row_idx, record in rows:
+        if _is_sent(record) or not str(record.get("Имя", "")).strip():
+            ROW_FINGERPRINTS.pop(row_idx, None)
+            ROW_INVALID.pop(row_idx, None)
+            continue
+        fp = _row_fingerprint(record)
+        old = ROW_FINGERPRINTS.get(row_idx)
+        if old == fp:
+            continue
+        ROW_FINGERPRINTS[row_idx] = fp
+        if old is None:
+            continue
+        changed += 1
+        ROW_INVALID.pop(row_idx, None)
+        MEDIA_CACHE.pop(old)
+        print(f"Строка {row_idx} изменена в таблице — будет проверена заново.")
+    return changed
+
+def _post_media_urls(record) -> List[str]:
+    media_urls = []
+    for header in MEDIA_COLUMN_HEADERS:
+        url = record.get(header)
+        if url and isinstance(url, str) and url.startswith("http"):
+            media_urls.append(url)
+    return media_urls
+
+def _required_media_count(record) -> int:
     # Требуемое количество рабочих медиа (из столбца "Количество"): пусто -> 4
     required_media_raw = record.get("Количество", "")
     try:
@@ -785,138 +2255,585 @@ async def send_post(record, row_idx, pending_indices=None):  # returns (ok_count
         required_media_count = 4
     if str(required_media_raw).strip() == "":
         required_media_count = 4
+    return required_media_count
 
+def _validate_post(record):
+    """Проверки, зависящие только от содержимого строки. Возвращает причину пропуска или None."""
+    telegram_link = record.get("Telegram", "")
+    whatsapp_link = record.get("WhatsApp", "")
     # Обязательное требование: нужен хотя бы один контакт (Telegram или WhatsApp)
     has_tg = bool(telegram_link and str(telegram_link).strip())
     has_wa = bool(whatsapp_link and str(whatsapp_link).strip())
     if not (has_tg or has_wa):
-        _notify_skip(row_idx, "Нет контакта Telegram или WhatsApp. Публикация пропущена.")
-        return 0, []
+        return "Нет контакта Telegram или WhatsApp. Публикация пропущена."
 
-    # --- сбор строк внутри блоков ---
-    param_lines = []
-    if age and str(age).strip():    param_lines.append(f"Возраст: {age}")
-    if height and str(height).strip(): param_lines.append(f"Рост: {height}")
-    if weight and str(weight).strip(): param_lines.append(f"Вес: {weight}")
-    if bust and str(bust).strip():  param_lines.append(f"Грудь: {bust}")
+    media_urls = _post_media_urls(record)
+    if not media_urls:
+        return "Нет ни одной ссылки на медиа. Публикация пропущена."
+    if media_urls and len(set(media_urls)) != len(media_urls):
+        return "Обнаружены дубликаты ссылок на медиа. Публикация пропущена."
+    return None
 
-    blocks = []
+def _present(val) -> bool:
+    return bool(val and str(val).strip())
+
+def _fmt_price(val):
+    try:
+        num = float(str(val).replace(' ', '').replace(',', '.'))
+        amount = int(round(num * 1000))  # значения трактуем как тысячи AMD
+        return f"{format(amount, ',d').replace(',', '.')} AMD"
+    except Exception:
+        return f"{val} AMD"
+
+def _utf16_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+class _Caption:
+    """Построитель подписи: текст + сущности Telegram за один проход, без HTML.
+    Смещения считаются в UTF-16 (как в Telegram); сущность пока — список
+    [класс, offset, length, kwargs], объекты MessageEntity создаются в build()."""
+    __slots__ = ("parts", "offset", "ents")
+
+    def __init__(self):
+        self.parts = []
+        self.offset = 0
+        self.ents = []
+
+    def text(self, s: str):
+        if s:
+            self.parts.append(s)
+            self.offset += _utf16_len(s)
+
+    def field(self, value):
+        """Значение из таблицы. Разметка внутри ячейки (теги, &amp;) разбирается
+        локально, только для этого фрагмента — как её понял бы HTML-парсер."""
+        s = str(value)
+        if "<" not in s and "&" not in s:
+            return self.text(s)
+        parser = tl_html.HTMLToTelegramParser()
+        parser.feed(add_surrogate(s))
+        parser.close()
+        for e in sorted(reversed(parser.entities), key=lambda e: e.offset):
+            kw = {k: v for k, v in e.to_dict().items() if k not in ("_", "offset", "length")}
+            self.ents.append([type(e), self.offset + e.offset, e.length, kw])
+        self.text(del_surrogate(parser.text))
+
+    def open(self, cls, **kw):
+        ent = [cls, self.offset, 0, kw]
+        self.ents.append(ent)
+        return ent
+
+    def close(self, ent):
+        ent[2] = self.offset - ent[1]
+
+    def emoji(self, document_id: int, placeholder: str):
+        if document_id in INVALID_EMOJI_IDS:
+            # Эмодзи недоступно в Telegram — остаётся обычный символ
+            return self.text(placeholder)
+        ent = self.open(types.MessageEntityCustomEmoji, document_id=document_id)
+        self.text(placeholder)
+        self.close(ent)
+
+    def static(self, frag):
+        """Вставить заранее собранный фрагмент (text, utf16_len, entities)."""
+        text, length, ents = frag
+        base = self.offset
+        self.parts.append(text)
+        self.offset += length
+        for cls, off, ln, kw in ents:
+            self.ents.append([cls, base + off, ln, kw])
+
+    def freeze(self):
+        return "".join(self.parts), self.offset, tuple(tuple(e) for e in self.ents)
+
+    def build(self):
+        """(text, entities). Пустые сущности отбрасываются, порядок — по offset
+        (внешняя раньше вложенной), как у telethon.extensions.html.parse."""
+        ents = sorted((e for e in self.ents if e[2] > 0), key=lambda e: e[1])
+        return "".join(self.parts), [cls(offset=off, length=ln, **kw) for cls, off, ln, kw in ents]
+
+def _static(*ops):
+    """Собрать статичный фрагмент: ops — строки и номера emoji_ids (int)."""
+    c = _Caption()
+    for op in ops:
+        if isinstance(op, int):
+            c.emoji(emoji_ids[op], emoji_placeholders[op])
+        else:
+            c.text(op)
+    return c.freeze()
+
+def _bold_italic(c: _Caption, write):
+    b = c.open(types.MessageEntityBold)
+    i = c.open(types.MessageEntityItalic)
+    write()
+    c.close(i)
+    c.close(b)
+
+# Макет поста: блоки по порядку, между блоками — пустая строка.
+# Шаблон компилируется один раз при старте: статичные фрагменты (эмодзи, заголовки разделов,
+# строка «Фото») собираются заранее вместе с сущностями, при рендере подставляются только поля строки.
+POST_TEMPLATE = (
     # 1) Статус
-    blocks.append(
-        f'<a href="emoji/{emoji_ids[1]}">{emoji_placeholders[1]}</a>{THIN}'
-        f'<i>{status}</i>{THIN}'
-        f'<a href="emoji/{emoji_ids[2]}">{emoji_placeholders[2]}</a>'
-    )
-    # 2) Коронка над именем (2 строки)
-    crown_html = f'<a href="emoji/{emoji_ids[3]}">{emoji_placeholders[3]}</a>'
-    line1, line2 = crown_over_name_lines(name, crown_html)
-    if nationality_flag:
-        line2 = f"{line2}{THIN}{nationality_flag}"
-    blocks.append("\n".join([line1, line2]))
+    ("title", {"left": 1, "right": 2, "field": "Статус"}),
+    # 2) Коронка над именем (2 строки) + флаг национальности
+    ("crown_name", {"crown": 3, "field": "Имя", "flag": "Национальность"}),
     # 3) Фото
-    foto_checks = "".join(f'<a href="emoji/{eid}">✅</a>' for eid in FOTO_EMOJI_IDS)
-    blocks.append(f'<b>Фото{THIN}{foto_checks}</b>')
+    ("photo", {"label": "Фото", "emoji": FOTO_EMOJI_IDS}),
     # 4) Услуги/Доп.услуги
-    services_lines = []
-    if services and str(services).strip():
-        services_lines += ["Услуги:", f'<b><i>{services}</i></b>']
-    if extra_services and str(extra_services).strip():
-        if services_lines:
-            services_lines.append("")  # один пустой ряд как визуальный разделитель
-        services_lines += ["Доп. услуги:", f'<b><i>{extra_services}</i></b>']
-    if services_lines:
-        inner = "\n".join(services_lines)
-        blocks.append(f"<blockquote>{inner}</blockquote>")
+    ("services", {"fields": (("Услуги", "Услуги:"), ("Доп. услуги", "Доп. услуги:"))}),
     # 5) Параметры
-    if param_lines:
-        params_header = (
-            f'<a href="emoji/{emoji_ids[8]}">{emoji_placeholders[8]}</a>{THIN}'
-            f'Параметры{THIN}'
-            f'<a href="emoji/{emoji_ids[9]}">{emoji_placeholders[9]}</a>'
-        )
-        blocks.append(params_header + "\n" + '<b><i>' + "\n".join(param_lines) + '</i></b>')
+    ("section", {"title": "Параметры", "left": 8, "right": 9,
+                 "lines": (("Возраст", "Возраст"), ("Рост", "Рост"), ("Вес", "Вес"), ("Грудь", "Грудь"))}),
     # 6) Цены
-    def _fmt_price(val):
-        try:
-            num = float(str(val).replace(' ', '').replace(',', '.'))
-            amount = int(round(num * 1000))  # значения трактуем как тысячи AMD
-            return f"{format(amount, ',d').replace(',', '.')} AMD"
-        except Exception:
-            return f"{val} AMD"
-    price_lines = []
-    if express_price and str(express_price).strip(): price_lines.append(f"Express: {_fmt_price(express_price)}")
-    if incall_price and str(incall_price).strip():  price_lines.append(f"Incall: {_fmt_price(incall_price)}")
-    if outcall_price and str(outcall_price).strip(): price_lines.append(f"Outcall: {_fmt_price(outcall_price)}")
-    if price_lines:
-        price_header = (
-            f'<a href="emoji/{emoji_ids[10]}">{emoji_placeholders[10]}</a>{THIN}'
-            f'Цена{THIN}'
-            f'<a href="emoji/{emoji_ids[11]}">{emoji_placeholders[11]}</a>'
-        )
-        blocks.append(price_header + "\n" + '<b><i>' + "\n".join(price_lines) + '</i></b>')
+    ("section", {"title": "Цена", "left": 10, "right": 11, "format": _fmt_price,
+                 "lines": (("Express", "Express"), ("Incall", "Incall"), ("Outcall", "Outcall"))}),
     # 6.5) Примечание
-    if note_text and str(note_text).strip():
-        note_header = (
-            f'<a href="emoji/{emoji_ids[15]}">{emoji_placeholders[15]}</a>{THIN}'
-            f'Примечание{THIN}'
-            f'<a href="emoji/{emoji_ids[15]}">{emoji_placeholders[15]}</a>'
-        )
-        blocks.append(note_header + "\n" + '<b><i>' + str(note_text).strip() + '</i></b>')
+    ("note", {"title": "Примечание", "left": 15, "right": 15, "field": "Примечание"}),
     # 7) Призыв + контакты
-    cta_and_contacts = [
-        f'<a href="emoji/{emoji_ids[12]}">{emoji_placeholders[12]}</a>'
-        f'{THIN}<b><i>Назначь встречу уже сегодня!</i></b>{THIN}'
-        f'<a href="emoji/{emoji_ids[13]}">{emoji_placeholders[13]}</a>'
-    ]
-    if telegram_link and str(telegram_link).strip():
-        cta_and_contacts.append(
-            f'<a href="emoji/{emoji_ids[16]}">{emoji_placeholders[16]}</a>{THIN}'
-            f'<a href="{telegram_dm_link}"><b>Связь в Telegram</b></a>'
+    ("contacts", {"cta": "Назначь встречу уже сегодня!", "left": 12, "right": 13,
+                  "links": (("Telegram", 16, "Связь в Telegram"), ("WhatsApp", 14, "Связь в WhatsApp"))}),
+)
+
+def _compile_title(left, right, field):
+    head, tail = _static(left, THIN), _static(THIN, right)
+
+    def render(c, record, links):
+        c.static(head)
+        i = c.open(types.MessageEntityItalic)
+        c.field(record.get(field, ""))
+        c.close(i)
+        c.static(tail)
+        return True
+    return render
+
+def _compile_crown_name(crown, field, flag):
+    crown_frag = _static(crown)
+
+    def render(c, record, links):
+        name = record.get(field, "")
+        c.text(_crown_indent(name))
+        c.static(crown_frag)
+        c.text("\n")
+        _bold_italic(c, lambda: c.field(name))
+        nationality_flag = re.sub(r"\s+", "", str(record.get(flag, "") or ""))
+        if nationality_flag:
+            c.text(THIN)
+            c.field(nationality_flag)
+        return True
+    return render
+
+def _compile_photo(label, emoji):
+    c = _Caption()
+    b = c.open(types.MessageEntityBold)
+    c.text(f"{label}{THIN}")
+    for eid in emoji:
+        c.emoji(eid, "✅")
+    c.close(b)
+    frag = c.freeze()
+
+    def render(c, record, links):
+        c.static(frag)
+        return True
+    return render
+
+def _compile_services(fields):
+    def render(c, record, links):
+        present = []
+        for field, label in fields:
+            text = _normalize_multiline_text(record.get(field, ""))
+            if _present(text):
+                present.append((label, text))
+        if not present:
+            return False
+        q = c.open(types.MessageEntityBlockquote)
+        for n, (label, text) in enumerate(present):
+            if n:
+                c.text("\n\n")  # один пустой ряд как визуальный разделитель
+            c.text(label + "\n")
+            _bold_italic(c, lambda: c.field(text))
+        c.close(q)
+        return True
+    return render
+
+def _compile_section(title, left, right, lines, format=None):
+    head = _static(left, THIN + title + THIN, right, "\n")
+    prefixes = tuple((field, f"{label}: ") for field, label in lines)
+
+    def render(c, record, links):
+        present = [(prefix, record.get(field, "")) for field, prefix in prefixes]
+        present = [(prefix, val) for prefix, val in present if _present(val)]
+        if not present:
+            return False
+        c.static(head)
+
+        def write():
+            for n, (prefix, val) in enumerate(present):
+                c.text(("\n" if n else "") + prefix)
+                c.field(format(val) if format else val)
+        _bold_italic(c, write)
+        return True
+    return render
+
+def _compile_note(title, left, right, field):
+    head = _static(left, THIN + title + THIN, right, "\n")
+
+    def render(c, record, links):
+        val = record.get(field, "")
+        if not _present(val):
+            return False
+        c.static(head)
+        _bold_italic(c, lambda: c.field(str(val).strip()))
+        return True
+    return render
+
+def _compile_contacts(cta, left, right, links):
+    c = _Caption()
+    c.emoji(emoji_ids[left], emoji_placeholders[left])
+    c.text(THIN)
+    _bold_italic(c, lambda: c.text(cta))
+    c.text(THIN)
+    c.emoji(emoji_ids[right], emoji_placeholders[right])
+    cta_frag = c.freeze()
+    contacts = tuple((field, _static("\n", emoji, THIN), label) for field, emoji, label in links)
+
+    def render(c, record, links):
+        c.static(cta_frag)
+        for field, prefix, label in contacts:
+            if _present(record.get(field, "")):
+                c.static(prefix)
+                url = str(links[field])
+                a = c.open(types.MessageEntityTextUrl, url=html_unescape(url) if "&" in url else url)
+                b = c.open(types.MessageEntityBold)
+                c.text(label)
+                c.close(b)
+                c.close(a)
+        return True
+    return render
+
+_TEMPLATE_COMPILERS = {
+    "title": _compile_title,
+    "crown_name": _compile_crown_name,
+    "photo": _compile_photo,
+    "services": _compile_services,
+    "section": _compile_section,
+    "note": _compile_note,
+    "contacts": _compile_contacts,
+}
+
+# Блоки, которым нужны DM-ссылки (в них зашита ссылка на будущий пост)
+_LINK_BLOCKS = frozenset({"contacts"})
+
+class _PostRenderer:
+    """Скомпилированный шаблон. Блоки до первого зависящего от ссылки на пост — «тело»:
+    оно меняется только вместе со строкой, поэтому кэшируется по отпечатку и переживает
+    повторы, даже если номер следующего поста сдвинулся."""
+    __slots__ = ("head", "tail")
+
+    def __init__(self, template):
+        blocks = [(kind in _LINK_BLOCKS, _TEMPLATE_COMPILERS[kind](**spec)) for kind, spec in template]
+        split = next((i for i, (by_link, _) in enumerate(blocks) if by_link), len(blocks))
+        self.head = tuple(block for _, block in blocks[:split])
+        self.tail = tuple(block for _, block in blocks[split:])
+
+    @staticmethod
+    def _emit(c, blocks, record, links):
+        for block in blocks:
+            mark = (len(c.parts), c.offset)
+            if c.offset:
+                c.text("\n\n")
+            if not block(c, record, links):
+                # блок пуст — убираем разделитель
+                del c.parts[mark[0]:]
+                c.offset = mark[1]
+
+    def body(self, record):
+        """Тело поста — готовый фрагмент для _Caption.static."""
+        c = _Caption()
+        self._emit(c, self.head, record, None)
+        return c.freeze()
+
+    def __call__(self, record, links, body=None):
+        """-> (text, entities)."""
+        c = _Caption()
+        c.static(self.body(record) if body is None else body)
+        self._emit(c, self.tail, record, links)
+        return c.build()
+
+POST_RENDERER = _PostRenderer(POST_TEMPLATE)
+
+def _dm_links(record, next_post_link: str) -> dict:
+    """DM-ссылки контактов с предзаполненным сообщением и ссылкой на будущий пост."""
+    telegram_link = record.get("Telegram", "")
+    whatsapp_link = record.get("WhatsApp", "")
+
+    # Определяем, нужно ли использовать английское имя/приветствие
+    eng_name_clean = _strip_tags(record.get("Английское Имя", ""))
+    if eng_name_clean:
+        prefill_text = (
+            f"Hi, {eng_name_clean}!\u2009💙\n"
+            f"I saw your profile and would like to arrange a meeting.\n"
+            f"Post link: {next_post_link}"
         )
-    if whatsapp_link and str(whatsapp_link).strip():
-        cta_and_contacts.append(
-            f'<a href="emoji/{emoji_ids[14]}">{emoji_placeholders[14]}</a>{THIN}'
-            f'<a href="{whatsapp_dm_link}"><b>Связь в WhatsApp</b></a>'
+    else:
+        prefill_text = (
+            f"Привет, {_strip_tags(record.get('Имя', ''))}!\u2009💙\n"
+            f"Увидел твою анкету и хочу организовать встречу.\n"
+            f"Ссылка на пост: {next_post_link}"
         )
-    blocks.append("\n".join(cta_and_contacts))
 
-    message_html = "\n\n".join(blocks)
+    tg_username = _tg_username_from_contact(telegram_link)
+    wa_number = _wa_number_from_contact(whatsapp_link)
+    links = {"Telegram": telegram_link, "WhatsApp": whatsapp_link}
+    if tg_username or wa_number:
+        quoted = urllib.parse.quote(prefill_text, safe="")
+        if tg_username:
+            links["Telegram"] = f"https://t.me/{tg_username}?text=" + quoted
+        if wa_number:
+            links["WhatsApp"] = f"https://wa.me/{wa_number}?text=" + quoted
+    return links
 
-    # --- медиа ---
-    media_column_headers = [f"Ссылка {i}" for i in range(1, 11)]
-    media_urls = []
-    for header in media_column_headers:
-        url = record.get(header)
-        if url and isinstance(url, str) and url.startswith("http"):
-            media_urls.append(url)
-    if not media_urls:
-        _notify_skip(row_idx, "Нет ни одной ссылки на медиа. Публикация пропущена.")
-        return 0, []
-    if media_urls and len(set(media_urls)) != len(media_urls):
-        _notify_skip(row_idx, "Обнаружены дубликаты ссылок на медиа. Публикация пропущена.")
-        return 0, []
+def _render_post(record, next_post_link: str, body=None):
+    """Подпись поста из строки таблицы: (text, entities) для formatting_entities."""
+    return POST_RENDERER(record, _dm_links(record, next_post_link), body)
 
-    print(f"Найдено {len(media_urls)} URL-адресов для строки {row_idx}.")
-    media_data = []
-    if media_urls:
-        for url_idx, url in enumerate(media_urls, start=1):
+def _rendered_post(fp: str, record, next_post_link: str):
+    """Подпись строки один раз на строку: (text, entities, ключ дедупа).
+    Результат общий для всех каналов и повторов — entities кортеж, отправка берёт копию списка."""
+    rendered = RENDER_CACHE.get((fp, next_post_link))
+    if rendered is None:
+        body = POST_BODY_CACHE.get(fp)
+        if body is None:
+            body = POST_RENDERER.body(record)
+            POST_BODY_CACHE.put(fp, body)
+        text, entities = _render_post(record, next_post_link, body)
+        rendered = (text, tuple(entities), _norm_text_for_dedupe(text))
+        RENDER_CACHE.put((fp, next_post_link), rendered)
+    return rendered
+
+# --- ПРОВЕРКА CUSTOM EMOJI: один пакетный запрос при старте, результат на диске с TTL ---
+
+EMOJI_CHECK_CACHE_PATH = ENV.get("EMOJI_CHECK_CACHE_PATH", "custom_emoji_check.json")
+EMOJI_CHECK_TTL_HOURS = float(ENV.get("EMOJI_CHECK_TTL_HOURS", "24"))
+
+def _all_emoji_ids() -> List[int]:
+    return sorted(set(emoji_ids.values()) | set(FOTO_EMOJI_IDS))
+
+def _load_emoji_check(ids):
+    """Множество валидных id из файла, если проверка свежая и про тот же набор id; иначе None."""
+    try:
+        with open(EMOJI_CHECK_CACHE_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        if sorted(data["ids"]) != ids or time.time() - float(data["checked_at"]) > EMOJI_CHECK_TTL_HOURS * 3600:
+            return None
+        return set(data["valid"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def _save_emoji_check(ids, valid):
+    tmp = f"{EMOJI_CHECK_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"checked_at": time.time(), "ids": ids, "valid": sorted(valid)}, f)
+        os.replace(tmp, EMOJI_CHECK_CACHE_PATH)
+    except OSError as e:
+        print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось сохранить результат проверки custom emoji: {e}")
+
+def _apply_invalid_emoji(invalid):
+    """Перекомпилировать шаблон: статичные фрагменты с эмодзи собираются при компиляции."""
+    global POST_RENDERER
+    INVALID_EMOJI_IDS.clear()
+    INVALID_EMOJI_IDS.update(invalid)
+    POST_RENDERER = _PostRenderer(POST_TEMPLATE)
+    POST_BODY_CACHE.clear()
+    RENDER_CACHE.clear()
+
+async def validate_custom_emoji():
+    """Проверить все document_id шаблона одним GetCustomEmojiDocuments через service_client.
+    Без ответа Telegram шаблон остаётся как есть — публикация не блокируется."""
+    ids = _all_emoji_ids()
+    valid = _load_emoji_check(ids)
+    source = "кэш"
+    if valid is None:
+        try:
+            docs = await asyncio.wait_for(
+                service_client(functions.messages.GetCustomEmojiDocumentsRequest(document_id=ids)),
+                timeout=int(VALIDATION_AUTH_TIMEOUT),
+            )
+        except Exception as e:
+            print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось проверить custom emoji ({e}) — используем id как есть.")
+            return
+        valid = {doc.id for doc in docs}
+        _save_emoji_check(ids, valid)
+        source = "Telegram"
+    invalid = set(ids) - valid
+    _apply_invalid_emoji(invalid)
+    if invalid:
+        names = [emoji_placeholders.get(n, "✅") for n, eid in emoji_ids.items() if eid in invalid]
+        names += ["✅"] * sum(1 for eid in FOTO_EMOJI_IDS if eid in invalid)
+        msg = (f"⚠️ Недоступны custom emoji ({len(invalid)} из {len(ids)}): {' '.join(names)} — "
+               f"в постах будут обычные символы. id: {', '.join(map(str, sorted(invalid)))}")
+        print(msg)
+        if source == "Telegram":  # из кэша — уже сообщали при проверке
+            tg_notify(msg)
+    else:
+        print(f"Custom emoji: все {len(ids)} id действительны ({source}).")
+
+# --- БЛОКИРУЮЩИЙ ВВОД-ВЫВОД ВНЕ EVENT LOOP ---
+# Скачивание и проверка медиа (блокирующий HTTP) выполняются в общем ограниченном пуле
+# потоков, чтобы сетевой ввод-вывод клиентов Telethon не ждал их. Это пул для I/O, а не для
+# вычислений: рендер подписи остаётся в цикле — после компиляции шаблона он занимает доли
+# миллисекунды, а его кэши рассчитаны на один поток.
+# Не меньше двух потоков: фоновым этапам (предпроверка) достаётся не больше workers - 1,
+# так что хотя бы один поток всегда свободен для медиа публикуемых постов.
+# OFFLOAD_WORKERS — прежнее имя настройки, читается для совместимости.
+IO_POOL_WORKERS = max(2, int(ENV.get("IO_POOL_WORKERS", ENV.get("OFFLOAD_WORKERS", "4"))))
+
+class BlockingIOPool:
+    """Общий пул потоков для блокирующего ввода-вывода с учётом очереди: сколько задач
+    ждёт и выполняется, и по каждому этапу — ожидание в очереди и время выполнения."""
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="blocking-io")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.stages = {}
+        self._quotas = {}
+
+    def limit(self, stage: str, concurrency: int) -> int:
+        """Ограничить одновременные задачи этапа на весь процесс (для всех арендаторов).
+        Квота не больше workers - 1 — один поток остаётся остальным этапам.
+        Первый вызов фиксирует квоту; возвращает действующее значение."""
+        if stage not in self._quotas:
+            n = max(1, min(concurrency, self.workers - 1))
+            self._quotas[stage] = (n, asyncio.Semaphore(n))
+        return self._quotas[stage][0]
+
+    def _record(self, stage: str, wait: float, run: float):
+        st = self.stages.setdefault(stage, {"count": 0, "wait_sum": 0.0, "wait_max": 0.0, "run_sum": 0.0, "run_max": 0.0})
+        st["count"] += 1
+        st["wait_sum"] += wait
+        st["run_sum"] += run
+        st["wait_max"] = max(st["wait_max"], wait)
+        st["run_max"] = max(st["run_max"], run)
+
+    async def run(self, stage: str, fn, *args):
+        """Выполнить fn(*args) в пуле; контекст (имя арендатора для логов) переносится в поток."""
+        quota = self._quotas.get(stage)
+        if quota is None:
+            return await self._submit(stage, fn, *args)
+        async with quota[1]:
+            return await self._submit(stage, fn, *args)
+
+    async def _submit(self, stage: str, fn, *args):
+        submitted = time.monotonic()
+        started = []
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+        def job():
+            t0 = time.monotonic()
+            with self._lock:
+                started.append(t0)
+                self.queued -= 1
+                self.running += 1
             try:
-                file_data, final_url, content_type = _download_with_ext_guess(url, row_idx, timeout=(5, 60))
-                file_base = final_url.split("/")[-1].split("?")[0]
-                if file_base and '.' in file_base:
-                    file_name = file_base
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self._record(stage, t0 - submitted, time.monotonic() - t0)
+
+        ctx = contextvars.copy_context()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, ctx.run, job)
+        except asyncio.CancelledError:
+            with self._lock:
+                if not started:  # задача так и не начала выполняться
+                    self.queued -= 1
+            raise
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {
+                name: {
+                    "count": st["count"],
+                    "wait_ms_avg": round(st["wait_sum"] / st["count"] * 1000, 1),
+                    "wait_ms_max": round(st["wait_max"] * 1000, 1),
+                    "run_ms_avg": round(st["run_sum"] / st["count"] * 1000, 1),
+                    "run_ms_max": round(st["run_max"] * 1000, 1),
+                }
+                for name, st in self.stages.items()
+            }
+            return {"workers": self.workers, "queued": self.queued, "running": self.running,
+                    "max_queued": self.max_queued, "stages": stages,
+                    "quotas": {name: n for name, (n, _) in self._quotas.items()}}
+
+# Один пул на процесс: арендаторы делят потоки, а не умножают их
+IO_POOL = SHARED.setdefault("io_pool", BlockingIOPool(IO_POOL_WORKERS))
+
+def _download_post_media(media_urls, row_idx, quiet: bool = False):
+    """Скачать медиа строки; файлы, которые не удалось загрузить, пропускаются с уведомлением.
+    quiet — без уведомлений в Telegram (предпроверка сообщает итог в столбце статуса и сводке)."""
+    report = (lambda idx, reason: logging.info(f"Строка {idx}: {reason}")) if quiet else _notify_media_issue
+    media_data = []
+    for url_idx, url in enumerate(media_urls, start=1):
+        try:
+            file_data, final_url, content_type = _download_with_ext_guess(url, row_idx, timeout=(5, 60))
+            file_base = final_url.split("/")[-1].split("?")[0]
+            if file_base and '.' in file_base:
+                file_name = file_base
+            else:
+                if 'video' in content_type:
+                    file_name = "video.mp4"
+                elif 'image' in content_type:
+                    file_name = "image.jpg"
                 else:
-                    if 'video' in content_type:
-                        file_name = "video.mp4"
-                    elif 'image' in content_type:
-                        file_name = "image.jpg"
-                    else:
-                        _notify_media_issue(row_idx, f"Неподдерживаемый тип {content_type} для {final_url}. Пропускаю файл №{url_idx} и продолжаю.")
-                        continue
-                media_data.append((file_data, file_name))
-            except Exception as e:
-                _notify_media_issue(row_idx, f"Не удалось загрузить медиа {url} — {e}. Пропускаю файл №{url_idx} и продолжаю.")
-                continue
+                    report(row_idx, f"Неподдерживаемый тип {content_type} для {final_url}. Пропускаю файл №{url_idx} и продолжаю.")
+                    continue
+            media_data.append((file_data, file_name))
+        except Exception as e:
+            report(row_idx, f"Не удалось загрузить медиа {url} — {e}. Пропускаю файл №{url_idx} и продолжаю.")
+            continue
+    return media_data
+
+async def send_post(record, row_idx, pending_indices=None, scheduled_at=None):  # returns (ok_count, success_indices)
+    """Собирает, форматирует и отправляет пост на основе строки из таблицы."""
+    fp = _row_fingerprint(record)
+    ROW_FINGERPRINTS[row_idx] = fp
+    invalid = ROW_INVALID.get(row_idx)
+    if invalid and invalid[0] == fp:
+        # Строка не менялась с прошлой неудачной проверки — о причине уже сообщили
+        return 0, []
+
+    # Строку с тем же содержимым уже проверила предпроверка — повторять проверки не нужно
+    pre = PREFLIGHT.get(row_idx)
+    reason = None if (pre and pre["fp"] == fp and pre["valid"]) else _validate_post(record)
+    if reason:
+        ROW_INVALID[row_idx] = (fp, reason)
+        _notify_skip(row_idx, reason)
+        return 0, []
+
+    # --- Сбор ссылки на будущий пост ---
+    next_post_link = await _get_next_post_link()
+    if not next_post_link:
+        _notify_skip(row_idx, "Не удалось получить номер последнего поста в канале (entity недоступен). Публикация пропущена.")
+        return 0, []
+
+    message_text, message_entities, dedup_key = _rendered_post(fp, record, next_post_link)
+
+    # --- медиа ---
+    media_urls = _post_media_urls(record)
+    required_media_count = _required_media_count(record)
+    media_data = MEDIA_CACHE.get(fp)
+    if media_data is None:
+        print(f"Найдено {len(media_urls)} URL-адресов для строки {row_idx}.")
+        media_data = await IO_POOL.run("media", _download_post_media, media_urls, row_idx)
+    else:
+        print(f"Строка {row_idx}: медиа не менялись — использую {len(media_data)} ранее загруженных файлов.")
 
     if not media_data:
         _notify_skip(row_idx, "Не удалось загрузить ни одно медиа. Публикация пропущена.")
@@ -940,9 +2857,9 @@ async def send_post(record, row_idx, pending_indices=None):  # returns (ok_count
     async def _send_to_one(client, acc):
         channel_str = acc.get("channel")
         acc_idx = acc.get("index")
-        rt_key = (row_idx, acc_idx)
-        if rt_key in SENT_RUNTIME:
-            return acc_idx, channel_str, True, "runtime-dup-skip"
+        entry = SEND_JOURNAL.get(row_idx, acc_idx)
+        if entry and entry["status"] == "sent" and entry["fingerprint"] == fp:
+            return acc_idx, channel_str, True, "journal-dup-skip"
         if not channel_str:
             return acc_idx, channel_str, False, "no_channel"
 
@@ -959,43 +2876,76 @@ async def send_post(record, row_idx, pending_indices=None):  # returns (ok_count
             except (ValueError, TypeError):
                 channel = channel_str
 
-            # Preflight: если такой же пост уже есть в канале за недавнее время — пропускаем
-            try:
-                if await _already_posted_recent(client, channel, message_html):
-                    SENT_RUNTIME.add(rt_key)
-                    return acc_idx, channel_str, True, "pre-exist-skip"
-            except Exception as e_chk:
-                print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось выполнить проверку на дубли в TG{acc_idx}: {e_chk}")
+            # Проверка истории канала нужна, только если журнал не знает исход наверняка:
+            # отправка оборвалась (pending/unknown), журнал пуст или в нём отправлена другая
+            # версия строки (журнал помнит позицию строки, а не сам пост)
+            stale_sent = entry is not None and entry["status"] == "sent"
+            uncertain = (
+                (entry is None and SEND_JOURNAL.fresh)
+                or (entry is not None and entry["status"] in ("pending", "unknown"))
+                or stale_sent
+            )
+            if uncertain:
+                try:
+                    if await _already_posted_recent(client, channel, dedup_key, normalized=True):
+                        SEND_JOURNAL.record(row_idx, acc_idx, fp, "sent", detail="pre-exist")
+                        return acc_idx, channel_str, True, "pre-exist-skip"
+                except Exception as e_chk:
+                    print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось выполнить проверку на дубли в TG{acc_idx}: {e_chk}")
+            if stale_sent:
+                same = await _journal_post_is_row(client, channel, entry, record)
+                if same is None:
+                    # Не смогли проверить — не рискуем ни дублем, ни пропуском: повтор в следующем цикле
+                    return acc_idx, channel_str, False, "journal-check-failed"
+                if same:
+                    # Сообщение в канале — эта же строка до правки: повторно не публикуем
+                    SEND_JOURNAL.record(
+                        row_idx, acc_idx, fp, "sent", message_id=entry["message_id"],
+                        message_ids=entry["message_ids"], link=entry["link"], latency=entry["latency"],
+                        detail="edited-after-send",
+                    )
+                    return acc_idx, channel_str, True, "edited-after-send"
+                # Иначе на этом месте теперь другой пост (строки вставляли/удаляли) — публикуем
+
+            SEND_JOURNAL.record(row_idx, acc_idx, fp, "pending")
 
             if media_data:
                 file_objs = []
                 for data, fname in media_data:
                     bio = io.BytesIO(data); bio.name = fname; file_objs.append(bio)
-                await client.send_file(
-                    channel, file_objs, caption=message_html,
-                    supports_streaming=True, parse_mode=CustomHtml()
+                # Сущности уже готовы — HTML-парсер клиента не нужен
+                sent = await client.send_file(
+                    channel, file_objs, caption=message_text,
+                    formatting_entities=list(message_entities),
+                    supports_streaming=True, parse_mode=None
                 )
             else:
-                await client.send_message(
-                    channel, message_html, parse_mode=CustomHtml()
+                sent = await client.send_message(
+                    channel, message_text,
+                    formatting_entities=list(message_entities), parse_mode=None
                 )
 
-            SENT_RUNTIME.add(rt_key)
+            messages = sent if isinstance(sent, list) else [sent]
+            ids = [m.id for m in messages if getattr(m, "id", None) is not None]
+            SEND_JOURNAL.record(
+                row_idx, acc_idx, fp, "sent",
+                message_id=ids[0] if ids else None, message_ids=ids,
+                link=_message_link(channel_str, ids[0]) if ids else None,
+                latency=round(time.time() - scheduled_at.timestamp(), 1) if scheduled_at else None,
+            )
             return acc_idx, channel_str, True, None
 
         except (tl_errors.FloodWaitError, tl_errors.SlowModeWaitError) as e:
             logging.error(f"TG{acc_idx} лимит Telegram: {e}", exc_info=True)
+            SEND_JOURNAL.record(row_idx, acc_idx, fp, "failed", detail=f"rate: {e}")
             return acc_idx, channel_str, False, f"rate: {e}"
         except Exception as e:
             logging.error(f"TG{acc_idx} ошибка отправки: {e}. Повтор не выполняем, чтобы избежать дублей", exc_info=True)
-            try:
-                await client.disconnect()
-            except Exception:
-                pass
-            try:
-                await client.connect()
-            except Exception:
-                pass
+            # Исход неизвестен (сообщение могло уйти) — следующий цикл сверится с историей канала
+            SEND_JOURNAL.record(row_idx, acc_idx, fp, "unknown", detail=e)
+            # Клиент не переподключаем: он может быть общим с другими арендаторами, и разрыв
+            # оборвал бы их отправки. Обрыв связи Telethon восстанавливает сам, а отключённый
+            # клиент подключится заново в начале следующей отправки.
             # Сообщаем об ошибке без повторной отправки — повтор выполнит главный цикл, если потребуется
             return acc_idx, channel_str, False, f"transient-no-retry: {e}"
 
@@ -1004,12 +2954,24 @@ async def send_post(record, row_idx, pending_indices=None):  # returns (ok_count
         return_exceptions=False
     )
 
+    edited = [i for (i, _, s, err) in results if s and err == "edited-after-send"]
+    if edited:
+        where = ", ".join(f"TG{i}" for i in edited)
+        msg = (f"Строка {row_idx}: изменена после публикации в {where} — там осталась прежняя версия, "
+               f"повторно не публикуется; при необходимости отредактируйте пост вручную.")
+        logging.warning(msg)
+        tg_notify(f"✏️ {msg}")
+
     ok = sum(1 for (_, _, s, _) in results if s)
     fail = [(i, ch, err) for (i, ch, s, err) in results if not s]
     print(f"Строка {row_idx}: перс-отправки завершены. Успешно {ok}/{len(clients_with_channels)}. Неудачи: {fail}")
 
     if fail:
         tg_notify(f"❗️Строка {row_idx}: {ok}/{len(clients_with_channels)} успешно.\nПроблемы: {fail}")
+        # Следующий цикл повторит отправку — медиа берём из кэша, а не скачиваем заново
+        MEDIA_CACHE.put(fp, media_data, weight=sum(len(d) for d, _ in media_data))
+    else:
+        MEDIA_CACHE.pop(fp)
 
 
     success_indices = [i for (i, _, s, _) in results if s]
@@ -1026,8 +2988,10 @@ async def validate_sessions_before_start():
     print("Проверка сессий Telegram...")
     to_check = [("service", service_client)] + [(f"TG{idx}", cl) for idx, cl in sorted(CLIENT_BY_INDEX.items())]
     for label, client in to_check:
+        # Общий с другим арендатором клиент уже может работать — его соединение не трогаем
+        was_connected = client.is_connected()
         try:
-            if not client.is_connected():
+            if not was_connected:
                 await asyncio.wait_for(client.connect(), timeout=int(VALIDATION_CONNECT_TIMEOUT))
             authed = await asyncio.wait_for(client.is_user_authorized(), timeout=int(VALIDATION_AUTH_TIMEOUT))
             if not authed:
@@ -1041,29 +3005,697 @@ async def validate_sessions_before_start():
             logging.error(f"Ошибка проверки сессии {label}: {e}")
             exit(1)
         finally:
-            try:
-                await asyncio.wait_for(client.disconnect(), timeout=int(VALIDATION_DISCONNECT_TIMEOUT))
-            except Exception:
-                pass
+            if not was_connected:
+                try:
+                    await asyncio.wait_for(client.disconnect(), timeout=int(VALIDATION_DISCONNECT_TIMEOUT))
+                except Exception:
+                    pass
+
+# --- 4.6. PUSH-УВЕДОМЛЕНИЯ ОБ ИЗМЕНЕНИЯХ ТАБЛИЦЫ (webhook) ---
+
+class RowRefreshQueue:
+    """Очередь номеров строк, которые нужно перечитать адресно (без полного опроса листа).
+    Номер 1 (строка заголовков) означает «нужен полный опрос»."""
+
+    def __init__(self):
+        self._rows = set()
+        self._event = asyncio.Event()
+
+    def push(self, rows):
+        added = 0
+        for r in rows:
+            if r not in self._rows:
+                self._rows.add(r)
+                added += 1
+        if self._rows:
+            self._event.set()
+        return added
+
+    def drain(self):
+        rows, self._rows = self._rows, set()
+        self._event.clear()
+        return rows
+
+    async def wait(self, timeout: float):
+        """Ждать новых строк не дольше timeout секунд."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout=max(0.0, timeout))
+        except asyncio.TimeoutError:
+            pass
+
+ROW_REFRESH_QUEUE = RowRefreshQueue()
+
+_WEBHOOK_MAX_BODY = 64 * 1024
+_WEBHOOK_MAX_ROWS = 1000
+
+def _parse_webhook_rows(data) -> List[int]:
+    """Извлечь номера строк из тела уведомления.
+    Поддерживаются {"rows": [5, 7]}, {"row": 5} и {"start": 5, "count": 3}
+    (как e.range.getRow()/getNumRows() из Apps Script onEdit)."""
+    if not isinstance(data, dict):
+        raise ValueError("ожидается JSON-объект")
+    rows = []
+    if "rows" in data:
+        if not isinstance(data["rows"], list):
+            raise ValueError("'rows' должен быть списком")
+        rows += [int(r) for r in data["rows"]]
+    if "row" in data:
+        rows.append(int(data["row"]))
+    if "start" in data:
+        start = int(data["start"])
+        count = int(data.get("count", 1))
+        if count < 1 or count > _WEBHOOK_MAX_ROWS:
+            raise ValueError("некорректный 'count'")
+        rows += list(range(start, start + count))
+    rows = sorted({r for r in rows if r >= 1})
+    if not rows:
+        raise ValueError("не указаны номера строк")
+    if len(rows) > _WEBHOOK_MAX_ROWS:
+        raise ValueError("слишком много строк в одном уведомлении")
+    return rows
+
+def _handle_sheet_webhook(method: str, target: str, headers: dict, body: bytes):
+    """Обработать HTTP-запрос уведомления. Возвращает (status, payload).
+    Google не вызывается: строки только ставятся в ROW_REFRESH_QUEUE."""
+    parsed = urllib.parse.urlsplit(target)
+    if parsed.path != SHEET_WEBHOOK_PATH:
+        return 404, {"error": "not found"}
+    if method != "POST":
+        return 405, {"error": "method not allowed"}
+    if SHEET_WEBHOOK_TOKEN:
+        query_token = urllib.parse.parse_qs(parsed.query).get("token", [""])[0]
+        expected = SHEET_WEBHOOK_TOKEN.encode("utf-8")
+        # Сравнение за постоянное время — по времени ответа токен не подобрать
+        if not any(hmac.compare_digest(expected, str(candidate).encode("utf-8"))
+                   for candidate in (headers.get("x-webhook-token", ""), query_token)):
+            return 403, {"error": "forbidden"}
+    try:
+        rows = _parse_webhook_rows(json.loads(body.decode("utf-8") or "{}"))
+    except Exception as e:
+        return 400, {"error": str(e)}
+    queued = ROW_REFRESH_QUEUE.push(rows)
+    return 202, {"queued": queued, "rows": rows}
+
+async def _handle_webhook_conn(reader, writer):
+    status, payload = 400, {"error": "bad request"}
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=10)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        length = int(headers.get("content-length", "0") or 0)
+        if length > _WEBHOOK_MAX_BODY:
+            status, payload = 413, {"error": "payload too large"}
+        else:
+            body = await asyncio.wait_for(reader.readexactly(length), timeout=10) if length else b""
+            status, payload = _handle_sheet_webhook(method.upper(), target, headers, body)
+    except Exception as e:
+        logging.warning(f"Webhook: некорректный запрос: {e}")
+    try:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        reason = {202: "Accepted", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                  405: "Method Not Allowed", 413: "Payload Too Large"}.get(status, "OK")
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+async def start_sheet_webhook():
+    """Поднять встроенный HTTP-эндпоинт для уведомлений (например, из Apps Script onEdit).
+    Возвращает asyncio.Server или None, если SHEET_WEBHOOK_PORT не задан."""
+    if not SHEET_WEBHOOK_PORT:
+        return None
+    server = await asyncio.start_server(_handle_webhook_conn, SHEET_WEBHOOK_HOST, SHEET_WEBHOOK_PORT)
+    print(f"Webhook изменений таблицы: http://{SHEET_WEBHOOK_HOST}:{SHEET_WEBHOOK_PORT}{SHEET_WEBHOOK_PATH} "
+          f"(полный опрос раз в {FULL_POLL_SECONDS} сек.)")
+    return server
+
+# --- 4.7. АРХИВАЦИЯ ОТПРАВЛЕННЫХ СТРОК ---
+
+# Строки с флагом «Отправлено» старше N дней переносятся на лист-архив (0 — выключено)
+ARCHIVE_AFTER_DAYS = int(ENV.get("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_SHEET_TITLE = ENV.get("ARCHIVE_SHEET_TITLE", "Архив")
+ARCHIVE_INTERVAL_HOURS = float(ENV.get("ARCHIVE_INTERVAL_HOURS", "6"))
+ARCHIVE_MAX_ROWS = int(ENV.get("ARCHIVE_MAX_ROWS", "500"))
+
+def _remap_row_keys(mapping: dict, deleted, deleted_set):
+    moved = {}
+    for r, v in mapping.items():
+        if r in deleted_set:
+            continue
+        moved[r - bisect.bisect_left(deleted, r)] = v
+    mapping.clear()
+    mapping.update(moved)
+
+def _remap_rows_after_delete(deleted_rows):
+    """Строки удалены из активного листа — сдвигаем номера в журнале и рабочих кэшах."""
+    deleted = sorted(set(deleted_rows))
+    deleted_set = set(deleted)
+    SEND_JOURNAL.remap_rows(deleted)
+    for mapping in (RECORD_CACHE, ROW_FINGERPRINTS, ROW_INVALID, STALE_ROWS, PREFLIGHT):
+        _remap_row_keys(mapping, deleted, deleted_set)
+    queued = {r - bisect.bisect_left(deleted, r) for r in ROW_REFRESH_QUEUE.drain() if r not in deleted_set}
+    ROW_REFRESH_QUEUE.push(queued)
+    writes = {
+        (r - bisect.bisect_left(deleted, r), name): v
+        for (r, name), v in SHEET_WRITES.items() if r not in deleted_set
+    }
+    SHEET_WRITES.clear()
+    SHEET_WRITES.update(writes)
+
+def _archivable(row, cutoff) -> bool:
+    if not _is_sent(row):
+        return False
+    try:
+        sched_time = tz.localize(datetime.strptime(str(row.get("Время", "")), "%d.%m.%Y %H:%M:%S"))
+    except Exception:
+        return False
+    return sched_time < cutoff
+
+async def archive_sent_rows() -> int:
+    """Перенести отправленные старые строки в архив одним пакетом. Возвращает число строк."""
+    cutoff = datetime.now(tz) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    try:
+        deleted = await SOURCE.archive_rows(lambda row: _archivable(row, cutoff), ARCHIVE_SHEET_TITLE, ARCHIVE_MAX_ROWS)
+    except NotImplementedError:
+        logging.warning(f"Архивация не поддерживается для источника {SOURCE.kind} — отключаю.")
+        return -1
+    if deleted and SOURCE.positional_rows:
+        _remap_rows_after_delete(deleted)
+    if deleted:
+        print(f"Архивировано строк: {len(deleted)} (лист '{ARCHIVE_SHEET_TITLE}').")
+    return len(deleted)
+
+# --- 4.8. ДОГОНЯЮЩАЯ ПУБЛИКАЦИЯ ПОСЛЕ ПРОСТОЯ ---
+
+# Строка, опоздавшая не больше CATCHUP_ON_TIME_SEC, публикуется сразу, как обычно.
+# Более поздние (отставание после простоя) идут по столбцу «Приоритет» (больше — раньше),
+# затем по времени (newest — свежие первыми), не чаще CATCHUP_RATE_PER_MIN (0 — без ограничения).
+# Опоздавшие больше CATCHUP_MAX_LATENESS_MIN минут (0 — без порога) по CATCHUP_STALE_ACTION:
+# flag — пометить в «Отправлено» значением CATCHUP_STALE_MARK, drop — только пропустить,
+# post — опубликовать всё равно. О пропущенных строках — одно сводное уведомление за цикл.
+CATCHUP_ON_TIME_SEC = int(ENV.get("CATCHUP_ON_TIME_SEC", str(max(60, 2 * REFRESH_SECONDS))))
+CATCHUP_RATE_PER_MIN = int(ENV.get("CATCHUP_RATE_PER_MIN", "4"))
+CATCHUP_ORDER = ENV.get("CATCHUP_ORDER", "newest").strip().lower()
+CATCHUP_MAX_LATENESS_MIN = int(ENV.get("CATCHUP_MAX_LATENESS_MIN", "0"))
+CATCHUP_STALE_ACTION = ENV.get("CATCHUP_STALE_ACTION", "flag").strip().lower()
+CATCHUP_STALE_MARK = ENV.get("CATCHUP_STALE_MARK", "ПРОСРОЧЕНО")
+
+# Запас токенов — на один цикл опроса, чтобы отставание расходовалось равномерно
+CATCHUP_BUCKET = TokenBucket(
+    CATCHUP_RATE_PER_MIN, burst=max(1, round(CATCHUP_RATE_PER_MIN * REFRESH_SECONDS / 60))
+)
+CATCHUP_STATE = {"backlog": 0}
+# Просроченные строки, о которых уже сообщили: {row_idx: fingerprint}
+STALE_ROWS = {}
+
+def _is_stale_marked(record) -> bool:
+    sent_flag = record.get("Отправлено", record.get("отправлено", ""))
+    return bool(CATCHUP_STALE_MARK) and str(sent_flag).strip().upper() == CATCHUP_STALE_MARK.upper()
+
+def _row_priority(record) -> float:
+    try:
+        return float(str(record.get("Приоритет", "") or 0).replace(",", ".").replace(" ", ""))
+    except ValueError:
+        return 0.0
+
+def _plan_due_rows(now):
+    """Созревшие строки: (вовремя — в порядке листа, отставание — по приоритету, просроченные)."""
+    on_time, backlog, stale = [], [], []
+    grace = timedelta(seconds=CATCHUP_ON_TIME_SEC)
+    max_late = timedelta(minutes=CATCHUP_MAX_LATENESS_MIN) if CATCHUP_MAX_LATENESS_MIN > 0 else None
+    for idx in sorted(RECORD_CACHE):
+        record = RECORD_CACHE.get(idx)
+        if record is None:
+            continue
+        sched = _scheduled_time(idx, record)
+        if sched is None or sched > now:
+            continue
+        late = now - sched
+        if max_late is not None and late > max_late and CATCHUP_STALE_ACTION != "post":
+            stale.append((idx, record, sched))
+        elif late <= grace or CATCHUP_RATE_PER_MIN <= 0:
+            on_time.append((idx, record, sched))
+        else:
+            backlog.append((idx, record, sched))
+    direction = -1 if CATCHUP_ORDER == "newest" else 1
+    backlog.sort(key=lambda it: (-_row_priority(it[1]), direction * it[2].timestamp(), it[0]))
+    return on_time, backlog, stale
+
+def _handle_stale_rows(stale, now):
+    """Пометить/пропустить просроченные строки и сообщить о них одним сообщением."""
+    reported = []
+    for idx, record, sched in stale:
+        fp = _row_fingerprint(record)
+        if STALE_ROWS.get(idx) == fp:
+            continue
+        STALE_ROWS[idx] = fp
+        reported.append((idx, sched))
+        if CATCHUP_STALE_ACTION != "flag":
+            continue
+        for fname in ("Отправлено", "отправлено"):
+            if _queue_write(idx, fname, CATCHUP_STALE_MARK):
+                record[fname] = CATCHUP_STALE_MARK
+                break
+    if not reported:
+        return
+    action = f"помечены «{CATCHUP_STALE_MARK}»" if CATCHUP_STALE_ACTION == "flag" else "пропущены"
+    rows = ", ".join(str(idx) for idx, _ in reported[:30]) + (" …" if len(reported) > 30 else "")
+    oldest = max(now - sched for _, sched in reported)
+    msg = (f"Просроченные строки (опоздание > {CATCHUP_MAX_LATENESS_MIN} мин, максимум "
+           f"{int(oldest.total_seconds() // 60)} мин) {action}: {len(reported)} шт. — {rows}")
+    logging.warning(msg)
+    tg_notify(f"🗑 {msg}")
+
+# --- 4.9. ПРЕДВАРИТЕЛЬНАЯ ПРОВЕРКА СТРОК (preflight) ---
+
+# Фоновая задача заранее проверяет неотправленные строки, время которых наступит в ближайшие
+# PREFLIGHT_HORIZON_HOURS (0 — выключено): формат «Время», контакты, наличие и доступность медиа.
+# Итог пишется пачкой в столбец PREFLIGHT_STATUS_COLUMN (если он есть в листе), о новых
+# проблемах — одно сводное уведомление. Медиа строк, которые выйдут в ближайшие
+# PREFLIGHT_PREFETCH_MIN минут, скачиваются заранее в MEDIA_CACHE.
+PREFLIGHT_HORIZON_HOURS = float(ENV.get("PREFLIGHT_HORIZON_HOURS", "24"))
+PREFLIGHT_INTERVAL_SECONDS = int(ENV.get("PREFLIGHT_INTERVAL_SECONDS", "120"))
+PREFLIGHT_STATUS_COLUMN = ENV.get("PREFLIGHT_STATUS_COLUMN", "Проверка")
+PREFLIGHT_PREFETCH_MIN = int(ENV.get("PREFLIGHT_PREFETCH_MIN", "10"))
+PREFLIGHT_MEDIA_TIMEOUT = float(ENV.get("PREFLIGHT_MEDIA_TIMEOUT", "10"))
+PREFLIGHT_CONCURRENCY = int(ENV.get("PREFLIGHT_CONCURRENCY", "4"))
+
+# Результаты проверки: {row_idx: {"fp", "valid", "status", "recheck", "written"}}.
+# valid — проверки содержимого пройдены (send_post их не повторяет); recheck — итог
+# зависит от сети (недоступные медиа), поэтому строка проверяется снова на следующем проходе
+PREFLIGHT = {}
+
+def _probe_media_url(url: str) -> bool:
+    """Доступен ли файл (с подбором расширения, как при скачивании). Тело не читается."""
+    for candidate in [url] + (_swap_media_extension(url) or []):
+        try:
+            with HTTP.get(candidate, stream=True, timeout=(5, PREFLIGHT_MEDIA_TIMEOUT)) as resp:
+                if resp.ok:
+                    return True
+        except Exception:
+            continue
+    return False
+
+def _preflight_row(idx, record, fp, prefetch: bool, cached):
+    """Проверить строку (выполняется в потоке, кэши не трогает). cached — число файлов
+    строки, уже лежащих в MEDIA_CACHE, или None. Возвращает запись для PREFLIGHT;
+    заранее скачанные медиа — в ключе "media"."""
+    time_str = str(record.get("Время", "") or "").strip()
+    try:
+        datetime.strptime(time_str, "%d.%m.%Y %H:%M:%S")
+    except ValueError:
+        # «Время» не входит в отпечаток строки: исправление времени его не меняет,
+        # поэтому такую ошибку перепроверяем на каждом проходе (это дёшево, без сети)
+        return {"fp": fp, "valid": False, "recheck": True, "time_error": True,
+                "status": f"ОШИБКА: неверный формат времени '{time_str}' (нужно ДД.ММ.ГГГГ ЧЧ:ММ:СС)"}
+
+    reason = _validate_post(record)
+    if reason:
+        return {"fp": fp, "valid": False, "recheck": False, "status": f"ОШИБКА: {reason}"}
+
+    warnings = []
+    telegram_link = str(record.get("Telegram", "") or "").strip()
+    whatsapp_link = str(record.get("WhatsApp", "") or "").strip()
+    if telegram_link and not _tg_username_from_contact(telegram_link):
+        warnings.append("Telegram не распознан — ссылка останется как в таблице")
+    if whatsapp_link and not _wa_number_from_contact(whatsapp_link):
+        warnings.append("номер WhatsApp не распознан — ссылка останется как в таблице")
+
+    media_urls = _post_media_urls(record)
+    required = _required_media_count(record)
+    media_data = None
+    if cached is not None:
+        reachable = cached
+    elif prefetch:
+        media_data = _download_post_media(media_urls, idx, quiet=True)
+        reachable = len(media_data)
+    else:
+        reachable = sum(1 for url in media_urls if _probe_media_url(url))
+
+    if reachable < required:
+        return {"fp": fp, "valid": True, "recheck": True,
+                "status": f"ОШИБКА: доступно {reachable} из {len(media_urls)} медиа, нужно {required}"}
+    media_missing = reachable < len(media_urls)
+    if media_missing:
+        warnings.append(f"недоступно {len(media_urls) - reachable} из {len(media_urls)} медиа")
+    status = "OK" if not warnings else "ВНИМАНИЕ: " + "; ".join(warnings)
+    return {"fp": fp, "valid": True, "recheck": media_missing, "status": status, "media": media_data}
+
+def _preflight_row_current(idx, fp) -> bool:
+    """Строка idx всё ещё содержит проверенную версию (не изменена и не сдвинута архивацией)."""
+    record = RECORD_CACHE.get(idx)
+    return record is not None and _row_fingerprint(record) == fp
+
+async def _preflight_username(record, result):
+    """Проверка, что Telegram-username существует (нужен клиент, поэтому не в потоке проверки)."""
+    username = CONTACTS.tg_username(record.get("Telegram", ""))
+    if not username:
+        return
+    exists = await CONTACTS.username_exists(username)
+    if exists is None and _TG_USERNAME_RE.fullmatch(username):
+        result["recheck"] = True  # лимит запросов — проверим на следующем проходе
+    elif exists is False:
+        warning = f"Telegram @{username} не существует — ссылка «Связь в Telegram» не откроется"
+        status = result["status"]
+        result["status"] = f"{status}; {warning}" if status.startswith("ВНИМАНИЕ") else f"ВНИМАНИЕ: {warning}"
+
+async def preflight_pass(now=None) -> int:
+    """Один проход проверки. Возвращает число проверенных строк."""
+    now = now or datetime.now(tz)
+    horizon = now + timedelta(hours=PREFLIGHT_HORIZON_HOURS)
+    prefetch_until = now + timedelta(minutes=PREFLIGHT_PREFETCH_MIN)
+    todo = []
+    for idx in sorted(RECORD_CACHE):
+        record = RECORD_CACHE.get(idx)
+        if record is None or not str(record.get("Имя", "")).strip():
+            continue
+        if _is_sent(record) or _is_stale_marked(record):
+            continue
+        try:
+            sched = tz.localize(datetime.strptime(str(record.get("Время", "")).strip(), "%d.%m.%Y %H:%M:%S"))
+        except ValueError:
+            sched = None  # неверное время — тоже результат проверки
+        if sched is not None and sched > horizon:
+            continue
+        fp = _row_fingerprint(record)
+        prefetch = sched is not None and sched <= prefetch_until and PREFLIGHT_PREFETCH_MIN > 0
+        prev = PREFLIGHT.get(idx)
+        if prev and prev["fp"] == fp and not prev["recheck"]:
+            if not (prefetch and MEDIA_CACHE.get(fp) is None):
+                continue
+        todo.append((idx, record, fp, prefetch))
+    if not todo:
+        return 0
+
+    # Пул общий с загрузкой медиа публикуемых постов (и с другими арендаторами) — квота
+    # предпроверки действует на весь процесс и оставляет хотя бы один поток для медиа
+    IO_POOL.limit("preflight", PREFLIGHT_CONCURRENCY)
+
+    async def check(idx, record, fp, prefetch):
+        cached = MEDIA_CACHE.get(fp)
+        return idx, await IO_POOL.run(
+            "preflight", _preflight_row, idx, record, fp, prefetch, None if cached is None else len(cached)
+        )
+
+    results = await asyncio.gather(*(check(*item) for item in todo), return_exceptions=True)
+    records = {idx: record for idx, record, _, _ in todo}
+
+    updates, problems = [], []
+    for res in results:
+        if isinstance(res, Exception):
+            logging.warning(f"Предпроверка: ошибка проверки строки: {res}")
+            continue
+        idx, result = res
+        if CONTACT_RESOLVE_USERNAMES and result["valid"] and not result["status"].startswith("ОШИБКА"):
+            await _preflight_username(records[idx], result)
+        if not _preflight_row_current(idx, result["fp"]):
+            continue  # строку изменили или сдвинули (архивация) — проверим на следующем проходе
+        media_data = result.pop("media", None)
+        if media_data:
+            MEDIA_CACHE.put(result["fp"], media_data, weight=sum(len(d) for d, _ in media_data))
+        prev = PREFLIGHT.get(idx) or {}
+        result["written"] = prev.get("written")
+        PREFLIGHT[idx] = result
+        if result["valid"]:
+            ROW_INVALID.pop(idx, None)
+        elif not result.get("time_error"):
+            # Содержимое не пройдёт и при публикации — send_post пропустит строку без повторного уведомления.
+            # Ошибку времени сюда не кладём: ключ — отпечаток без «Время», и исправленное время
+            # не сняло бы отметку
+            ROW_INVALID[idx] = (result["fp"], result["status"])
+        if result["status"] != result["written"]:
+            updates.append((idx, PREFLIGHT_STATUS_COLUMN, result["status"]))
+            if not result["status"].startswith("OK") and result["status"] != prev.get("status"):
+                problems.append((idx, result["status"]))
+
+    # Номера строк могли сдвинуться, пока шли проверки, — пишем только в те же строки
+    checked = {idx: fp for idx, _, fp, _ in todo}
+    updates = [u for u in updates if _preflight_row_current(u[0], checked[u[0]])]
+    if updates and get_col_index(PREFLIGHT_STATUS_COLUMN, warn=False):
+        try:
+            await SOURCE.write_cells(updates)
+            for idx, _, status in updates:
+                entry = PREFLIGHT.get(idx)
+                if entry and entry["fp"] == checked[idx]:
+                    entry["written"] = status
+        except Exception as e:
+            logging.warning(f"Предпроверка: не удалось записать столбец '{PREFLIGHT_STATUS_COLUMN}': {e}")
+    if problems:
+        lines = "\n".join(f"Строка {idx}: {status}" for idx, status in problems[:20])
+        more = f"\n… и ещё {len(problems) - 20}" if len(problems) > 20 else ""
+        logging.warning(f"Предпроверка: проблемы в {len(problems)} строках")
+        tg_notify(f"🔎 Предпроверка: проблемы в {len(problems)} строках\n{lines}{more}")
+    return len(todo)
+
+async def preflight_loop():
+    await asyncio.sleep(min(PREFLIGHT_INTERVAL_SECONDS, 10))  # первый полный опрос листа
+    while True:
+        try:
+            checked = await preflight_pass()
+            if checked:
+                print(f"Предпроверка: проверено строк {checked}.")
+        except Exception as e:
+            logging.error(f"Ошибка предпроверки строк: {e}", exc_info=True)
+        await asyncio.sleep(PREFLIGHT_INTERVAL_SECONDS)
 
 # --- 5. ГЛАВНЫЙ ЦИКЛ ПРОГРАММЫ ---
 
+# Последнее известное содержимое строк листа: {row_idx: record}.
+# Полный опрос заменяет его целиком, webhook — обновляет отдельные строки.
+RECORD_CACHE = {}
+
+# Счётчики главного цикла (в мультиарендном режиме — свои у каждого арендатора)
+CYCLE_STATS = {"cycles": 0, "errors": 0, "posted": 0, "restarts": 0, "last_cycle": None}
+
+# Подключение клиентов арендаторы выполняют по очереди: общий клиент не должен
+# подключаться из двух задач одновременно
+_STARTUP_LOCK = SHARED.setdefault("startup_lock", asyncio.Lock())
+
+def tenant_status() -> str:
+    """Однострочная сводка для периодического лога хоста."""
+    last = CYCLE_STATS["last_cycle"]
+    usage = SHEETS.usage.snapshot()["last_minute"] if SHEETS else None
+    parts = [
+        f"циклов {CYCLE_STATS['cycles']}, ошибок {CYCLE_STATS['errors']}, перезапусков {CYCLE_STATS['restarts']}",
+        f"опубликовано {CYCLE_STATS['posted']}",
+        f"строк в кэше {len(RECORD_CACHE)}",
+        f"последний цикл {last.strftime('%H:%M:%S') if last else '—'}",
+    ]
+    if usage:
+        parts.append(f"Sheets/мин: чтений {usage['reads']}, записей {usage['writes']}, 429: {usage['throttled']}")
+    hit_rates = ", ".join(
+        f"{name} {st['hit_rate']:.0%}" for name, st in cache_stats().items() if st["hit_rate"] is not None
+    )
+    if hit_rates:
+        parts.append(f"попадания в кэши: {hit_rates}")
+    pool = IO_POOL.snapshot()
+    if pool["stages"]:
+        waits = ", ".join(f"{name} {st['wait_ms_avg']:.0f}/{st['run_ms_avg']:.0f} мс" for name, st in pool["stages"].items())
+        parts.append(f"пул ввода-вывода: очередь {pool['queued']} (макс {pool['max_queued']}), ожидание/работа {waits}")
+    return "; ".join(parts)
+
+def _active_channels() -> List[int]:
+    # Берём все настроенные каналы (табличные флаги не используем)
+    return [acc["index"] for acc in accounts if acc.get("channel") and acc["index"] in CLIENT_BY_INDEX]
+
+def _scheduled_time(idx, record):
+    """Время публикации строки или None, если строку публиковать не нужно."""
+    if not str(record.get("Имя", "")).strip():
+        return None
+
+    # Глобальный флаг "Отправлено": если TRUE (или строка помечена просроченной) — пропускаем запись
+    if _is_sent(record) or _is_stale_marked(record):
+        return None
+
+    # Строка не менялась с прошлой неудачной проверки — не проверяем и не рендерим заново
+    invalid = ROW_INVALID.get(idx)
+    if invalid and invalid[0] == ROW_FINGERPRINTS.get(idx):
+        return None
+
+    time_str = record.get("Время")
+    if not time_str:
+        return None
+    try:
+        return tz.localize(datetime.strptime(time_str, "%d.%m.%Y %H:%M:%S"))
+    except ValueError:
+        print(f"ПРЕДУПРЕЖДЕНИЕ: Неверный формат времени в строке {idx}: '{time_str}'. Ожидается 'ДД.ММ.ГГГГ ЧЧ:ММ:СС'.")
+        return None
+
+async def _process_record(idx, record, now, refreshed=False):
+    """Проверить одну строку и, если пришло время, опубликовать её."""
+    sched_time = _scheduled_time(idx, record)
+    if sched_time is None or sched_time > now:
+        return
+    active_idx = _active_channels()
+    if not active_idx:
+        return
+
+    try:
+        if SHEET_WEBHOOK_PORT and not refreshed:
+            # Кэш мог устареть между уведомлениями — перечитываем строку перед публикацией
+            fresh = dict(await SOURCE.fetch_rows([idx]))
+            if idx in fresh:
+                RECORD_CACHE[idx] = fresh[idx]
+                _note_row_versions([(idx, fresh[idx])])
+                return await _process_record(idx, fresh[idx], now, refreshed=True)
+
+        # Доставка отслеживается по каждому каналу в журнале: повтор идёт только в те каналы,
+        # куда эта версия строки ещё не ушла (без повторного рендера и проверки истории остальных)
+        fp = _row_fingerprint(record)
+        pending = SEND_JOURNAL.pending_channels(idx, fp, active_idx)
+        if not pending:
+            # Все каналы уже получили пост, не записался только флаг — ставим его без отправки
+            _mark_row_sent(idx, record)
+            _queue_delivery_report(idx, fp, active_idx)
+            return
+        if len(pending) < len(active_idx):
+            print(f"Строка {idx}: повтор только для каналов {pending} (остальные уже доставлены).")
+        else:
+            print(f"Найдена запись для отправки в строке {idx}. Каналы: {active_idx}")
+        await send_post(record, idx, pending_indices=pending, scheduled_at=sched_time)
+        _queue_delivery_report(idx, fp, active_idx)
+
+        # Если все каналы успешно отработали — ставим глобальный флаг "Отправлено"
+        if not SEND_JOURNAL.pending_channels(idx, fp, active_idx):
+            CYCLE_STATS["posted"] += 1
+            _mark_row_sent(idx, record)
+    except Exception as e:
+        print(f"ОШИБКА при обработке строки {idx}: {e}")
+
+# Запись в лист копится за цикл и уходит одним batch-запросом (flush_sheet_writes).
+# Если запись флага потеряется, журнал отправок восстановит его на следующем цикле.
+PUBLISH_LINKS_COLUMN = ENV.get("PUBLISH_LINKS_COLUMN", "Ссылки на посты")
+PUBLISH_LATENCY_COLUMN = ENV.get("PUBLISH_LATENCY_COLUMN", "Задержка, сек")
+SHEET_WRITES = {}  # {(row_idx, заголовок): значение} — побеждает последнее
+
+def _queue_write(idx, name, value) -> bool:
+    if not get_col_index(name, warn=False):
+        return False
+    SHEET_WRITES[(idx, name)] = value
+    return True
+
+async def flush_sheet_writes() -> int:
+    if not SHEET_WRITES:
+        return 0
+    updates = [(idx, name, value) for (idx, name), value in SHEET_WRITES.items()]
+    SHEET_WRITES.clear()
+    try:
+        await SOURCE.write_cells(updates)
+    except Exception as e:
+        # Вернуть в очередь (более новые значения, если успели появиться, не перетираем)
+        for idx, name, value in updates:
+            SHEET_WRITES.setdefault((idx, name), value)
+        print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось записать в лист {len(updates)} ячеек: {e}")
+        return 0
+    return len(updates)
+
+def _mark_row_sent(idx, record):
+    for fname in ("Отправлено", "отправлено"):
+        if get_col_index(fname):
+            _queue_write(idx, fname, "TRUE")
+            record[fname] = "TRUE"
+            break
+
+def _queue_delivery_report(idx, fp, channels):
+    """Ссылки на опубликованные сообщения по каналам и задержка публикации — в лист."""
+    lines, latencies = [], []
+    for acc_idx in channels:
+        entry = SEND_JOURNAL.get(idx, acc_idx)
+        if not (entry and entry["status"] == "sent" and entry["fingerprint"] == fp):
+            continue
+        if entry["link"]:
+            where = entry["link"]
+        elif entry["message_id"]:
+            where = f"{ACC_BY_INDEX.get(acc_idx, {}).get('channel')} #{entry['message_id']}"
+        else:
+            where = "уже был в канале"
+        if entry["latency"] is not None:
+            latencies.append(entry["latency"])
+            where += f" (+{entry['latency']:.0f} с)"
+        lines.append(f"TG{acc_idx}: {where}")
+    if lines:
+        _queue_write(idx, PUBLISH_LINKS_COLUMN, "\n".join(lines))
+    if latencies:
+        _queue_write(idx, PUBLISH_LATENCY_COLUMN, round(max(latencies)))
+
+async def _publish_due_rows(now):
+    """Опубликовать созревшие строки: вовремя пришедшие — сразу, отставание после
+    простоя — по приоритету и с ограничением скорости, слишком старые — отбросить."""
+    on_time, backlog, stale = _plan_due_rows(now)
+    for idx, record, _ in on_time:
+        await _process_record(idx, record, now)
+
+    if stale:
+        _handle_stale_rows(stale, now)
+
+    published = 0
+    for idx, record, _ in backlog:
+        if not CATCHUP_BUCKET.try_acquire():
+            break
+        await _process_record(idx, record, now)
+        published += 1
+
+    await flush_sheet_writes()
+
+    waiting = len(backlog) - published
+    if waiting and not CATCHUP_STATE["backlog"]:
+        tg_notify(
+            f"⏳ Догоняю отставание: {len(backlog)} строк с опозданием, "
+            f"публикую не чаще {CATCHUP_RATE_PER_MIN}/мин."
+        )
+    elif not waiting and CATCHUP_STATE["backlog"]:
+        tg_notify("✅ Отставание разобрано.")
+    if waiting:
+        print(f"Догоняющая публикация: опубликовано {published}, в очереди {waiting}.")
+    CATCHUP_STATE["backlog"] = waiting
+
 async def main():
     """Главная функция: подключается к клиентам и запускает бесконечный цикл проверки."""
     if not CLIENT_BY_INDEX:
         print("ОШИБКА: Не настроен ни один TG{n}_SESSION/TG{n}_CHANNEL.")
         return
 
-    await validate_sessions_before_start()
+    async with _STARTUP_LOCK:
+        await validate_sessions_before_start()
 
-    print("Подключение Telegram клиентов...")
-    results = await asyncio.gather(*(c.start() for c in ALL_CLIENTS), return_exceptions=True)
-    for idx, res in enumerate(results, start=1):
-        if isinstance(res, Exception):
-            print(f"ПРЕДУПРЕЖДЕНИЕ: клиент #{idx} не запустился: {res}")
+        print("Подключение Telegram клиентов...")
+        results = await asyncio.gather(*(c.start() for c in ALL_CLIENTS), return_exceptions=True)
+        for idx, res in enumerate(results, start=1):
+            if isinstance(res, Exception):
+                print(f"ПРЕДУПРЕЖДЕНИЕ: клиент #{idx} не запустился: {res}")
+        await validate_custom_emoji()
     print("Клиенты успешно подключены. Запуск основного цикла...")
     tg_notify("🚀 telethon-постер запущен и следит за Google Sheets")
 
+    try:
+        webhook_server = await start_sheet_webhook()
+    except Exception as e:
+        webhook_server = None
+        logging.error(f"Не удалось запустить webhook изменений таблицы: {e}")
+
+    # Ссылка на задачу держит её живой
+    preflight_task = asyncio.create_task(preflight_loop()) if PREFLIGHT_HORIZON_HOURS > 0 else None
+
+    loop = asyncio.get_running_loop()
+    last_full_poll = None
+    changed_watermark = 0.0
+    archive_enabled = ARCHIVE_AFTER_DAYS > 0
+    last_archive = loop.time()
+
     while True:
         try:
             alive = sum(1 for c in ALL_CLIENTS if c.is_connected())
@@ -1081,61 +3713,449 @@ async def main():
                     except Exception as e:
                         print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось переподключить клиента: {e}")
             print(f"Активных клиентов: {alive}/{len(ALL_CLIENTS)}")
-            print(f"Проверка таблицы... {datetime.now(tz).strftime('%H:%M:%S')}")
-            records = worksheet.get_all_records()
-            now = datetime.now(tz)
+            SEND_JOURNAL.maybe_compact()
 
-            for idx, record in enumerate(records, start=2):
-                if not str(record.get("Имя", "")).strip():
-                    continue
+            if archive_enabled and loop.time() - last_archive >= ARCHIVE_INTERVAL_HOURS * 3600:
+                last_archive = loop.time()
+                try:
+                    archived = await archive_sent_rows()
+                    if archived < 0:
+                        archive_enabled = False
+                    elif archived:
+                        last_full_poll = None  # номера строк сдвинулись — перечитываем лист целиком
+                except Exception as e:
+                    logging.error(f"Ошибка архивации отправленных строк: {e}", exc_info=True)
 
-                # Глобальный флаг "Отправлено": если TRUE — пропускаем запись
-                sent_flag = record.get("Отправлено", record.get("отправлено", ""))
-                if str(sent_flag).strip().upper() == "TRUE":
-                    continue
+            changed_rows = ROW_REFRESH_QUEUE.drain()
+            full_due = (
+                last_full_poll is None
+                or not (webhook_server or SOURCE.incremental)
+                or 1 in changed_rows
+                or loop.time() - last_full_poll >= FULL_POLL_SECONDS
+            )
+            if full_due:
+                print(f"Проверка таблицы... {datetime.now(tz).strftime('%H:%M:%S')}")
+                poll_started = time.time()
+                records = await SOURCE.fetch_all()
+                RECORD_CACHE.clear()
+                RECORD_CACHE.update(records)
+                fetched = records
+                for stale in set(ROW_FINGERPRINTS) - set(RECORD_CACHE):
+                    ROW_FINGERPRINTS.pop(stale, None)
+                    ROW_INVALID.pop(stale, None)
+                    STALE_ROWS.pop(stale, None)
+                    PREFLIGHT.pop(stale, None)
+                last_full_poll = loop.time()
+                changed_watermark = poll_started
+            else:
+                fetched = []
+                if SOURCE.incremental:
+                    poll_started = time.time()
+                    for idx, record in await SOURCE.changed_since(changed_watermark):
+                        RECORD_CACHE[idx] = record
+                        fetched.append((idx, record))
+                    changed_watermark = poll_started
+                if changed_rows:
+                    print(f"Адресное обновление строк {sorted(changed_rows)}... {datetime.now(tz).strftime('%H:%M:%S')}")
+                    try:
+                        for idx, record in await SOURCE.fetch_rows(changed_rows):
+                            RECORD_CACHE[idx] = record
+                            fetched.append((idx, record))
+                    except Exception:
+                        # Не потерять уведомление: вернём строки в очередь до следующей попытки
+                        ROW_REFRESH_QUEUE.push(changed_rows)
+                        raise
 
-                # Берём все настроенные каналы (табличные флаги не используем)
-                active_idx = [acc["index"] for acc in accounts if acc.get("channel") and acc["index"] in CLIENT_BY_INDEX]
-                if not active_idx:
-                    continue
+            n_changed = _note_row_versions(fetched)
+            if fetched:
+                print(f"Строк изменено с прошлого цикла: {n_changed}")
 
-                time_str = record.get("Время")
-                if not time_str:
-                    continue
+            await _publish_due_rows(datetime.now(tz))
+            # Все строки, которые могли уйти до рестарта, уже сверены — дальше хватает журнала
+            SEND_JOURNAL.fresh = False
 
-                try:
-                    sched_time = datetime.strptime(time_str, "%d.%m.%Y %H:%M:%S")
-                    sched_time = tz.localize(sched_time)
-
-                    if sched_time <= now:
-                        print(f"Найдена запись для отправки в строке {idx}. Каналы: {active_idx}")
-                        ok, success_idx = await send_post(record, idx, pending_indices=active_idx)
-
-                        # Если все каналы успешно отработали — ставим глобальный флаг "Отправлено"
-                        if ok == len(active_idx):
-                            for fname in ("Отправлено", "отправлено"):
-                                col_idx = get_col_index(fname)
-                                if col_idx:
-                                    try:
-                                        worksheet.update_cell(idx, col_idx, "TRUE")
-                                        break
-                                    except Exception as e_upd:
-                                        print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось обновить глобальный флаг '{fname}' (строка {idx}): {e_upd}")
-                except ValueError:
-                    print(f"ПРЕДУПРЕЖДЕНИЕ: Неверный формат времени в строке {idx}: '{time_str}'. Ожидается 'ДД.ММ.ГГГГ ЧЧ:ММ:СС'.")
-                except Exception as e:
-                    print(f"ОШИБКА при обработке строки {idx}: {e}")
+            CYCLE_STATS["cycles"] += 1
+            CYCLE_STATS["last_cycle"] = datetime.now(tz)
 
-            await asyncio.sleep(REFRESH_SECONDS)
+            interval = SHEETS.poll_interval(REFRESH_SECONDS) if SHEETS else REFRESH_SECONDS
+            if interval != REFRESH_SECONDS:
+                print(f"Бюджет Sheets на исходе — следующий опрос через {interval:.0f} сек.")
+            await ROW_REFRESH_QUEUE.wait(interval)
 
-        except gspread.exceptions.APIError as e:
-            logging.error(f"ОШИБКА API Google Sheets: {e}. Повторная попытка через {REFRESH_SECONDS} сек.", exc_info=True)
+        except asyncio.TimeoutError:
+            CYCLE_STATS["errors"] += 1
+            logging.error(f"Google Sheets не ответил за {SHEETS_CALL_TIMEOUT:.0f} сек. Повторная попытка через {REFRESH_SECONDS} сек.")
             await asyncio.sleep(REFRESH_SECONDS)
+        except gspread.exceptions.APIError as e:
+            CYCLE_STATS["errors"] += 1
+            interval = SHEETS.poll_interval(REFRESH_SECONDS) if SHEETS else REFRESH_SECONDS
+            logging.error(f"ОШИБКА API Google Sheets: {e}. Повторная попытка через {interval:.0f} сек.", exc_info=True)
+            await asyncio.sleep(interval)
         except Exception as e:
+            CYCLE_STATS["errors"] += 1
             logging.critical(f"КРИТИЧЕСКАЯ ОШИБКА в главном цикле: {e}", exc_info=True)
             await asyncio.sleep(REFRESH_SECONDS)
 
+# --- 5.5. ОФЛАЙН-БЕНЧМАРКИ (python telethon-poster.py --bench-...) ---
+
+_BENCH_HEADER = [
+    "Имя", "Английское Имя", "Статус", "Время", "Отправлено", "Услуги", "Доп. услуги",
+    "Возраст", "Рост", "Вес", "Грудь", "Express", "Incall", "Outcall",
+    "WhatsApp", "Telegram", "Примечание", "Национальность", "Количество",
+] + [f"Ссылка {i}" for i in range(1, 11)] + ["Комментарий менеджера", "Источник", "Телефон для связи"]
+
+def _synthetic_sheet(n_rows: int, seed: int = 1):
+    """Синтетический лист в виде get_all_values: заголовок + n_rows строк строковых значений."""
+    rnd = random.Random(seed)
+    names = ["Анна", "Мария", "Ева", "Александра", "Виктория", "Анастасия-Мария", "Лилит", "Ани"]
+    statuses = ["NEW", "TOP", "VIP", "Только приехала"]
+    rows = [list(_BENCH_HEADER)]
+    for i in range(n_rows):
+        sent = "TRUE" if rnd.random() < 0.8 else ""
+        row = {
+            "Имя": rnd.choice(names), "Статус": rnd.choice(statuses),
+            "Время": f"{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.2025 {rnd.randint(0, 23):02d}:00:00",
+            "Отправлено": sent, "Услуги": "массаж\nсауна\nвыезд", "Возраст": str(rnd.randint(20, 35)),
+            "Рост": str(rnd.randint(155, 180)), "Вес": str(rnd.randint(45, 65)), "Грудь": str(rnd.randint(1, 4)),
+            "Express": "30", "Incall": "40,5", "Outcall": "1 500",
+            "WhatsApp": f"+374 99 {rnd.randint(100000, 999999)}", "Telegram": f"@user{i}",
+            "Национальность": "🇦🇲", "Количество": str(rnd.randint(1, 4)),
+            "Комментарий менеджера": "созвонились", "Источник": "instagram",
+        }
+        for k in range(1, rnd.randint(2, 10)):
+            row[f"Ссылка {k}"] = f"https://cdn.example.com/{i}/{k}.jpg"
+        rows.append([row.get(h, "") for h in _BENCH_HEADER])
+    return rows
+
+def _bench(fn, repeat: int = 5) -> float:
+    """Лучшее время из repeat запусков (сек.)."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def bench_parse(n_rows: int = 10000):
+    """Разбор листа: путь get_all_records (numericise_all + to_records) против PostRow-парсера.
+    Все варианты разбирают одни и те же строки; отбор неотправленных измеряется отдельно."""
+    values = _synthetic_sheet(n_rows)
+    header, rows = values[0], values[1:]
+
+    def via_get_all_records():
+        return gspread.utils.to_records(header, [gspread.utils.numericise_all(r) for r in rows])
+
+    def via_to_records():
+        return gspread.utils.to_records(header, rows)
+
+    def via_lean_parser():
+        return _records_from_values(header, rows)
+
+    def via_lean_unsent():
+        return _records_from_values(header, rows, unsent_only=True)
+
+    t_old = _bench(via_get_all_records)
+    t_dicts = _bench(via_to_records)
+    t_new = _bench(via_lean_parser)
+    t_unsent = _bench(via_lean_unsent)
+    kept = len(via_lean_unsent())
+    per = lambda t: f"{t * 1000:8.1f} мс  ({t / n_rows * 1e6:.2f} мкс/строка)"
+    print(f"Разбор {n_rows} строк × {len(header)} столбцов (все строки, одинаковый вход):")
+    print(f"  get_all_records (numericise + dict): {per(t_old)}")
+    print(f"  to_records без numericise:           {per(t_dicts)}")
+    print(f"  PostRow-парсер:                      {per(t_new)}")
+    print(f"  ускорение PostRow: ×{t_old / max(t_new, 1e-9):.1f} к get_all_records, "
+          f"×{t_dicts / max(t_new, 1e-9):.1f} к to_records без numericise")
+    print(f"Отбор неотправленных (отдельно): PostRow + фильтр {per(t_unsent)}, "
+          f"строк в памяти: {kept} из {n_rows}")
+
+def bench_render(n_rows: int = 2000):
+    """Рендер подписи (текст + сущности): стоимость на строку и доли этапов."""
+    values = _synthetic_sheet(n_rows, seed=2)
+    records = [r for _, r in _records_from_values(values[0], values[1:])]
+    link = f"https://t.me/{POST_LINK_CHANNEL_SLUG}/12345"
+
+    t_full = _bench(lambda: [_render_post(r, link) for r in records])
+    t_links = _bench(lambda: [_dm_links(r, link) for r in records])
+    t_crown = _bench(lambda: [_crown_indent(r.get("Имя", "")) for r in records])
+    t_measure = _bench(lambda: [_measure_crown_indent(_strip_tags(r.get("Имя", ""))) for r in records])
+    per = lambda t: t / n_rows * 1e6
+    print(f"Рендер {n_rows} строк (скомпилированный шаблон):")
+    print(f"  подпись целиком:  {per(t_full):8.1f} мкс/строка")
+    print(f"  из них DM-ссылки: {per(t_links):8.1f} мкс/строка")
+    print(f"  из них корона:    {per(t_crown):8.1f} мкс/строка (без кэша {per(t_measure):.1f})")
+    crown = CROWN_INDENT_CACHE.stats()
+    print(f"  кэш короны: {crown['items']} имён, попаданий {crown['hits']}, промахов {crown['misses']}")
+
+def _render_corpus(n_rows: int, seed: int = 3):
+    """Тяжёлые для рендера строки: кириллические имена разной длины, длинные услуги,
+    много эмодзи, разметка и «&» в примечаниях, цены в разных форматах."""
+    rnd = random.Random(seed)
+    syllables = ["ан", "на", "ма", "ри", "я", "ле", "ка", "те", "ри", "на", "ви", "кто", "ия", "лу", "иза"]
+    emoji = ["🔥", "💋", "🌹", "✨", "💎", "🍓", "🇦🇲", "🇷🇺", "❤️", "😘"]
+    services = ["массаж", "классика", "сауна", "выезд", "ролевые игры", "стриптиз", "эскорт на мероприятия"]
+    rows = [list(_BENCH_HEADER)]
+    for i in range(n_rows):
+        name = "".join(rnd.choice(syllables) for _ in range(rnd.randint(1, 6))).capitalize()
+        if rnd.random() < 0.3:
+            name += "-" + "".join(rnd.choice(syllables) for _ in range(rnd.randint(1, 5))).capitalize()
+        if rnd.random() < 0.2:
+            name += " " + rnd.choice(emoji)
+        lines = [f"{rnd.choice(emoji)} {rnd.choice(services)} {rnd.choice(emoji) * rnd.randint(0, 3)}"
+                 for _ in range(rnd.randint(5, 30))]
+        row = {
+            "Имя": name, "Статус": rnd.choice(["NEW", "TOP 🔥", "VIP 💎💎", "Только приехала ✨"]),
+            "Время": "01.01.2026 12:00:00", "Услуги": "\r\n".join(lines),
+            "Доп. услуги": "\n".join(rnd.sample(services, 3)),
+            "Возраст": str(rnd.randint(20, 35)), "Рост": str(rnd.randint(155, 180)),
+            "Вес": str(rnd.randint(45, 65)), "Грудь": str(rnd.randint(1, 4)),
+            "Express": rnd.choice(["30", "40,5", "1.5", ""]), "Incall": rnd.choice(["40", "50 000", "дог."]),
+            "Outcall": rnd.choice(["1 500", "100", ""]),
+            "WhatsApp": rnd.choice([f"+374 (99) {rnd.randint(100000, 999999)}", f"wa.me/37499{rnd.randint(100000, 999999)}", ""]),
+            "Telegram": rnd.choice([f"@user_{i}", f"https://t.me/user_{i}?start=1", ""]) or f"@u{i}x",
+            "Примечание": rnd.choice(["", "только <b>вечером</b> & по записи 🌙", "ℹ️ " + " ".join(rnd.choice(emoji) for _ in range(8))]),
+            "Национальность": rnd.choice(["🇦🇲", "🇷🇺 ", ""]), "Английское Имя": rnd.choice(["", "Anna"]),
+            "Количество": "2", "Ссылка 1": f"https://cdn.example.com/{i}/1.jpg", "Ссылка 2": f"https://cdn.example.com/{i}/2.mp4",
+        }
+        rows.append([row.get(h, "") for h in _BENCH_HEADER])
+    return [record for _, record in _records_from_values(rows[0], rows[1:])]
+
+def _bench_case(fn, items, repeat: int = 5) -> dict:
+    """Скорость fn на каждом элементе и память в пересчёте на строку:
+    retained_blocks — блоки, оставшиеся живыми после прогона (результаты и заполненные кэши);
+    peak_bytes — пик памяти одного вызова сверх уже занятой, включая короткоживущие объекты.
+    tracemalloc видит только живые блоки, поэтому число всех выделений он не даёт — временные
+    выделения отражает пик каждого вызова."""
+    n = len(items)
+    best = _bench(lambda: [fn(x) for x in items], repeat)
+    tracemalloc.start()
+    try:
+        out, peaks = [], 0
+        for x in items:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            out.append(fn(x))
+            peaks += tracemalloc.get_traced_memory()[1] - before
+        retained = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    finally:
+        tracemalloc.stop()
+    del out
+    return {"ops_per_sec": round(n / max(best, 1e-9)), "us_per_row": round(best / n * 1e6, 2),
+            "retained_blocks_per_row": round(retained / n, 1), "peak_bytes_per_row": round(peaks / n)}
+
+def bench_suite(n_rows: int = 1000):
+    """Микробенчмарки пути рендера на корпусе тяжёлых строк; результат — в JSON (--json=...)."""
+    records = _render_corpus(n_rows)
+    link = f"https://t.me/{POST_LINK_CHANNEL_SLUG}/12345"
+    names = [r.get("Имя", "") for r in records]
+    plain_names = [_strip_tags(n) for n in names]
+    prices = [r.get(h, "") for r in records for h in ("Express", "Incall", "Outcall") if _present(r.get(h, ""))]
+    contacts = [(r.get("Telegram", ""), r.get("WhatsApp", "")) for r in records]
+    notes = [str(r.get("Примечание", "")) for r in records]
+    html = [CustomHtml.unparse(text, list(entities)) for text, entities in (_render_post(r, link) for r in records)]
+
+    def field(value):
+        c = _Caption()
+        c.field(value)
+        return c.build()
+
+    cases = {
+        "text_width": (_text_width_px, plain_names),
+        "crown_cold": (_measure_crown_indent, plain_names),
+        "crown_cached": (_crown_indent, names),
+        "price_format": (_fmt_price, prices),
+        "contacts_parse": (lambda tw: (_parse_tg_username(tw[0]), _parse_wa_number(tw[1])), contacts),
+        "contacts_cached": (lambda tw: (CONTACTS.tg_username(tw[0]), CONTACTS.wa_number(tw[1])), contacts),
+        "dm_links": (lambda r: _dm_links(r, link), records),
+        "markup_field": (field, notes),
+        "caption_body": (POST_RENDERER.body, records),
+        "caption_full": (lambda r: _render_post(r, link), records),
+        # Повтор строки: столько строк, сколько помещается в RENDER_CACHE (иначе меряется вытеснение)
+        "caption_cached": (lambda r: _rendered_post(_row_fingerprint(r), r, link), records[:RENDER_CACHE_SIZE]),
+        # Прежний путь отправки (HTML -> CustomHtml.parse в Telethon) — для сравнения
+        "html_parse_reference": (CustomHtml.parse, html),
+    }
+    results = {}
+    print(f"Рендер: {n_rows} строк, таблица ширин глифов: {'да' if _GLYPH_TABLE is not None else 'нет'}")
+    print(f"  {'случай':<22}{'оп/с':>12}{'мкс/строка':>12}{'живых бл/стр':>14}{'пик Б/вызов':>13}")
+    for name, (fn, items) in cases.items():
+        res = results[name] = _bench_case(fn, items)
+        print(f"  {name:<22}{res['ops_per_sec']:>12}{res['us_per_row']:>12.2f}"
+              f"{res['retained_blocks_per_row']:>14.1f}{res['peak_bytes_per_row']:>13}")
+
+    out = _cli_value("json", "bench_results.json")
+    report = {
+        "created": datetime.now(tz).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "rows": n_rows,
+        "glyph_table": _GLYPH_TABLE is not None,
+        "cases": results,
+    }
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {out}")
+
+def run_benchmarks(mode: str) -> int:
+    benches = {
+        "--bench-parse": bench_parse,
+        "--bench-render": bench_render,
+        "--bench-suite": bench_suite,
+    }
+    fn = benches.get(mode)
+    if fn is None:
+        print(f"Неизвестный бенчмарк {mode}. Доступны: {', '.join(benches)}")
+        return 2
+    fn()
+    return 0
+
+# --- 5.6. ПРОБНЫЙ ПРОГОН (python telethon-poster.py --dry-run) ---
+# Весь путь send_post до отправки — проверка, DM-ссылки, подпись, загрузка медиа —
+# без Telegram: итоговый текст/сущности и время каждого этапа по строкам.
+#   --file=posts.csv   читать CSV/XLSX вместо источника из RECORD_SOURCE/GSHEET_ID
+#   --rows=2,5-7       только эти строки (по умолчанию — все неотправленные)
+#   --all              включая отправленные
+#   --no-download      не скачивать медиа (только список ссылок)
+#   --json=report.json сохранить отчёт в JSON
+
+DRY_RUN_POST_LINK = f"https://t.me/{POST_LINK_CHANNEL_SLUG or 'channel'}/0"  # номер следующего поста неизвестен офлайн
+
+def _cli_value(name: str, default=None):
+    """Значение опции --name=value из командной строки."""
+    prefix = f"--{name}="
+    return next((a[len(prefix):] for a in sys.argv[1:] if a.startswith(prefix)), default)
+
+def _parse_row_spec(spec: str) -> set:
+    """'2,5-7' -> {2, 5, 6, 7}"""
+    rows = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if part:
+            first, _, last = part.partition("-")
+            rows.update(range(int(first), int(last or first) + 1))
+    return rows
+
+def _entity_dict(e) -> dict:
+    d = e.to_dict()
+    d["type"] = d.pop("_").replace("MessageEntity", "")
+    return d
+
+def _dry_run_row(idx, record, download: bool) -> dict:
+    """Этапы send_post для одной строки; время этапов — в мс."""
+    timings = {}
+    report = {"row": idx, "name": _strip_tags(record.get("Имя", "")), "timings_ms": timings}
+
+    def stage(name, fn, *args):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        timings[name] = round((time.perf_counter() - t0) * 1000, 3)
+        return result
+
+    reason = stage("validate", _validate_post, record)
+    if reason:
+        report["status"] = f"ОШИБКА: {reason}"
+        timings["total"] = timings["validate"]
+        return report
+    links = stage("links", _dm_links, record, DRY_RUN_POST_LINK)
+    text, entities = stage("render", POST_RENDERER, record, links)
+    report.update(text=text, entities=[_entity_dict(e) for e in entities], utf16_length=_utf16_len(text))
+
+    media_urls = _post_media_urls(record)
+    required = _required_media_count(record)
+    report["status"] = "OK"
+    if download:
+        media = stage("download", _download_post_media, media_urls, idx)
+        report["media"] = [{"file": name, "bytes": len(data)} for data, name in media]
+        if len(media) < required:
+            report["status"] = f"ОШИБКА: загружено {len(media)} медиа, требуется минимум {required}"
+    else:
+        report["media"] = [{"url": url} for url in media_urls]
+    if report["utf16_length"] > 1024 and report["media"]:
+        report["status"] += "; ВНИМАНИЕ: подпись длиннее 1024 символов"
+    timings["total"] = round(sum(timings.values()), 3)
+    return report
+
+def _print_dry_run_row(report: dict):
+    t = report["timings_ms"]
+    print(f"── Строка {report['row']} ({report['name']}): {report['status']}")
+    print("   этапы, мс: " + " · ".join(f"{k} {v:.2f}" for k, v in t.items()))
+    if "text" not in report:
+        return
+    if report["media"] and "bytes" in report["media"][0]:
+        print(f"   медиа: {len(report['media'])} файлов, {sum(m['bytes'] for m in report['media']) / 1048576:.2f} МБ")
+    print("   " + report["text"].replace("\n", "\n   "))
+    print("   сущности: " + ", ".join(f"{e['type']}@{e['offset']}+{e['length']}" for e in report["entities"]))
+
+async def dry_run() -> int:
+    path = _cli_value("file")
+    source = LocalFileRecordSource(path) if path else SOURCE
+    if source is None:
+        print("ОШИБКА: нет источника записей — укажите --file=... или настройте RECORD_SOURCE / GSHEET_ID и GOOGLE_CREDS_JSON.")
+        return 2
+    if path:
+        source.read_header()
+    spec = _cli_value("rows")
+    wanted = _parse_row_spec(spec) if spec else None
+    include_sent = wanted is not None or "--all" in sys.argv[1:]
+    rows = [
+        (idx, record) for idx, record in await source.fetch_all()
+        if (wanted is None or idx in wanted) and (include_sent or not _is_sent(record))
+        and str(record.get("Имя", "")).strip()
+    ]
+    download = "--no-download" not in sys.argv[1:]
+    print(f"Пробный прогон: строк {len(rows)}, медиа {'скачиваются' if download else 'не скачиваются'}, "
+          f"ссылка на пост — {DRY_RUN_POST_LINK}")
+    reports = []
+    for idx, record in rows:
+        report = _dry_run_row(idx, record, download)
+        _print_dry_run_row(report)
+        reports.append(report)
+
+    stages = {}
+    for report in reports:
+        for name, ms in report["timings_ms"].items():
+            stages.setdefault(name, []).append(ms)
+    summary = {name: {"mean": round(sum(v) / len(v), 3), "max": max(v), "rows": len(v)} for name, v in stages.items()}
+    if summary:
+        print("Итого, мс на строку (среднее / максимум):")
+        for name, st in summary.items():
+            print(f"  {name:<9} {st['mean']:10.3f} / {st['max']:10.3f}  (строк {st['rows']})")
+    failed = sum(1 for r in reports if r["status"].startswith("ОШИБКА"))
+    print(f"Строк с ошибками: {failed} из {len(reports)}")
+
+    out = _cli_value("json")
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump({"post_link": DRY_RUN_POST_LINK, "rows": reports, "summary": summary,
+                       "caches": cache_stats()}, f, ensure_ascii=False, indent=2)
+        print(f"Отчёт сохранён: {out}")
+    return 1 if failed else 0
+
+# --- 5.7. ЗАГРУЗКА В SQLITE (python telethon-poster.py --sqlite-import=posts.csv) ---
+# Для RECORD_SOURCE=sqlite: строки CSV/XLSX (например, выгрузки листа) переносятся в таблицу
+# RECORD_SOURCE_TABLE по номерам строк. Неизменённые строки не трогаются, поэтому работающий
+# процесс увидит через changed_since только правки. Запуск можно повторять (cron и т.п.).
+
+def sqlite_import(path: str) -> int:
+    if not isinstance(SOURCE, SqliteRecordSource):
+        print("ОШИБКА: --sqlite-import работает только с RECORD_SOURCE=sqlite (база — RECORD_SOURCE_PATH).")
+        return 2
+    if not os.path.exists(path):
+        print(f"ОШИБКА: файл {path} не найден.")
+        return 2
+    src = LocalFileRecordSource(path)
+    rows = src.values()
+    inserted, updated = SOURCE.upsert_rows(src.header, rows)
+    print(f"{path} → {SOURCE.path}:{SOURCE.table}: строк {len(rows)}, добавлено {inserted}, "
+          f"изменено {updated}, без изменений {len(rows) - inserted - updated}")
+    return 0
+
 # --- 6. ЗАПУСК СКРИПТА ---
 
 if __name__ == "__main__":
+    if BENCH_MODE:
+        sys.exit(run_benchmarks(BENCH_MODE))
+    if DRY_RUN:
+        sys.exit(asyncio.run(dry_run()))
+    if SQLITE_IMPORT is not None:
+        sys.exit(sqlite_import(SQLITE_IMPORT))
     asyncio.run(main())
\ No newline at end of file